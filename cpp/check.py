@@ -1,52 +1,272 @@
 #!/usr/bin/env python3
+"""Verify a router output against its trace.
 
+    python check.py <trace> <output> [--jobs N] [--memory-mb 256] [--spill-dir /tmp]
+
+Rows are reduced to 64 bit digests of their ids and hashes and the files
+are parsed in parallel byte ranges. Rows are spilled to disk in
+partitions, first by object to find the hash each read must return, the
+latest write of its object before it in the trace, then by request id to
+join the trace with the output. Every step holds one partition, the
+partition count follows from ``--memory-mb``.
+
+Reports wrong read results, count mismatches and the used bytes of every
+bucket.
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
 import sys
+import tempfile
 
-write_req_map = {}
-read_req_map = {}
-obj_map = {}
-input_cnt = 0
-
-
-def load_input(fname: str) -> None:
-    global input_cnt
-    with open(fname, 'r') as f:
-        for line in f:
-            if len(line) < 3:
-                continue
-            input_cnt += 1
-            parts = line.strip().split(',')
-            if parts[1] == 'R':
-                read_req_map[parts[0]] = obj_map[parts[2]]
-            else:
-                write_req_map[parts[0]] = int(parts[3])
-                obj_map[parts[2]] = parts[4]
-
-bucket_map = {}
-
-def check_output(fname: str) -> None:
-    output_cnt = 0
-    with open(fname, 'r') as f:
-        for line in f:
-            if len(line) < 3:
-                continue
-            output_cnt += 1
-            parts = line.strip().split(',')
-            if parts[0] in read_req_map:
-                if parts[1] != read_req_map[parts[0]]:
-                    print(f"read response wrong, required {read_req_map[parts[0]]}, go {parts[1]}")
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+from common import balance  # noqa: E402
+from common import trace  # noqa: E402
+
+
+RANGE_BYTES = 64 << 20
+MAX_BUCKET = 1 << 16
+
+TRACE_ROW = np.dtype([("request_id", "<i8"), ("object", "<u8"), ("hash", "<u8"), ("size", "<i8"), ("write", "?")])
+EXPECTED_ROW = np.dtype([("request_id", "<i8"), ("hash", "<u8"), ("size", "<i8"), ("write", "?")])
+OUTPUT_ROW = np.dtype([("request_id", "<i8"), ("hash", "<u8"), ("bucket", "<i8")])
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--jobs", default=os.cpu_count(), type=int)
+    parser.add_argument("--memory-mb", default=256, type=int, help="Trace bytes per partition")
+    parser.add_argument("--spill-dir", default=None, help="Defaults to the system temp dir")
+    parser.add_argument("--max-errors", default=20, type=int, help="Wrong results shown, all are counted")
+    return parser
+
+
+def digests(column):
+    """``StringColumn.digest`` of strings of any length, one width at a time."""
+    lengths = column.ends - column.starts
+    values = np.zeros(len(column), np.uint64)
+    for width in np.unique(lengths).tolist():
+        rows = np.flatnonzero(lengths == width)
+        values[rows] = column.take(rows).digest()
+    return values
+
+
+def parse_output(block):
+    """``request_id,result`` lines, the result is a hash or a bucket id."""
+    buf = np.frombuffer(block, np.uint8)
+    separators = np.flatnonzero(buf <= trace.COMMA)
+    line_ends = np.flatnonzero(buf[separators] == trace.NEWLINE)
+    first = np.empty_like(line_ends)
+    first[:1] = 0
+    first[1:] = line_ends[:-1] + 1
+    starts = np.empty_like(line_ends)
+    starts[:1] = 0
+    starts[1:] = separators[line_ends[:-1]] + 1
+    request_end = separators[first]
+    result_end = separators[line_ends]
+    rows = np.empty(len(line_ends), OUTPUT_ROW)
+    rows["request_id"] = trace.parse_int(buf, starts, request_end)
+    rows["hash"] = digests(trace.StringColumn(block, request_end + 1, result_end))
+    rows["bucket"] = -1
+    short = np.flatnonzero((result_end - request_end - 1 >= 1) & (result_end - request_end - 1 <= 5))
+    rows["bucket"][short] = trace.parse_int(buf, request_end[short] + 1, result_end[short])
+    return rows
+
+
+def spill(files, spill_dir, kind, task, rows, keys):
+    partitions = len(files)
+    for partition, part in trace.group_rows(keys % np.uint64(partitions)):
+        f = files[partition]
+        if f is None:
+            f = files[partition] = open(os.path.join(spill_dir, f"{kind}-{partition}-{task:05d}"), "wb")
+        rows[part].tofile(f)
+
+
+def load(spill_dir, kind, partition, dtype):
+    """Rows spilled for ``partition``, in task order."""
+    paths = sorted(glob.glob(os.path.join(spill_dir, f"{kind}-{partition}-*")))
+    if not paths:
+        return np.empty(0, dtype)
+    return np.concatenate([np.fromfile(path, dtype) for path in paths])
+
+
+def split_trace(task):
+    """Spill the trace rows of one byte range by object."""
+    index, path, start, stop, spill_dir, partitions = task
+    files = [None] * partitions
+    lines = 0
+    try:
+        for trace_batch in trace.read_batches(path, start=start, stop=stop):
+            rows = np.zeros(len(trace_batch), TRACE_ROW)
+            writes = trace_batch.writes()
+            rows["request_id"] = trace_batch.request_ids
+            rows["object"] = trace_batch.object_ids.digest()
+            rows["hash"][writes] = digests(trace_batch.hashes.take(writes))
+            rows["size"] = trace_batch.sizes
+            rows["write"][writes] = True
+            spill(files, spill_dir, "trace", index, rows, rows["object"])
+            lines += len(rows)
+    finally:
+        for f in files:
+            if f is not None:
+                f.close()
+    return "trace", lines
+
+
+def split_output(task):
+    """Spill the output rows of one byte range by request id."""
+    index, path, start, stop, spill_dir, partitions = task
+    files = [None] * partitions
+    lines = 0
+    try:
+        for block in trace.read_blocks(path, start=start, stop=stop):
+            rows = parse_output(block)
+            spill(files, spill_dir, "output", index, rows, rows["request_id"].astype(np.uint64))
+            lines += len(rows)
+    finally:
+        for f in files:
+            if f is not None:
+                f.close()
+    return "output", lines
+
+
+def resolve(task):
+    """Hash every read of one object partition must return, spilled by
+    request id. Returns the reads of objects not written before."""
+    partition, spill_dir, partitions = task
+    rows = load(spill_dir, "trace", partition, TRACE_ROW)
+    # Trace order within every object
+    order = np.argsort(rows["object"], kind="stable")
+    rows = rows[order]
+    index = np.arange(len(rows))
+    group_start = np.zeros(len(rows), np.int64)
+    if len(rows):
+        changed = np.flatnonzero(rows["object"][1:] != rows["object"][:-1]) + 1
+        group_start[changed] = changed
+        group_start = np.maximum.accumulate(group_start)
+    latest = np.maximum.accumulate(np.where(rows["write"], index, -1)) if len(rows) else index
+    orphans = ~rows["write"] & (latest < group_start)
+    expected = np.empty(len(rows), EXPECTED_ROW)
+    expected["request_id"] = rows["request_id"]
+    expected["hash"] = np.where(rows["write"], 0, rows["hash"][np.maximum(latest, 0)])
+    expected["size"] = rows["size"]
+    expected["write"] = rows["write"]
+    files = [None] * partitions
+    try:
+        spill(files, spill_dir, "expected", partition, expected, expected["request_id"].astype(np.uint64))
+    finally:
+        for f in files:
+            if f is not None:
+                f.close()
+    return rows["request_id"][orphans].tolist()
+
+
+def join(task):
+    """Compare the output with the expected rows of one request id
+    partition, returns error counts, shown errors and bucket bytes."""
+    partition, spill_dir, max_errors = task
+    expected = load(spill_dir, "expected", partition, EXPECTED_ROW)
+    output = load(spill_dir, "output", partition, OUTPUT_ROW)
+    expected = expected[np.argsort(expected["request_id"], kind="stable")]
+    output = output[np.argsort(output["request_id"], kind="stable")]
+    errors = []
+    counts = {}
+
+    def report(kind, request_ids, message):
+        if not len(request_ids):
+            return
+        counts[kind] = counts.get(kind, 0) + len(request_ids)
+        for request_id in request_ids[:max_errors].tolist():
+            errors.append((request_id, message.format(request_id)))
+
+    duplicated = output["request_id"][1:][output["request_id"][1:] == output["request_id"][:-1]]
+    report("duplicate", np.unique(duplicated), "output duplicates request {}")
+    output = output[np.concatenate([[True], output["request_id"][1:] != output["request_id"][:-1]])] if len(output) else output
+    found = np.searchsorted(expected["request_id"], output["request_id"])
+    known = found < len(expected)
+    known[known] = expected["request_id"][found[known]] == output["request_id"][known]
+    report("unknown", output["request_id"][~known], "output has request {} not in the trace")
+    answered = np.zeros(len(expected), bool)
+    answered[found[known]] = True
+    report("missing", expected["request_id"][~answered], "output misses request {}")
+
+    output, matched = output[known], expected[found[known]]
+    reads = ~matched["write"]
+    wrong = reads & (output["hash"] != matched["hash"])
+    report("read", output["request_id"][wrong], "read response wrong for request {}")
+    writes = matched["write"]
+    bad = writes & ((output["bucket"] < 0) | (output["bucket"] >= MAX_BUCKET))
+    report("write", output["request_id"][bad], "write response wrong for request {}, no bucket id")
+    placed = writes & ~bad
+    used = np.bincount(output["bucket"][placed], weights=matched["size"][placed], minlength=0)
+    return counts, errors, used
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+    spill_root = tempfile.TemporaryDirectory(prefix="check-", dir=args.spill_dir)
+    spill_dir = spill_root.name
+    partitions = max(args.jobs, -(-os.path.getsize(args.input) // (args.memory_mb << 20)))
+    tasks = []
+    for path, split in ((args.input, split_trace), (args.output, split_output)):
+        ranges = trace.split_ranges(path, max(args.jobs, -(-os.path.getsize(path) // RANGE_BYTES)))
+        tasks += [(split, (index, path, start, stop, spill_dir, partitions)) for index, (start, stop) in enumerate(ranges)]
+    with spill_root, multiprocessing.Pool(args.jobs) as pool:
+        lines = {"trace": 0, "output": 0}
+        for kind, count in pool.starmap(_call, tasks):
+            lines[kind] += count
+        orphans = []
+        for found in pool.imap(resolve, [(partition, spill_dir, partitions) for partition in range(partitions)]):
+            orphans += found
+        counts = {}
+        errors = []
+        used = np.zeros(0)
+        for found, shown, bucket_bytes in pool.imap(join, [(p, spill_dir, args.max_errors) for p in range(partitions)]):
+            for kind, count in found.items():
+                counts[kind] = counts.get(kind, 0) + count
+            errors += shown
+            if len(bucket_bytes) > len(used):
+                bucket_bytes[:len(used)] += used
+                used = bucket_bytes
             else:
-                bid = int(parts[1])
-                bucket_map[bid] = bucket_map.get(bid, 0) + write_req_map[parts[0]]
-    if output_cnt != input_cnt:
-        print(f"output count mismatch, required {input_cnt}, got {output_cnt}")
+                used[:len(bucket_bytes)] += bucket_bytes
 
+    for request_id in sorted(orphans)[:args.max_errors]:
+        print(f"input wrong, request {request_id} reads an object before its write")
+    for _, error in sorted(errors)[:args.max_errors]:
+        print(error)
+    shown = min(len(errors), args.max_errors)
+    if sum(counts.values()) > shown:
+        print(f"{sum(counts.values()) - shown} more wrong results: {counts}")
+    if lines["output"] != lines["trace"]:
+        print(f"output count mismatch, required {lines['trace']}, got {lines['output']}")
+
+    buckets = np.flatnonzero(used)
+    if not len(buckets):
+        print("no writes placed")
+        return 1 if counts or orphans else 0
+    ranked = buckets[np.argsort(-used[buckets], kind="stable")]
     print("top buckets:")
-    for _, v in sorted(bucket_map.items(), key=lambda x: x[1], reverse=True)[:10]:
-        print(f"\t{v}")
+    for bucket_id in ranked[:10].tolist():
+        print(f"\t{bucket_id}\t{int(used[bucket_id])}")
+    print("bottom buckets:")
+    for bucket_id in ranked[-10:][::-1].tolist():
+        print(f"\t{bucket_id}\t{int(used[bucket_id])}")
+    summary = balance.summarize(used[buckets].astype(np.int64).tolist())
+    print(f"balance over {summary['buckets']} buckets: {balance.format_summary(summary)}")
+    return 1 if counts or orphans or lines["output"] != lines["trace"] else 0
 
 
-if __name__ == '__main__':
-    load_input(sys.argv[1])
-    check_output(sys.argv[2])
+def _call(function, task):
+    return function(task)
 
+
+if __name__ == '__main__':
+    sys.exit(main())
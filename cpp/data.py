@@ -1,44 +1,193 @@
-import random
-import time
+"""Trace generator.
+
+    python data.py <objects> [seed] [--rw-factor 10] [--zipf 0] [--overwrite 0] [--jobs N]
+
+Every object is written once and then read, ``--rw-factor`` requests per
+object on average. The first request of an object is always its write.
+
+- ``--zipf s`` draws the reads from a Zipf popularity over the objects,
+  object ranks are random. 0 reads every object ``rw-factor - 1`` times
+- ``--overwrite f`` adds ``f * objects`` writes of objects written
+  before, with a new size and hash, at random times after the first write.
+  check.py verifies reads against the latest write, the routers place an
+  object on its every write. ``--batch-mode split`` sends the writes of a
+  flush ahead of its reads and needs objects written once
+- ``--size-decay d`` is the base of ``rand_size``, sizes follow
+  ``ceil(log(r) / log(d))`` for ``r`` uniform in ``(0, d]``
+
+The request timeline is shuffled once in this process. Ids, hashes and
+sizes come from a counter based generator keyed by the seed and the
+object or line index, so worker processes render chunks of lines
+independently and the output does not depend on ``--jobs``.
+"""
+
+import argparse
+import multiprocessing
+import os
 import sys
-import string
-import math
+import time
+
+import numpy as np
+
 
 LEN_OBJ_ID = 32
 LEN_HASH = 128
 RW_FACTOR = 10
+SIZE_DECAY = 0.99
+CHUNK_LINES = 1 << 18
 
+ALPHABET = np.frombuffer(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", np.uint8)
+_POWERS = 10 ** np.arange(1, 19, dtype=np.int64)
+# Streams of the counter based generator
+_OBJ_ID, _HASH, _SIZE = 1, 2, 3
 
-def rand_str(l: int) -> str:
-    lower = string.ascii_lowercase
-    upper = string.ascii_uppercase
-    num = string.digits
-    all = lower + upper + num
-    return "".join(random.choices(all, k=l))
 
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("objects", type=int)
+    parser.add_argument("seed", type=int, nargs="?", default=None, help="Defaults to the current time")
+    parser.add_argument("--rw-factor", default=RW_FACTOR, type=float, help="Requests per object, one is the write")
+    parser.add_argument("--zipf", default=0.0, type=float, help="Zipf exponent of the read popularity")
+    parser.add_argument("--overwrite", default=0.0, type=float, help="Overwrites per object")
+    parser.add_argument("--size-decay", default=SIZE_DECAY, type=float)
+    parser.add_argument("--jobs", default=os.cpu_count(), type=int)
+    parser.add_argument("--chunk-lines", default=CHUNK_LINES, type=int)
+    parser.add_argument("--output", default=None, help="Defaults to stdout")
+    return parser
 
-def rand_size() -> int:
-    r = (1 - random.random()) * 0.99
-    return math.ceil(math.log(r, 0.99))
 
+def mix(values):
+    """splitmix64 finalizer."""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
 
-if __name__ == '__main__':
-    random.seed(time.time())
-    n_objects = int(sys.argv[1])
 
-    obj_set = set()
-    while len(obj_set) != n_objects:
-        for _ in range(n_objects - len(obj_set)):
-            obj_set.add(rand_str(LEN_OBJ_ID))
+def random_words(seed, stream, keys, words):
+    """``words`` random uint64 for every key, the same for the same seed,
+    stream and key."""
+    with np.errstate(over="ignore"):
+        salt = mix(np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(stream))
+        counters = keys.astype(np.uint64)[:, None] * np.uint64(words) + np.arange(words, dtype=np.uint64)
+        return mix(counters ^ salt)
+
 
-    req_objs = list(obj_set) * RW_FACTOR
-    random.shuffle(req_objs)
+def random_chars(seed, stream, keys, length):
+    # Four chars from every word, 16 bits modulo 62 is all but unbiased
+    pieces = random_words(seed, stream, keys, -(-length // 4)).view(np.uint16)
+    return ALPHABET[pieces[:, :length] % len(ALPHABET)]
 
-    for i, o in enumerate(req_objs):
-        if o in obj_set:
-            print(f"{i},W,{o},{rand_size()},{rand_str(LEN_HASH)}")
-            obj_set.remove(o)
+
+def random_sizes(seed, keys, decay):
+    uniform = (random_words(seed, _SIZE, keys, 1)[:, 0] >> np.uint64(11)) * 2.0 ** -53
+    # rand_size of the original generator
+    return np.ceil(np.log((1 - uniform) * decay) / np.log(decay)).astype(np.int64)
+
+
+def digits(values):
+    """Right aligned decimal digits of ``values`` and the mask of the
+    significant ones."""
+    width = len(str(int(values.max())))
+    scales = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    chars = (values[:, None] // scales % 10 + ord("0")).astype(np.uint8)
+    lengths = np.searchsorted(_POWERS, values, side="right") + 1
+    return chars, np.arange(width) >= (width - lengths)[:, None]
+
+
+def timeline(args, rng):
+    """Object of every request in trace order and whether it is a write."""
+    objects = args.objects
+    if not objects:
+        return np.empty(0, np.int32), np.empty(0, bool)
+    if args.zipf == 0 and float(args.rw_factor).is_integer():
+        reads = np.full(objects, int(args.rw_factor) - 1, np.int64)
+    else:
+        popularity = 1.0 / np.arange(1, objects + 1) ** args.zipf
+        popularity = popularity[rng.permutation(objects)]
+        reads = rng.multinomial(round(objects * (args.rw_factor - 1)), popularity / popularity.sum())
+    overwrites = np.bincount(rng.integers(objects, size=round(objects * args.overwrite)), minlength=objects)
+    counts = 1 + reads + overwrites
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    total = int(ends[-1])
+    # Slot k of the grouped requests happens at time order[k]
+    order = np.arange(total, dtype=np.int32 if total < 2 ** 31 else np.int64)
+    rng.shuffle(order)
+    sequence = np.empty(total, order.dtype)
+    sequence[order] = np.repeat(np.arange(objects, dtype=order.dtype), counts)
+    # The first slot of an object is its write, the last ones its overwrites
+    write = np.zeros(total, bool)
+    write[order[starts]] = True
+    written = int(overwrites.sum())
+    if written:
+        slots = np.repeat(ends - overwrites - np.cumsum(overwrites) + overwrites, overwrites) + np.arange(written)
+        write[order[slots]] = True
+    # Swap labels where a read comes first, the write moves ahead of it
+    first = np.minimum.reduceat(order, starts)
+    late = ~write[first]
+    write[first[late]] = True
+    write[order[starts][late]] = False
+    return sequence, write
+
+
+def render(task):
+    """Trace lines ``start..`` for the objects and write flags given."""
+    start, sequence, write, seed, decay = task
+    count = len(sequence)
+    line_ids = np.arange(start, start + count, dtype=np.int64)
+    comma = np.full((count, 1), ord(","), np.uint8)
+    everywhere = np.ones((count, 1), bool)
+    id_chars, id_keep = digits(line_ids)
+    action = np.where(write, ord("W"), ord("R")).astype(np.uint8)[:, None]
+    object_ids = random_chars(seed, _OBJ_ID, sequence, LEN_OBJ_ID)
+    sizes = np.ones(count, np.int64)
+    hashes = np.zeros((count, LEN_HASH), np.uint8)
+    rows = np.flatnonzero(write)
+    if len(rows):
+        sizes[rows] = random_sizes(seed, line_ids[rows], decay)
+        hashes[rows] = random_chars(seed, _HASH, line_ids[rows], LEN_HASH)
+    size_chars, size_keep = digits(sizes)
+    tail = write[:, None]
+    columns = [
+        (id_chars, id_keep),
+        (comma, everywhere),
+        (action, everywhere),
+        (comma, everywhere),
+        (object_ids, np.ones(object_ids.shape, bool)),
+        (comma, tail),
+        (size_chars, size_keep & tail),
+        (comma, tail),
+        (hashes, np.broadcast_to(tail, hashes.shape)),
+        (np.full((count, 1), ord("\n"), np.uint8), everywhere),
+    ]
+    chars = np.concatenate([column for column, _ in columns], axis=1)
+    keep = np.concatenate([mask for _, mask in columns], axis=1)
+    return chars[keep].tobytes()
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+    seed = int(time.time()) if args.seed is None else args.seed
+    sequence, write = timeline(args, np.random.default_rng(seed))
+    tasks = (
+        (start, sequence[start:start + args.chunk_lines], write[start:start + args.chunk_lines], seed, args.size_decay)
+        for start in range(0, len(sequence), args.chunk_lines)
+    )
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        if args.jobs > 1:
+            with multiprocessing.Pool(args.jobs) as pool:
+                for chunk in pool.imap(render, tasks):
+                    output.write(chunk)
         else:
-            print(f"{i},R,{o}")
+            for task in tasks:
+                output.write(render(task))
+    finally:
+        output.flush()
+        if args.output:
+            output.close()
 
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,304 @@
+"""End to end runs of every router and worker variant on one trace.
+
+Generates a seeded trace with cpp/data.py (kept in --work-dir for later
+runs), then per variant starts the workers, runs the router, verifies
+its output with cpp/check.py and stops the workers. Every run records
+throughput, batch latency, peak RSS and bucket skew into --results. With
+--baseline, a result worse than the baseline by more than --tolerance is
+flagged and the exit code is 1.
+
+    python bench_e2e.py --objects 100000 --bucket-num 4 --results baseline.json
+    python bench_e2e.py --variants mq,http-binary --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from common import balance
+from common import framing
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CPP = os.path.join(ROOT, "..", "cpp")
+
+# Compared against the baseline, True when larger is better
+METRICS = {
+    "lines_per_second": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "router_rss_mb": False,
+    "worker_rss_mb": False,
+    "skew": False,
+}
+
+
+def v0(args, port):
+    workers = [["worker_v0.py", "--worker-port", str(port + i), "--id", str(i)] for i in range(args.bucket_num)]
+    router = ["router_v0.py", "--worker-start-port", str(port)]
+    return workers, router, [port + i for i in range(args.bucket_num)]
+
+
+def mq(args, port):
+    workers = [
+        ["mq/worker.py", "--task-pub-port", str(port), "--result-pub-port", str(port + 1 + i), "--id", str(i)]
+        for i in range(args.bucket_num)
+    ]
+    router = ["mq/router.py", "--task-pub-port", str(port)]
+    for i in range(args.bucket_num):
+        router += ["--result-pub-port", str(port + 1 + i)]
+    return workers, router, [port + 1 + i for i in range(args.bucket_num)]
+
+
+def http(batch_format, transport="http"):
+    def variant(args, port):
+        worker = "http/worker.py" if transport == "http" else "raw/worker.py"
+        worker_args = []
+        router = ["http/router.py", "--start-port", str(port), "--batch-format", batch_format]
+        ready = [port + i for i in range(args.bucket_num)]
+        if transport != "http":
+            router += ["--transport", transport, "--socket-dir", args.work_dir]
+        if transport in ("unix", "shm"):
+            worker_args = ["--unix-dir", args.work_dir] + (["--shm"] if transport == "shm" else [])
+            ready = [framing.socket_path(args.work_dir, port + i) for i in range(args.bucket_num)]
+        workers = [[worker, "--port", str(port + i), "--id", str(i)] + worker_args for i in range(args.bucket_num)]
+        return workers, router, ready
+    return variant
+
+
+def http_host(args, port):
+    per_host = -(-args.bucket_num // args.hosts)
+    workers = []
+    for first in range(0, args.bucket_num, per_host):
+        last = min(first + per_host, args.bucket_num) - 1
+        workers.append(["http/worker.py", "--port", str(port + len(workers)), "--buckets", f"{first}-{last}"])
+    router = ["http/router.py", "--start-port", str(port), "--batch-format", "binary", "--buckets-per-host", str(per_host)]
+    return workers, router, [port + host for host in range(len(workers))]
+
+
+VARIANTS = {
+    "v0": v0,
+    "mq": mq,
+    "http-json": http("json"),
+    "http-binary": http("binary"),
+    "http-host": http_host,
+    "raw-tcp": http("binary", "tcp"),
+    "raw-unix": http("binary", "unix"),
+    "raw-shm": http("binary", "shm"),
+}
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--objects", default=100000, type=int, help="Objects of the trace, 10 lines each")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--data", default=None, help="Use this trace instead of generating one")
+    parser.add_argument("--bucket-num", default=4, type=int)
+    parser.add_argument("--hosts", default=1, type=int, help="Worker hosts of http-host")
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    parser.add_argument("--start-port", default=7500, type=int)
+    parser.add_argument("--work-dir", default="/tmp/bench_e2e", help="Traces, logs and router output")
+    parser.add_argument("--results", default="bench_e2e.json")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", default=0.1, type=float, help="Allowed relative regression")
+    parser.add_argument("--timeout", default=600, type=float, help="Seconds a router may run")
+    parser.add_argument("--repeat", default=1, type=int, help="Runs per variant, the fastest one is kept")
+    return parser
+
+
+def generate(args):
+    if args.data is not None:
+        return os.path.abspath(args.data)
+    path = os.path.join(args.work_dir, f"trace-{args.objects}-{args.seed}.txt")
+    if not os.path.exists(path):
+        print(f"Generate {path}", file=sys.stderr)
+        with open(path + ".tmp", "w") as f:
+            subprocess.run(
+                [sys.executable, os.path.join(CPP, "data.py"), str(args.objects), str(args.seed)],
+                stdout=f, check=True,
+            )
+        os.rename(path + ".tmp", path)
+    return path
+
+
+def wait_ready(targets, timeout=60):
+    """Wait for every worker port, or socket path, to take connections."""
+    deadline = time.time() + timeout
+    for target in targets:
+        while True:
+            try:
+                if isinstance(target, str):
+                    if os.path.exists(target):
+                        break
+                else:
+                    socket.create_connection(("localhost", target), timeout=1).close()
+                    break
+            except OSError:
+                pass
+            if time.time() > deadline:
+                raise TimeoutError(f"Worker at {target} did not come up")
+            time.sleep(0.1)
+
+
+def reap(process, timeout):
+    """Exit code and peak RSS in KiB of a child, killed after ``timeout``."""
+    deadline = time.time() + timeout
+    while True:
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return process.returncode, rusage.ru_maxrss
+        if time.time() > deadline:
+            process.kill()
+            deadline = float("inf")
+        time.sleep(0.05)
+
+
+def parse_log(text):
+    report = {}
+    found = re.search(r"Time cost: ([0-9.]+)", text)
+    if found:
+        report["seconds"] = float(found.group(1))
+    found = re.search(r"Batch latency: batches=(\d+) p50=([0-9.]+)ms p99=([0-9.]+)ms", text)
+    if found:
+        report["batches"] = int(found.group(1))
+        report["p50_ms"] = float(found.group(2))
+        report["p99_ms"] = float(found.group(3))
+    used_bytes = [int(value) for value in re.findall(r"\] (?:\d+) = (\d+) bytes", text)]
+    if used_bytes:
+        report["skew"] = balance.summarize(used_bytes)["max_min"]
+    return report
+
+
+def check(data, output):
+    """Return code of check.py and the error lines it printed ahead of the
+    bucket summary."""
+    checked = subprocess.run(
+        [sys.executable, os.path.join(CPP, "check.py"), data, output], capture_output=True, text=True
+    )
+    errors = []
+    for line in (checked.stdout + checked.stderr).splitlines():
+        if line.startswith(("top buckets:", "no writes placed")):
+            break
+        errors.append(line)
+    return checked.returncode, errors
+
+
+def run_variant(args, name, data, lines):
+    log_dir = os.path.join(args.work_dir, name)
+    os.makedirs(log_dir, exist_ok=True)
+    workers, router, ready = VARIANTS[name](args, args.start_port)
+    processes = []
+    result = {"ok": False}
+    try:
+        for i, command in enumerate(workers):
+            with open(os.path.join(log_dir, f"worker-{i}.log"), "w") as log:
+                processes.append(subprocess.Popen(
+                    [sys.executable] + command, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT
+                ))
+        wait_ready(ready)
+        output = os.path.join(log_dir, "out.txt")
+        router_log = os.path.join(log_dir, "router.log")
+        router += ["--data", data, "--bucket-num", str(args.bucket_num)]
+        s = time.time()
+        with open(output, "w") as out, open(router_log, "w") as log:
+            process = subprocess.Popen([sys.executable] + router, cwd=ROOT, stdout=out, stderr=log)
+            returncode, router_rss = reap(process, args.timeout)
+        wall = time.time() - s
+        with open(router_log) as log:
+            result.update(parse_log(log.read()))
+        check_returncode, errors = check(data, output)
+        result.update(
+            ok=returncode == 0 and check_returncode == 0,
+            returncode=returncode,
+            check_returncode=check_returncode,
+            errors=errors[:5],
+            wall_seconds=wall,
+            lines_per_second=lines / result.get("seconds", wall),
+            router_rss_mb=router_rss / 1024,
+        )
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        worker_rss = [reap(process, 10)[1] for process in processes]
+        result["worker_rss_mb"] = sum(worker_rss) / 1024
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing every regression against ``baseline``."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if before.get("ok") and not result.get("ok"):
+            regressions.append(f"{name}: output no longer verifies {result.get('errors')}")
+        for metric, larger_is_better in METRICS.items():
+            if metric not in result or not before.get(metric):
+                continue
+            change = result[metric] / before[metric] - 1
+            if (-change if larger_is_better else change) > tolerance:
+                regressions.append(f"{name}: {metric} {before[metric]:.4g} -> {result[metric]:.4g} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    args.work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(args.work_dir, exist_ok=True)
+    data = generate(args)
+    with open(data, "rb") as f:
+        lines = sum(1 for _ in f)
+    results = {}
+    for name in args.variants.split(","):
+        runs = []
+        for _ in range(args.repeat):
+            print(f"Run {name} on {lines} lines, {args.bucket_num} buckets", file=sys.stderr)
+            runs.append(run_variant(args, name, data, lines))
+        # Any failed run is reported, slower runs are noise of a shared machine
+        failed = [run for run in runs if not run["ok"]]
+        results[name] = result = failed[0] if failed else max(runs, key=lambda run: run["lines_per_second"])
+        print(
+            f"{name:>12}: {'ok' if result['ok'] else 'FAILED'} {result.get('lines_per_second', 0):12,.0f} lines/s "
+            f"p50 {result.get('p50_ms', 0):8.2f}ms p99 {result.get('p99_ms', 0):8.2f}ms "
+            f"router {result.get('router_rss_mb', 0):7.1f}MiB workers {result['worker_rss_mb']:7.1f}MiB "
+            f"skew {result.get('skew', 0):.4f}"
+        )
+    report = {
+        "config": {
+            "data": data,
+            "lines": lines,
+            "objects": args.objects,
+            "seed": args.seed,
+            "bucket_num": args.bucket_num,
+            "hosts": args.hosts,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.results, "w") as f:
+        json.dump(report, f, indent=2)
+    failed = [name for name, result in results.items() if not result["ok"]]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"]["lines"] != lines or baseline["config"]["bucket_num"] != args.bucket_num:
+            print(f"Baseline ran on another setup: {baseline['config']}", file=sys.stderr)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    if failed:
+        print(f"FAILED {','.join(failed)}")
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""Placement throughput and bucket balance of every placement strategy.
+
+Sizes come from the writes of a trace, or follow the size distribution
+of cpp/data.py. max/min is the skew cpp/check.py shows in its top
+buckets, objects max/min the one of the object counts.
+
+    python bench_placement.py --writes 10000000 --bucket-num 100
+    python bench_placement.py --data ../data.txt --bucket-num 4
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from common import balance
+from common import placement
+from common import trace
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default=None)
+    parser.add_argument("--writes", default=10000000, type=int)
+    parser.add_argument("--bucket-num", default=100, type=int)
+    # Writes of a trace block
+    parser.add_argument("--batch-writes", default=12000, type=int)
+    parser.add_argument("--strategies", default=",".join(placement.STRATEGIES))
+    return parser
+
+
+def load_sizes(args):
+    if args.data is not None:
+        return np.concatenate([
+            trace_batch.sizes[trace_batch.writes()] for trace_batch in trace.read_batches(args.data)
+        ])
+    # rand_size of cpp/data.py
+    r = (1 - np.random.default_rng(0).random(args.writes)) * 0.99
+    return np.ceil(np.log(r) / np.log(0.99)).astype(np.int64)
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    sizes = load_sizes(args)
+    print(f"{len(sizes)} writes, {args.bucket_num} buckets, largest write {sizes.max()}")
+    for name in args.strategies.split(","):
+        target = placement.STRATEGIES[name](range(args.bucket_num))
+        objects = np.zeros(args.bucket_num, np.int64)
+        s = time.perf_counter()
+        for start in range(0, len(sizes), args.batch_writes):
+            bucket_ids = target.place(sizes[start:start + args.batch_writes])
+            objects += np.bincount(bucket_ids, minlength=args.bucket_num)
+        cost = time.perf_counter() - s
+        summary = balance.summarize(target.used.tolist())
+        print(
+            f"{name:>10}: {len(sizes) / cost:12,.0f} writes/s, max/min {summary['max_min']:.6f}, "
+            f"max-min {summary['max'] - summary['min']} bytes, objects max/min {objects.max() / objects.min():.4f}"
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""Time the routers spend writing results: print per line, one write and
+flush per reply, the buffered sink, and the sink behind a reorder buffer
+taking the replies of ``--buckets`` buckets, highest bucket first.
+
+    python bench_sink.py --lines 10000000 > /dev/null
+"""
+import argparse
+import os
+import sys
+import time
+
+from common import sink
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", default=10000000, type=int)
+    # Lines per worker reply
+    parser.add_argument("--reply-lines", default=25000, type=int)
+    parser.add_argument("--buffer-bytes", default=sink.BUFFER_BYTES, type=int)
+    parser.add_argument("--buckets", default=4, type=int)
+    parser.add_argument("--reorder-window", default=sink.REORDER_WINDOW, type=int)
+    return parser
+
+
+def make_replies(args):
+    # Every flush of ``buckets`` replies spreads its rows round robin
+    line = b"%d," + os.urandom(32).hex().encode()
+    flush = args.reply_lines * args.buckets
+    replies = []
+    for start in range(0, args.lines // flush * flush, flush):
+        for bucket_id in reversed(range(args.buckets)):
+            ids = range(start + bucket_id, start + flush, args.buckets)
+            replies.append(b"\n".join(line % i for i in ids))
+    return replies
+
+
+def print_lines(args, replies):
+    for reply in replies:
+        for line in reply.split(b"\n"):
+            print(line.decode())
+    sys.stdout.flush()
+
+
+def write_replies(args, replies):
+    for reply in replies:
+        sys.stdout.buffer.write(reply + b"\n")
+        sys.stdout.buffer.flush()
+
+
+def sink_replies(args, replies):
+    result_sink = sink.ResultSink(buffer_bytes=args.buffer_bytes)
+    for reply in replies:
+        result_sink.write(reply)
+    # Time until the caller may go on, the rest is on the writer thread
+    blocked = time.perf_counter()
+    result_sink.close()
+    return blocked
+
+
+def reorder_replies(args, replies):
+    result_sink = sink.ReorderBuffer(sink.ResultSink(buffer_bytes=args.buffer_bytes), args.reorder_window)
+    for reply in replies:
+        result_sink.write(reply)
+    blocked = time.perf_counter()
+    result_sink.close()
+    return blocked
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    replies = make_replies(args)
+    lines = len(replies) * args.reply_lines
+    funcs = (("print", print_lines), ("write", write_replies), ("sink", sink_replies), ("reorder", reorder_replies))
+    for name, func in funcs:
+        s = time.perf_counter()
+        blocked = func(args, replies)
+        e = time.perf_counter()
+        caller = (blocked or e) - s
+        print(f"{name}: {lines / (e - s):,.0f} lines/s, caller busy {caller:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Memory and throughput of the worker stores.
+
+    python bench_store.py --objects 1000000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+from common import batch
+from common import store
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--objects", default=1000000, type=int)
+    parser.add_argument("--batch-size", default=50000, type=int)
+    return parser
+
+
+def make_batches(args):
+    # Packed columns shaped like cpp/data.py: 32 char ids, 128 char hashes
+    batches = []
+    for start in range(0, args.objects, args.batch_size):
+        n = min(args.batch_size, args.objects - start)
+        object_ids = batch.pack_strings([os.urandom(16).hex().encode() for _ in range(n)])
+        hashes = batch.pack_strings([os.urandom(64).hex().encode() for _ in range(n)])
+        batches.append((object_ids, hashes))
+    return batches
+
+
+def run(kind, batches, objects):
+    tracemalloc.start()
+    s = time.perf_counter()
+    target = store.STORES[kind]()
+    # Decoded inside the measurement, like a worker decoding a request
+    unpack = batch.unpack_rows if target.columnar else batch.unpack_strings
+    for object_ids, hashes in batches:
+        target.put_many(unpack(object_ids), unpack(hashes))
+    put = time.perf_counter() - s
+    resident = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    s = time.perf_counter()
+    for object_ids, _ in batches:
+        list(target.get_many(unpack(object_ids)))
+    get = time.perf_counter() - s
+    print(
+        f"{kind:>6}: {resident / objects:.1f} B/object "
+        f"({target.payload_bytes / objects:.0f} payload), "
+        f"put {objects / put:,.0f}/s, get {objects / get:,.0f}/s"
+    )
+    return resident
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    batches = make_batches(args)
+    plain = run("dict", batches, args.objects)
+    arena = run("arena", batches, args.objects)
+    print(f"arena/dict memory: {arena / plain:.2f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Lines per second of the per-line ingest loop against common.trace.
+The columns were meant to reach 5x the per-line loop, they reach 3-4x
+(2.5-3x with the digests the routers need).
+
+    python bench_trace.py --data ../data_large.txt
+"""
+import argparse
+import sys
+import time
+
+from common import trace
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default="data.txt")
+    parser.add_argument("--block-size", default=trace.BLOCK_SIZE, type=int)
+    return parser
+
+
+def per_line(args):
+    counter = 0
+    with open(args.data) as reader:
+        for line in reader:
+            counter += 1
+            body = {}
+            line = line.strip().split(",")
+            body["request_id"] = line[0]
+            body["action"] = line[1]
+            body["object_id"] = line[2]
+            if len(line) > 3:
+                body["size"] = int(line[3])
+                body["hash"] = line[4]
+    return counter
+
+
+def columns(args):
+    counter = 0
+    for trace_batch in trace.read_batches(args.data, args.block_size):
+        counter += len(trace_batch)
+    return counter
+
+
+def columns_with_digests(args):
+    # What the routers pay: columns plus the object id digests for routing
+    counter = 0
+    for trace_batch in trace.read_batches(args.data, args.block_size):
+        trace_batch.object_ids.digest()
+        counter += len(trace_batch)
+    return counter
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    baseline = None
+    for fn in (per_line, columns, columns_with_digests):
+        s = time.perf_counter()
+        lines = fn(args)
+        rate = lines / (time.perf_counter() - s)
+        baseline = baseline or rate
+        print(f"{fn.__name__:>20}: {lines} lines, {rate:,.0f} lines/s, {rate / baseline:.1f}x")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""Write throughput of the worker stores with and without the write-ahead
+log, and how long a restarted worker takes to recover.
+
+    python bench_wal.py --objects 1000000 --wal-dir /tmp/wal
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+from common import batch
+from common import store
+from common import wal
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--objects", default=1000000, type=int)
+    # 100k messages per flush spread over a few buckets
+    parser.add_argument("--batch-size", default=33000, type=int)
+    parser.add_argument("--store", default="dict", choices=sorted(store.STORES))
+    parser.add_argument("--wal-dir", default="wal.bench")
+    parser.add_argument("--snapshot-bytes", default=wal.SNAPSHOT_BYTES, type=int)
+    return parser
+
+
+def make_batches(args):
+    # Write batches as the http worker receives them
+    batches = []
+    for start in range(0, args.objects, args.batch_size):
+        n = min(args.batch_size, args.objects - start)
+        batches.append(batch.encode_batch(
+            "W",
+            range(start, start + n),
+            [os.urandom(16).hex().encode() for _ in range(n)],
+            [os.urandom(64).hex().encode() for _ in range(n)],
+        ))
+    return batches
+
+
+def run(args, batches, log_dir=None):
+    # Mirrors columnar.write_columnar
+    target = store.STORES[args.store]()
+    log = None
+    if log_dir is not None:
+        log = wal.Log(log_dir, target, args.snapshot_bytes)
+        log.recover()
+    s = time.perf_counter()
+    for body in batches:
+        if log is not None:
+            _, _, bounds = batch.split_batch(body)
+            view = memoryview(body)
+            log.append_columns(view[slice(*bounds[1])], view[slice(*bounds[2])])
+        _, request_ids, object_ids, hashes = batch.decode_batch(body)
+        target.put_many(object_ids, hashes)
+        b"\n".join([b"%d,0" % request_id for request_id in request_ids])
+        if log is not None:
+            log.commit()
+    cost = time.perf_counter() - s
+    if log is not None:
+        log.close()
+    return cost
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    batches = make_batches(args)
+    shutil.rmtree(args.wal_dir, ignore_errors=True)
+    try:
+        memory = run(args, batches)
+        logged = run(args, batches, args.wal_dir)
+        print(f"in memory: {args.objects / memory:,.0f} writes/s")
+        print(f"      wal: {args.objects / logged:,.0f} writes/s, overhead {logged / memory - 1:.1%}")
+        s = time.perf_counter()
+        recovered = store.STORES[args.store]()
+        records = wal.Log(args.wal_dir, recovered).recover()
+        print(f"recovery: {len(recovered)} objects, {records} records in {time.perf_counter() - s:.2f}s")
+    finally:
+        shutil.rmtree(args.wal_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
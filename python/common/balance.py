@@ -0,0 +1,41 @@
+"""Bucket balance statistics for the router reports."""
+
+import heapq
+import math
+import statistics
+
+
+def summarize(used_bytes):
+    values = list(used_bytes)
+    mean = statistics.fmean(values)
+    high, low = max(values), min(values)
+    return {
+        "buckets": len(values),
+        "max": high,
+        "min": low,
+        "mean": mean,
+        "stddev": statistics.pstdev(values),
+        "max_mean": high / mean if mean else 0.0,
+        "max_min": high / low if low else math.inf,
+    }
+
+
+def format_summary(summary):
+    return (
+        f"max={summary['max']} min={summary['min']} mean={summary['mean']:.1f} "
+        f"stddev={summary['stddev']:.1f} max/mean={summary['max_mean']:.4f} "
+        f"max/min={summary['max_min']:.4f}"
+    )
+
+
+def global_heap(sizes, bucket_num):
+    """Used bytes per bucket when a single least-used heap places every
+    write, like ``push_to_bucket`` of a single router."""
+    heap = [(0, bucket_id) for bucket_id in range(bucket_num)]
+    for size in sizes:
+        used, bucket_id = heap[0]
+        heapq.heapreplace(heap, (used + size, bucket_id))
+    used_bytes = [0] * bucket_num
+    for used, bucket_id in heap:
+        used_bytes[bucket_id] = used
+    return used_bytes
@@ -0,0 +1,248 @@
+"""Columnar binary batch format shared by routers and workers.
+
+A batch carries one action code and three columns: request ids packed as
+native uint64, object ids and hashes packed as strings. The whole body is
+
+    magic(4) | action(1) | count(4) | len(4) ids | len(4) object_ids | len(4) hashes
+
+String columns start with a uint32 item width. Fixed-width columns (the
+32-char object ids and 128-char hashes of the trace) are plain
+concatenations, width 0 means newline separated items.
+
+A ``MIXED`` batch interleaves reads and writes in trace order. It carries
+a fourth column with one action byte per message, and ``hashes`` only
+holds the hashes of the writes, in order.
+"""
+
+import struct
+
+from array import array
+
+import numpy as np
+
+
+MAGIC = b"HKB1"
+CONTENT_TYPE = "application/x-hackson-batch"
+RESULT_CONTENT_TYPE = "application/x-hackson-result"
+ACK_CONTENT_TYPE = "application/x-hackson-ack"
+JSON_CONTENT_TYPE = "application/json"
+MIXED = "M"
+
+_HEADER = struct.Struct("<4scI")
+_LENGTH = struct.Struct("<I")
+_ACK = struct.Struct("<II")
+
+
+class BatchError(ValueError):
+    pass
+
+
+def pack_ids(request_ids):
+    return array("Q", request_ids).tobytes()
+
+
+def unpack_ids(buf):
+    return memoryview(buf).cast("B").cast("Q")
+
+
+def pack_fixed(data, width):
+    """Column of ``width`` byte strings already concatenated in ``data``."""
+    return _LENGTH.pack(width) + data
+
+
+def pack_strings(items):
+    width = len(items[0]) if items else 0
+    for item in items:
+        if len(item) != width:
+            return _LENGTH.pack(0) + b"\n".join(items)
+    return _LENGTH.pack(width) + b"".join(items)
+
+
+def unpack_strings(buf, start=0, end=None):
+    """Split the string column stored in ``buf[start:end]``.
+
+    ``buf`` may be bytes or any buffer (e.g. a zmq frame memoryview), in
+    which case every item is copied out exactly once.
+    """
+    if end is None:
+        end = len(buf)
+    width, = _LENGTH.unpack_from(buf, start)
+    start += _LENGTH.size
+    if start == end:
+        return []
+    if not width:
+        return bytes(buf[start:end]).split(b"\n")
+    if isinstance(buf, bytes):
+        return [buf[i:i + width] for i in range(start, end, width)]
+    view = memoryview(buf)
+    return [view[i:i + width].tobytes() for i in range(start, end, width)]
+
+
+def unpack_rows(buf, start=0, end=None):
+    """A fixed width string column as an ``(n, width)`` uint8 matrix over
+    ``buf``, without a copy, for stores taking rows. Other columns come
+    back as ``unpack_strings`` lists."""
+    if end is None:
+        end = len(buf)
+    width, = _LENGTH.unpack_from(buf, start)
+    if not width:
+        return unpack_strings(buf, start, end)
+    count = (end - start - _LENGTH.size) // width
+    return np.frombuffer(buf, np.uint8, count * width, start + _LENGTH.size).reshape(-1, width)
+
+
+def encode_header(action, count):
+    return _HEADER.pack(MAGIC, action.encode(), count)
+
+
+def encode_column(column):
+    """Length prefixed column, the parts following ``encode_header``."""
+    return [_LENGTH.pack(len(column)), column]
+
+
+def encode_columns(action, count, request_ids, object_ids, hashes, actions=None):
+    """Assemble a batch from columns packed by pack_ids/pack_strings,
+    ``actions`` is the per message action column of MIXED batches."""
+    columns = [request_ids, object_ids, hashes]
+    if action == MIXED:
+        columns.append(actions)
+    parts = [encode_header(action, count)]
+    for column in columns:
+        parts += encode_column(column)
+    return b"".join(parts)
+
+
+def encode_batch(action, request_ids, object_ids, hashes=(), actions=None):
+    return encode_columns(
+        action,
+        len(request_ids),
+        pack_ids(request_ids),
+        pack_strings(object_ids),
+        pack_strings(hashes),
+        actions,
+    )
+
+
+def peek_count(body):
+    """Rows of a columnar batch from its header alone."""
+    if len(body) < _HEADER.size or body[:4] != MAGIC:
+        raise BatchError("Not a columnar batch")
+    return _HEADER.unpack_from(body)[2]
+
+
+def split_batch(body):
+    """Return ``(action, count, bounds)`` of a batch, ``bounds`` holds the
+    ``(start, end)`` of its packed columns in ``body``."""
+    if len(body) < _HEADER.size or body[:4] != MAGIC:
+        raise BatchError("Not a columnar batch")
+    _, action, count = _HEADER.unpack_from(body)
+    offset = _HEADER.size
+    bounds = []
+    for _ in range(4 if action == MIXED.encode() else 3):
+        length, = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        bounds.append((offset, offset + length))
+        offset += length
+    if offset != len(body):
+        raise BatchError(f"Batch size mismatch: {offset} != {len(body)}")
+    return action.decode(), count, bounds
+
+
+def _decode_columns(body, count, bounds, rows):
+    unpack = unpack_rows if rows else unpack_strings
+    request_ids = unpack_ids(memoryview(body)[bounds[0][0]:bounds[0][1]])
+    object_ids = unpack(body, *bounds[1])
+    hashes = unpack(body, *bounds[2])
+    if len(request_ids) != count or len(object_ids) != count:
+        raise BatchError(f"Column length mismatch, expect {count} messages")
+    return request_ids, object_ids, hashes
+
+
+def decode_batch(body, rows=False):
+    """Return ``(action, request_ids, object_ids, hashes)`` of a batch. With
+    ``rows`` fixed width strings come as ``unpack_rows`` matrices."""
+    action, count, bounds = split_batch(body)
+    return (action,) + _decode_columns(body, count, bounds, rows)
+
+
+def decode_mixed(body, rows=False):
+    """Return ``(actions, request_ids, object_ids, hashes)`` of a MIXED
+    batch, like ``decode_frames``."""
+    action, count, bounds = split_batch(body)
+    if action != MIXED:
+        raise BatchError(f"Expect a mixed batch, got {action}")
+    actions = bytes(body[bounds[3][0]:bounds[3][1]])
+    if len(actions) != count:
+        raise BatchError(f"Column length mismatch, expect {count} messages")
+    return (actions,) + _decode_columns(body, count, bounds, rows)
+
+
+# Result of a batch asked for with ``Accept: ACK_CONTENT_TYPE``. The writes
+# are acknowledged by their count and the worker id, the router knows
+# their request ids and writes their result lines itself. Only the reads
+# come back as lines. The http and mq routers and workers speak it, the
+# pickled zmq REQ/REP pair (router_v0.py, worker_v0.py) has no ack mode.
+#
+#     writes(4) | len(4) worker id | worker id | read result lines
+
+
+def encode_ack(writes, worker_id, lines=b""):
+    return _ACK.pack(writes, len(worker_id)) + worker_id + lines
+
+
+def decode_ack(body):
+    """Return ``(writes, worker_id, lines)`` of an ack result."""
+    if len(body) < _ACK.size:
+        raise BatchError("Not an ack result")
+    writes, size = _ACK.unpack_from(body)
+    start = _ACK.size + size
+    return writes, bytes(body[_ACK.size:start]), memoryview(body)[start:]
+
+
+# Multipart layout used over zmq: every column is its own frame so workers
+# can read them straight out of the received frame buffers.
+#
+#     topic | actions | request_ids | object_ids | hashes
+#
+# ``actions`` holds one action byte per message and ``hashes`` only has
+# entries for the writes, in order. Replies are ``topic | kind | lines``,
+# or ``topic | ACK | ack result`` for a router which sent ``ACK`` along
+# with its handshake. A ``topic | CONTROL | STATS`` control message is
+# answered with ``topic | STATS | json``. The pickled REQ/REP pair takes
+# ``CONTROL | STATS`` in place of a batch and answers with the json alone.
+
+CONTROL = b"C"
+DATA = b"D"
+ACK = b"A"
+STATS = b"S"
+
+
+def topic(bucket_id):
+    # Trailing separator so that the SUB prefix filter for "1" skips "10"
+    return b"%d-" % int(bucket_id)
+
+
+def encode_control_frames(bucket_id, acks=False):
+    return [topic(bucket_id), CONTROL] + ([ACK] if acks else [])
+
+
+def encode_stats_frames(bucket_id):
+    """Control message asking a worker for ``[topic, STATS, json]``."""
+    return [topic(bucket_id), CONTROL, STATS]
+
+
+def decode_frames(buffers, rows=False):
+    """Return ``(actions, request_ids, object_ids, hashes)`` of a multipart
+    message given the frame buffers, ``actions`` is CONTROL for handshakes."""
+    if len(buffers) in (2, 3):
+        return bytes(buffers[1]), [], [], []
+    if len(buffers) != 5:
+        raise BatchError(f"Expect 5 frames, got {len(buffers)}")
+    actions = bytes(buffers[1])
+    request_ids = unpack_ids(buffers[2])
+    unpack = unpack_rows if rows else unpack_strings
+    object_ids = unpack(buffers[3])
+    hashes = unpack(buffers[4])
+    if len(request_ids) != len(actions) or len(object_ids) != len(actions):
+        raise BatchError(f"Column length mismatch, expect {len(actions)} messages")
+    return actions, request_ids, object_ids, hashes
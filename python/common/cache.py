@@ -0,0 +1,240 @@
+"""Router side cache of object hashes.
+
+The router keeps the hash it sees on a write and answers later reads of
+the object itself. Objects may be written again, a read gets the hash of
+the latest write before it. Entries are keyed by the 64-bit object id
+digest the directory uses, the budget counts the hash bytes plus 8 bytes
+of key per entry.
+
+Eviction policies share ``get_many``/``put`` and keep ``nbytes`` within
+the budget:
+
+- ``lru``: least recently used first
+- ``clock``: second chance over a ring of entries, no reordering on hits
+- ``size``: GreedyDual-Size-Frequency, evicts low ``hits / bytes`` first
+  and ages the survivors
+"""
+
+import heapq
+import itertools
+
+from collections import OrderedDict
+
+import numpy as np
+
+from . import routing
+
+
+KEY_BYTES = 8
+
+
+class LRUPolicy:
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, keys):
+        values = list(map(self._entries.get, keys))
+        touch = self._entries.move_to_end
+        for key, value in zip(keys, values):
+            if value is not None:
+                touch(key)
+        return values
+
+    def put(self, key, value):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= len(old) + KEY_BYTES
+        size = len(value) + KEY_BYTES
+        if size > self.budget:
+            return
+        while self.nbytes + size > self.budget:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= len(evicted) + KEY_BYTES
+        self._entries[key] = value
+        self.nbytes += size
+
+
+class ClockPolicy:
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self._slots = {}
+        self._keys = []
+        self._values = []
+        self._referenced = bytearray()
+        self._hand = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def get_many(self, keys):
+        values = []
+        for slot in map(self._slots.get, keys):
+            if slot is None:
+                values.append(None)
+            else:
+                self._referenced[slot] = 1
+                values.append(self._values[slot])
+        return values
+
+    def _evict(self):
+        """Free the next slot without a second chance and return it."""
+        while True:
+            if self._hand >= len(self._keys):
+                self._hand = 0
+            slot = self._hand
+            self._hand += 1
+            if self._keys[slot] is None:
+                continue
+            if self._referenced[slot]:
+                self._referenced[slot] = 0
+                continue
+            del self._slots[self._keys[slot]]
+            self.nbytes -= len(self._values[slot]) + KEY_BYTES
+            self._keys[slot] = self._values[slot] = None
+            return slot
+
+    def put(self, key, value):
+        size = len(value) + KEY_BYTES
+        slot = self._slots.get(key)
+        if slot is not None:
+            self.nbytes += len(value) - len(self._values[slot])
+            self._values[slot] = value
+        elif size > self.budget:
+            return
+        else:
+            slot = None
+            while self.nbytes + size > self.budget:
+                slot = self._evict()
+            if slot is None:
+                slot = len(self._keys)
+                self._keys.append(None)
+                self._values.append(None)
+                self._referenced.append(0)
+            self._slots[key] = slot
+            self._keys[slot] = key
+            self._values[slot] = value
+            self._referenced[slot] = 0
+            self.nbytes += size
+        while self.nbytes > self.budget:
+            self._evict()
+
+
+class SizeAwarePolicy:
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        # key: [priority, hits, value]
+        self._entries = {}
+        self._heap = []
+        self._clock = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _priority(self, hits, value):
+        return self._clock + hits / (len(value) + KEY_BYTES)
+
+    def get_many(self, keys):
+        values = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                values.append(None)
+                continue
+            entry[1] += 1
+            # Stale heap items are skipped on eviction
+            entry[0] = self._priority(entry[1], entry[2])
+            heapq.heappush(self._heap, (entry[0], key))
+            values.append(entry[2])
+        return values
+
+    def _evict(self):
+        while True:
+            priority, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == priority:
+                break
+        del self._entries[key]
+        self.nbytes -= len(entry[2]) + KEY_BYTES
+        self._clock = priority
+
+    def put(self, key, value):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= len(old[2]) + KEY_BYTES
+        size = len(value) + KEY_BYTES
+        if size > self.budget:
+            return
+        while self.nbytes + size > self.budget:
+            self._evict()
+        entry = [self._priority(1, value), 1, value]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, (entry[0], key))
+        self.nbytes += size
+        if len(self._heap) > 4 * len(self._entries) + 1024:
+            self._heap = [(entry[0], key) for key, entry in self._entries.items()]
+            heapq.heapify(self._heap)
+
+
+POLICIES = {"lru": LRUPolicy, "clock": ClockPolicy, "size": SizeAwarePolicy}
+
+
+class ReadCache:
+
+    def __init__(self, budget, policy="lru"):
+        self.policy_name = policy
+        self.policy = POLICIES[policy](budget)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def apply(self, trace_batch):
+        """Answer the cached reads of a batch and cache its writes. A read
+        behind a write of the same object in the batch gets the hash of the
+        latest such write, the others what the cache held before the batch.
+        Returns the rows still to send, in trace order, and the result
+        lines of the answered reads."""
+        digests = trace_batch.object_ids.digest()
+        writes = trace_batch.writes()
+        reads = trace_batch.reads()
+        latest = routing.latest_writes(digests, writes, reads)
+        behind = latest >= 0
+        values = np.empty(len(reads), object)
+        values[~behind] = self.policy.get_many(digests[reads[~behind]].tolist())
+        values[behind] = trace_batch.hashes.take(latest[behind]).tolist()
+        values = values.tolist()
+        # In trace order, a rewrite replaces the hash of the earlier write
+        put = self.policy.put
+        for key, value in zip(digests[writes].tolist(), trace_batch.hashes.take(writes).tolist()):
+            put(key, value)
+        hit = np.fromiter((value is not None for value in values), bool, len(values))
+        keep = np.ones(len(trace_batch), bool)
+        keep[reads[hit]] = False
+        lines = [
+            b"%d,%s" % (request_id, value)
+            for request_id, value in zip(
+                trace_batch.request_ids[reads[hit]].tolist(), itertools.compress(values, hit)
+            )
+        ]
+        self.hits += len(lines)
+        self.misses += len(reads) - len(lines)
+        self.bytes_saved += sum(map(len, itertools.compress(values, hit)))
+        return np.flatnonzero(keep), lines
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return (
+            f"{self.policy_name}, {len(self.policy)} entries, {self.policy.nbytes} bytes: "
+            f"hit rate {rate:.1%} ({self.hits} hits, {self.misses} misses), "
+            f"{self.bytes_saved} hash bytes saved"
+        )
@@ -0,0 +1,175 @@
+"""Router checkpoints, resume a run from a byte offset of the trace.
+
+A checkpoint directory holds numbered checkpoints, each of them
+
+    checkpoint-<n>.keys.npy, checkpoint-<n>.values.npy   directory table
+    checkpoint-<n>.json                                  everything else
+
+The json holds the trace byte offset, the lines and the next request id
+behind it, the used bytes of every bucket, the acknowledged batches of
+every bucket and the output bytes written. It is written last and
+replaced atomically, the highest numbered json is the checkpoint.
+
+A checkpoint is consistent: the router takes it at a trace block
+boundary once every line before it has its result written, so it covers
+exactly the lines before the offset. The router only copies the table
+arrays, a writer thread saves them and waits for the result lines before
+the offset to reach the output before it commits the json. The arrays
+are saved as they are, empty slots included, ``load`` maps them copy on
+write and the directory resumes without rehashing. Files are not
+fsynced, a checkpoint survives the router dying, not the host.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import directory
+
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = 30.0
+
+_CHECKPOINT = re.compile(r"checkpoint-(\d+)\.json$")
+
+
+def _files(path):
+    """``(number, path)`` of the committed checkpoints, oldest first."""
+    found = []
+    for name in os.listdir(path):
+        match = _CHECKPOINT.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(path, name)))
+    return sorted(found)
+
+
+def _prefix(path, number):
+    return os.path.join(path, f"checkpoint-{number:08d}")
+
+
+def load(path):
+    """State of the latest checkpoint in ``path`` and its directory, None
+    without one. The directory tables are mapped copy on write."""
+    found = _files(path) if os.path.isdir(path) else []
+    if not found:
+        return None, None
+    number, name = found[-1]
+    with open(name, "rb") as f:
+        state = json.load(f)
+    meta_info = None
+    if state["directory"] is not None:
+        prefix = _prefix(path, number)
+        keys = np.load(f"{prefix}.keys.npy", mmap_mode="c")
+        values = np.load(f"{prefix}.values.npy", mmap_mode="c")
+        meta_info = directory.Directory.restore(keys, values, state["directory"])
+    return state, meta_info
+
+
+def restore_used(buckets, used_bytes):
+    """Set the used bytes of ``buckets``, a placement or a hash routing,
+    from ``used_bytes`` as saved by a checkpoint. The greedy comparison of
+    a hash routing starts over."""
+    buckets.used[:] = [used_bytes[str(bucket_id)] for bucket_id in buckets.bucket_ids.tolist()]
+
+
+class Checkpoints:
+    """Periodic checkpoints of a router into ``path``.
+
+    The router reports every trace block with ``advance`` before routing
+    it. ``due`` asks for a checkpoint at the block about to be routed,
+    the router then dispatches what it routed so far, waits for it and
+    calls ``save``."""
+
+    def __init__(self, path, meta_info, buckets, interval=INTERVAL, state=None, **extra):
+        self.path = path
+        self.meta_info = meta_info
+        self.buckets = buckets
+        self.interval = interval
+        self.extra = extra
+        self.requested = False
+        self.saved = 0
+        # Seconds the parser waited for the batches before checkpoints
+        self.paused = 0.0
+        self._number = state["number"] if state else 0
+        self._position = None
+        self._paused_since = None
+        self._last = time.monotonic()
+        self._pending = None
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="checkpoint")
+        os.makedirs(path, exist_ok=True)
+
+    def advance(self, offset, request_id, lines):
+        """The next trace block starts at byte ``offset`` with
+        ``request_id``, ``lines`` lines come before it."""
+        self._position = (offset, request_id, lines)
+
+    def due(self):
+        if self.requested or self._position is None:
+            return False
+        if self._pending is not None and not self._pending.done():
+            return False
+        if time.monotonic() - self._last < self.interval:
+            return False
+        self.requested = True
+        self._paused_since = time.perf_counter()
+        return True
+
+    def save(self, result_sink, acked):
+        """Checkpoint at the block ``due`` asked for, every line before it
+        has its result written to ``result_sink``. ``acked`` maps a bucket
+        id to its answered batches and the last request id of them."""
+        meta_info = self.meta_info
+        self.requested = False
+        if self._pending is not None:
+            # Surfaces an error of the last write
+            self._pending.result()
+        offset, request_id, lines = self._position
+        self._number += 1
+        state = dict(
+            self.extra,
+            number=self._number,
+            offset=offset,
+            request_id=request_id,
+            lines=lines,
+            used_bytes={str(bucket_id): used for bucket_id, used in self.buckets.used_bytes().items()},
+            acked={str(bucket_id): list(entry) for bucket_id, entry in acked.items()},
+            output=dict(result_sink.written),
+            directory=None if meta_info is None else len(meta_info),
+        )
+        tables = None if meta_info is None else meta_info.snapshot()
+        flushed = result_sink.barrier()
+        self._pending = self._writer.submit(self._write, state, tables, flushed)
+        self._last = time.monotonic()
+        self.saved += 1
+        paused = time.perf_counter() - self._paused_since
+        self.paused += paused
+        return state, paused
+
+    def _write(self, state, tables, flushed):
+        prefix = _prefix(self.path, state["number"])
+        if tables is not None:
+            keys, values = tables
+            np.save(f"{prefix}.keys.npy", keys)
+            np.save(f"{prefix}.values.npy", values)
+        flushed.wait()
+        with open(f"{prefix}.json.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{prefix}.json.tmp", f"{prefix}.json")
+        for number, _ in _files(self.path):
+            if number < state["number"]:
+                for suffix in (".json", ".keys.npy", ".values.npy"):
+                    if os.path.exists(_prefix(self.path, number) + suffix):
+                        os.remove(_prefix(self.path, number) + suffix)
+        logger.info(f"Checkpoint {state['number']} at byte {state['offset']}, line {state['lines']}")
+
+    def close(self):
+        if self._pending is not None:
+            self._pending.result()
+        self._writer.shutdown()
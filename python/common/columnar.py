@@ -0,0 +1,105 @@
+"""Columnar batch execution shared by the http and raw workers.
+
+A ``Bucket`` is the store and write-ahead log of one bucket id. ``execute``
+runs a columnar batch body (see ``batch``) against it by the batch action
+and returns the result body: result lines, or with ``acks`` the
+``batch.encode_ack`` body of the writes followed by the read lines. Writes
+are logged before they are applied and committed before the result goes
+out. The http worker calls the per action functions from its handlers,
+the raw worker ``execute`` for every frame or ring record.
+"""
+
+from . import batch
+from . import store as object_store
+from . import wal
+
+
+WRITE = ord("W")
+
+
+class Bucket:
+    """Store and write ahead log of one bucket id, ``records`` counts the
+    log records replayed on start."""
+
+    def __init__(self, bucket_id, args, wal_dir=None):
+        self.worker_id = str(bucket_id).encode()
+        self.store = object_store.STORES[args.store]()
+        self.log = None
+        self.records = 0
+        if wal_dir:
+            self.log = wal.Log(wal_dir, self.store, args.snapshot_bytes)
+            self.records = self.log.recover()
+
+
+def format_results(actions, request_ids, values, worker_id, acks=False):
+    """Result lines of a mixed batch, ``values`` are the read hashes. With
+    ``acks`` the writes get no line."""
+    values = iter(values)
+    suffix = b",%s" % worker_id
+    result = []
+    # Iterating bytes yields ints, compare against the action code points
+    for action, request_id in zip(actions, request_ids):
+        if action == WRITE:
+            if not acks:
+                result.append(b"%d%s" % (request_id, suffix))
+        else:
+            result.append(b"%d,%s" % (request_id, next(values)))
+    return result
+
+
+def write_columnar(bucket, body, acks=False):
+    log = bucket.log
+    if log is not None:
+        # Log the packed columns as they came in, the log thread writes and
+        # fsyncs them while the batch is decoded and applied
+        _, count, bounds = batch.split_batch(body)
+        if count:
+            view = memoryview(body)
+            log.append_columns(view[slice(*bounds[1])], view[slice(*bounds[2])])
+    _, request_ids, object_ids, hashes = batch.decode_batch(body, bucket.store.columnar)
+    bucket.store.put_many(object_ids, hashes)
+    if acks:
+        result = batch.encode_ack(len(request_ids), bucket.worker_id)
+    else:
+        suffix = b",%s" % bucket.worker_id
+        result = b"\n".join([b"%d%s" % (request_id, suffix) for request_id in request_ids])
+    if log is not None:
+        log.commit()
+    return result
+
+
+def read_columnar(bucket, body):
+    _, request_ids, object_ids, _ = batch.decode_batch(body, bucket.store.columnar)
+    return b"\n".join([
+        b"%d,%s" % (request_id, value)
+        for request_id, value in zip(request_ids, bucket.store.get_many(object_ids))
+    ])
+
+
+def execute_columnar(bucket, body, acks=False):
+    actions, request_ids, object_ids, hashes = batch.decode_mixed(body, bucket.store.columnar)
+    log = bucket.log
+    if log is not None and WRITE in actions:
+        _, _, bounds = batch.split_batch(body)
+        view = memoryview(body)
+        log.append_columns(view[slice(*bounds[1])], view[slice(*bounds[2])], actions)
+    values = bucket.store.execute(actions, object_ids, hashes)
+    result = b"\n".join(format_results(actions, request_ids, values, bucket.worker_id, acks))
+    if acks:
+        result = batch.encode_ack(actions.count(WRITE), bucket.worker_id, result)
+    if log is not None:
+        log.commit()
+    return result
+
+
+def execute(bucket, body, acks=False):
+    """``(acked, result)`` of a batch of any action, ``acked`` tells if the
+    result is an ack body. Read batches never are."""
+    action, _, _ = batch.split_batch(body)
+    if action == "W":
+        return acks, write_columnar(bucket, body, acks)
+    if action == "R":
+        return False, read_columnar(bucket, body)
+    if action == batch.MIXED:
+        return acks, execute_columnar(bucket, body, acks)
+    raise batch.BatchError(f"Unknown action {action}")
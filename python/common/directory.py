@@ -0,0 +1,137 @@
+"""Compact object id -> bucket id directory.
+
+An open addressing table (linear probing) in two numpy arrays: the 64 bit
+digest of the object id (``trace.digest``) and the bucket id as uint16,
+10 bytes per slot instead of a dict entry plus a 32 char str key. Two
+object ids sharing a digest would share an entry, at 10^8 objects the
+odds of any such pair are below 1 in 3000. ``store.ObjectStore`` indexes
+its arenas with one holding uint32 entry numbers.
+"""
+
+import numpy as np
+
+from . import trace
+
+
+EMPTY = np.uint64(0)
+MAX_LOAD = 0.7
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _keys(digests):
+    digests = np.asarray(digests, np.uint64)
+    # 0 marks an empty slot
+    return np.where(digests == EMPTY, np.uint64(1), digests)
+
+
+class Directory:
+
+    def __init__(self, capacity=1 << 16, dtype=np.uint16):
+        bits = max(int(capacity - 1).bit_length(), 4)
+        self._bits = bits
+        self._keys = np.zeros(1 << bits, np.uint64)
+        self._values = np.zeros(1 << bits, dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return len(self._keys)
+
+    @property
+    def nbytes(self):
+        return self._keys.nbytes + self._values.nbytes
+
+    def bytes_per_entry(self):
+        return self.nbytes / self._size if self._size else 0.0
+
+    def snapshot(self):
+        """Copies of the table arrays, ``restore`` takes them as they are."""
+        return self._keys.copy(), self._values.copy()
+
+    @classmethod
+    def restore(cls, keys, values, size):
+        """Directory over the table arrays of ``snapshot`` holding ``size``
+        objects, e.g. memory maps."""
+        restored = cls(dtype=values.dtype)
+        restored._bits = len(keys).bit_length() - 1
+        restored._keys, restored._values, restored._size = keys, values, size
+        return restored
+
+    def _slots(self, keys):
+        return (keys * _GOLDEN) >> np.uint64(64 - self._bits)
+
+    def _probe(self, keys):
+        """Slot of every key, or of the empty slot where it would go."""
+        mask = np.uint64(self.capacity - 1)
+        slots = self._slots(keys)
+        pending = np.arange(len(keys))
+        while len(pending):
+            found = self._keys[slots[pending]]
+            done = (found == keys[pending]) | (found == EMPTY)
+            pending = pending[~done]
+            slots[pending] = (slots[pending] + np.uint64(1)) & mask
+        return slots
+
+    def find(self, digests):
+        """``(values, found)`` of a batch of digests, values of the digests
+        not found are undefined."""
+        keys = _keys(digests)
+        slots = self._probe(keys)
+        return self._values[slots], self._keys[slots] == keys
+
+    def lookup(self, digests):
+        """Bucket ids of a batch of digests as an uint16 array."""
+        values, found = self.find(digests)
+        if not found.all():
+            missing = np.asarray(digests, np.uint64)[~found]
+            raise KeyError(f"{len(missing)} unknown objects, first digest {int(missing[0])}")
+        return values
+
+    def put_many(self, digests, bucket_ids):
+        """Insert or update a batch, the last of repeated digests wins."""
+        keys = _keys(digests)
+        bucket_ids = np.asarray(bucket_ids, self._values.dtype)
+        if (self._size + len(keys)) > self.capacity * MAX_LOAD:
+            self._grow(self._size + len(keys))
+        pending = np.arange(len(keys))
+        while len(pending):
+            slots = self._probe(keys[pending])
+            found = self._keys[slots]
+            update = found == keys[pending]
+            self._values[slots[update]] = bucket_ids[pending[update]]
+            pending, slots = pending[~update], slots[~update]
+            # Several new keys may probe to the same empty slot, the first one
+            # claims it and the others probe again next round
+            slots, first = np.unique(slots, return_index=True)
+            claimed = pending[first]
+            self._keys[slots] = keys[claimed]
+            self._values[slots] = bucket_ids[claimed]
+            self._size += len(claimed)
+            pending = np.setdiff1d(pending, claimed, assume_unique=True)
+
+    def _grow(self, size):
+        used = self._keys != EMPTY
+        keys, values = self._keys[used], self._values[used]
+        capacity = self.capacity
+        while size > capacity * MAX_LOAD:
+            capacity <<= 1
+        self.__init__(capacity, values.dtype)
+        self.put_many(keys, values)
+
+    def get(self, object_id, default=None):
+        try:
+            return int(self.lookup([trace.digest(object_id)])[0])
+        except KeyError:
+            return default
+
+    def __getitem__(self, object_id):
+        return int(self.lookup([trace.digest(object_id)])[0])
+
+    def __setitem__(self, object_id, bucket_id):
+        self.put_many([trace.digest(object_id)], [bucket_id])
+
+    def __contains__(self, object_id):
+        return self.get(object_id) is not None
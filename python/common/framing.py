@@ -0,0 +1,237 @@
+"""Length prefixed frames over TCP or Unix domain sockets.
+
+Every frame is
+
+    length(4) | frame id(4) | payload
+
+A request carries an accept byte, ``RESULT`` or ``ACK``, and a columnar
+batch body (see ``batch``). Its reply has the same frame id and a status
+byte: ``OK`` before the result lines, ``ACK`` before a ``batch.encode_ack``
+body, ``ERROR`` before a message. A connection pipelines any number of
+requests, replies are matched by their frame id.
+
+A request is streamed as it is encoded: every part goes out in a frame
+with the ``MORE`` bit set in its length, an empty frame without it ends
+the request. The parser joins the parts of each frame id.
+
+``RawSession`` speaks this to the raw workers with the part of the
+``aiohttp.ClientSession`` interface the http router uses, so the router
+keeps its batch and dispatch logic on either transport.
+"""
+
+import asyncio
+import contextlib
+import os
+import struct
+
+from urllib.parse import urlsplit
+
+from . import batch
+
+
+OK = b"D"
+ERROR = b"E"
+ACK = b"A"
+RESULT = b"R"
+
+_HEADER = struct.Struct("<II")
+_MORE = 1 << 31
+
+
+def encode_frame(frame_id, parts, more=False):
+    """Header and ``parts`` of a frame, for ``writelines``."""
+    length = sum(len(part) for part in parts)
+    return [_HEADER.pack(length | _MORE if more else length, frame_id)] + list(parts)
+
+
+def socket_path(socket_dir, port):
+    return os.path.join(socket_dir, f"worker-{port}.sock")
+
+
+class FrameParser:
+    """Splits a byte stream into frames. Chunks are kept until a frame is
+    complete and joined once, a large frame is not copied per chunk."""
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+        self._need = _HEADER.size
+        self._partial = {}
+
+    def feed(self, data):
+        """Return ``[(frame_id, payload), ...]`` completed by ``data``."""
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size < self._need:
+            return []
+        buf = b"".join(self._chunks) if len(self._chunks) > 1 else bytes(self._chunks[0])
+        frames = []
+        offset = 0
+        self._need = _HEADER.size
+        while len(buf) - offset >= _HEADER.size:
+            length, frame_id = _HEADER.unpack_from(buf, offset)
+            more = length & _MORE
+            end = offset + _HEADER.size + (length & ~_MORE)
+            if end > len(buf):
+                self._need = end - offset
+                break
+            if offset == 0 and end == len(buf):
+                payload = buf[_HEADER.size:]
+            else:
+                payload = buf[offset + _HEADER.size:end]
+            offset = end
+            if more:
+                self._partial.setdefault(frame_id, []).append(payload)
+            elif frame_id in self._partial:
+                self._partial[frame_id].append(payload)
+                frames.append((frame_id, b"".join(self._partial.pop(frame_id))))
+            else:
+                frames.append((frame_id, payload))
+        self._chunks = [buf[offset:]] if offset < len(buf) else []
+        self._size = len(buf) - offset
+        return frames
+
+
+class FlowControl:
+    """Pause writers while the transport buffer is above its high mark."""
+
+    def __init__(self):
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    async def drain(self):
+        await self._writable.wait()
+
+
+class _Connection(FlowControl, asyncio.Protocol):
+
+    def __init__(self):
+        super().__init__()
+        self.transport = None
+        self._parser = FrameParser()
+        self._waiting = {}
+        self._next_id = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        for frame_id, payload in self._parser.feed(data):
+            waiting = self._waiting.pop(frame_id, None)
+            if waiting is not None and not waiting.done():
+                waiting.set_result(payload)
+
+    def connection_lost(self, exc):
+        for waiting in self._waiting.values():
+            if not waiting.done():
+                waiting.set_exception(ConnectionError(f"Worker connection lost: {exc}"))
+        self._waiting = {}
+        self.resume_writing()
+
+    async def _send(self, frame_id, parts, more=False):
+        await self.drain()
+        if self.transport.is_closing():
+            raise ConnectionError("Worker connection closed")
+        self.transport.writelines(encode_frame(frame_id, parts, more))
+
+    async def request(self, parts):
+        """Reply payload of a request, ``parts`` is a list or an async
+        iterable streamed as ``MORE`` frames."""
+        frame_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        waiting = asyncio.get_running_loop().create_future()
+        self._waiting[frame_id] = waiting
+        try:
+            if hasattr(parts, "__aiter__"):
+                async for part in parts:
+                    await self._send(frame_id, [part], more=True)
+                parts = []
+            await self._send(frame_id, parts)
+        except BaseException:
+            self._waiting.pop(frame_id, None)
+            raise
+        return await waiting
+
+
+async def _prepend(part, parts):
+    yield part
+    async for rest in parts:
+        yield rest
+
+
+class RawResponse:
+
+    def __init__(self, payload):
+        status = payload[:1]
+        self.status = 200 if status in (OK, ACK) else 500
+        if status == ACK:
+            self.content_type = batch.ACK_CONTENT_TYPE
+        else:
+            self.content_type = batch.RESULT_CONTENT_TYPE if self.status == 200 else "text/plain"
+        self.content = self
+        self._body = payload[1:]
+
+    async def read(self):
+        return self._body
+
+    async def iter_chunked(self, size):
+        # The whole frame is in already
+        yield self._body
+
+
+class RawSession:
+    """One pipelined connection per worker, ``tcp`` to the host and port of
+    the url or ``unix`` to the socket of its port in ``socket_dir``."""
+
+    def __init__(self, transport="tcp", socket_dir="/tmp"):
+        self.transport = transport
+        self.socket_dir = socket_dir
+        self._connections = {}
+        self._connecting = {}
+
+    async def _connect(self, url):
+        address = urlsplit(url)
+        key = (address.hostname, address.port)
+        connection = self._connections.get(key)
+        if connection is not None and not connection.transport.is_closing():
+            return connection
+        lock = self._connecting.setdefault(key, asyncio.Lock())
+        async with lock:
+            connection = self._connections.get(key)
+            if connection is None or connection.transport.is_closing():
+                connection = await self._open(address)
+                self._connections[key] = connection
+        return connection
+
+    async def _open(self, address):
+        loop = asyncio.get_running_loop()
+        if self.transport == "unix":
+            _, connection = await loop.create_unix_connection(
+                _Connection, socket_path(self.socket_dir, address.port)
+            )
+        else:
+            _, connection = await loop.create_connection(_Connection, address.hostname, address.port)
+        return connection
+
+    @contextlib.asynccontextmanager
+    async def post(self, url, data, headers=None):
+        accept = RESULT
+        if headers and headers.get("Accept") == batch.ACK_CONTENT_TYPE:
+            accept = ACK
+        if hasattr(data, "__aiter__"):
+            parts = _prepend(accept, data)
+        else:
+            parts = [accept, data]
+        connection = await self._connect(url)
+        yield RawResponse(await connection.request(parts))
+
+    async def close(self):
+        for connection in self._connections.values():
+            connection.transport.close()
+        self._connections = {}
@@ -0,0 +1,124 @@
+"""Stateless routing of object ids to buckets.
+
+Both routings map the 64-bit object id digest to a bucket without a
+directory, so reads find their object wherever it was written and any
+number of routers agree without sharing state:
+
+- ``hash``: consistent hashing over a ring with ``vnodes`` virtual nodes
+  per bucket, a bucket of weight ``w`` gets ``w`` times as many
+- ``rendezvous``: weighted highest random weight, every object goes to
+  the bucket with the highest ``-w / log(u)`` for its hash ``u``
+
+Weights are fixed for a run, objects are written once and reads would
+miss every object a changed weight moves. ``reweight`` turns the bytes a
+run placed on every bucket into weights for the next deployment.
+"""
+
+import numpy as np
+
+from . import balance
+from . import placement
+
+
+VNODES = 1024
+_CHUNK = 1 << 14
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def mix(values):
+    """splitmix64 finalizer, FNV-1a digests differ little in their high
+    bits."""
+    values = np.asarray(values, np.uint64)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def parse_weights(text):
+    return [float(weight) for weight in text.split(",")]
+
+
+def reweight(weights, used_bytes):
+    """Weights which would have evened out ``used_bytes``, mean 1."""
+    weights = np.asarray(weights, np.float64) * np.mean(used_bytes) / np.maximum(used_bytes, 1)
+    return weights / weights.mean()
+
+
+class Routing:
+    """Tracks the bytes routed to every bucket and, with ``compare``, where
+    the greedy placement would have put the same writes for the run
+    summary."""
+
+    def __init__(self, bucket_ids, weights=None, compare=False):
+        self.bucket_ids = np.asarray(list(bucket_ids), np.int64)
+        if weights is None:
+            weights = np.ones(len(self.bucket_ids))
+        self.weights = np.asarray(weights, np.float64)
+        if len(self.weights) != len(self.bucket_ids) or (self.weights <= 0).any():
+            raise ValueError(f"Need {len(self.bucket_ids)} positive weights, got {list(self.weights)}")
+        self.used = np.zeros(len(self.bucket_ids), np.int64)
+        self.greedy = placement.GreedyPlacement(self.bucket_ids) if compare else None
+
+    def __len__(self):
+        return len(self.bucket_ids)
+
+    def record(self, bucket_ids, sizes):
+        slots = np.searchsorted(self.bucket_ids, bucket_ids)
+        self.used += np.bincount(slots, sizes, len(self)).astype(np.int64)
+        if self.greedy is not None:
+            self.greedy.place(sizes)
+
+    def used_bytes(self):
+        return dict(zip(self.bucket_ids.tolist(), self.used.tolist()))
+
+    def summary(self):
+        weights = ",".join(f"{weight:.4f}" for weight in reweight(self.weights, self.used))
+        summary = f"{balance.format_summary(balance.summarize(self.used.tolist()))}; "
+        if self.greedy is not None:
+            summary += f"greedy placement {balance.format_summary(balance.summarize(self.greedy.used.tolist()))}; "
+        return summary + f"--hash-weights {weights} would even out these bytes"
+
+
+class HashRing(Routing):
+
+    def __init__(self, bucket_ids, weights=None, vnodes=VNODES, compare=False):
+        super().__init__(bucket_ids, weights, compare)
+        counts = np.maximum(np.rint(vnodes * self.weights / self.weights.mean()), 1).astype(np.int64)
+        owners = np.repeat(np.arange(len(self)), counts)
+        replicas = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts)
+        points = mix((self.bucket_ids[owners].astype(np.uint64) << np.uint64(32)) | replicas.astype(np.uint64))
+        order = np.argsort(points)
+        self._points = points[order]
+        self._owners = self.bucket_ids[owners[order]]
+
+    def lookup(self, digests):
+        positions = np.searchsorted(self._points, mix(digests), side="right")
+        return self._owners[positions % len(self._points)]
+
+
+class Rendezvous(Routing):
+
+    def __init__(self, bucket_ids, weights=None, compare=False):
+        super().__init__(bucket_ids, weights, compare)
+        self._seeds = mix(self.bucket_ids.astype(np.uint64) + _GOLDEN)
+
+    def lookup(self, digests):
+        digests = mix(digests)
+        weights = self.weights.astype(np.float32)
+        slots = np.empty(len(digests), np.int64)
+        for start in range(0, len(digests), _CHUNK):
+            # Digests and seeds are mixed already, one multiply per pair
+            hashes = (digests[start:start + _CHUNK, None] ^ self._seeds[None, :]) * _GOLDEN
+            # Uniform in (0, 1) from the top 23 bits, exact in float32
+            uniform = ((hashes >> np.uint64(41)).astype(np.float32) + np.float32(0.5)) * np.float32(2.0 ** -23)
+            slots[start:start + _CHUNK] = np.argmax(weights / -np.log(uniform), axis=1)
+        return self.bucket_ids[slots]
+
+
+ROUTINGS = {"hash": HashRing, "rendezvous": Rendezvous}
+
+
+def create(routing, bucket_ids, weights=None, vnodes=VNODES, compare=False):
+    if routing == "hash":
+        return HashRing(bucket_ids, weights, vnodes, compare)
+    return ROUTINGS[routing](bucket_ids, weights, compare)
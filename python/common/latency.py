@@ -0,0 +1,231 @@
+"""Batch latencies for the router reports, from sending a batch to a
+worker until its reply is in, and histograms of the router stages.
+
+``Histogram`` is HDR style: microseconds in ``SUB_BUCKETS`` linear slots
+per power of two, a fixed list of counters with about 3% relative error,
+so recording costs an ``int.bit_length`` and an increment. ``Stages``
+keeps one per stage name, ``NO_STAGES`` records nothing.
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import re
+import time
+
+import numpy as np
+
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+# Up to 2**40 microseconds, 12 days
+_SLOTS = (40 - SUB_BITS + 1) * SUB_BUCKETS
+
+
+class Latencies:
+
+    def __init__(self):
+        self._seconds = []
+
+    def __len__(self):
+        return len(self._seconds)
+
+    def start(self):
+        return time.perf_counter()
+
+    def record(self, start):
+        self._seconds.append(time.perf_counter() - start)
+
+    def summarize(self):
+        seconds = np.asarray(self._seconds or [0.0])
+        p50, p99 = np.percentile(seconds, [50, 99])
+        return {
+            "batches": len(self._seconds),
+            "p50_ms": p50 * 1e3,
+            "p99_ms": p99 * 1e3,
+            "max_ms": seconds.max() * 1e3,
+        }
+
+
+def format_summary(summary):
+    return (
+        f"batches={summary['batches']} p50={summary['p50_ms']:.2f}ms "
+        f"p99={summary['p99_ms']:.2f}ms max={summary['max_ms']:.2f}ms"
+    )
+
+
+def _slot(micros):
+    if micros < 2 * SUB_BUCKETS:
+        return micros
+    shift = micros.bit_length() - SUB_BITS - 1
+    return min((shift + 1) * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS, _SLOTS - 1)
+
+
+def _upper(slot):
+    """Largest microseconds counted in ``slot``."""
+    if slot < 2 * SUB_BUCKETS:
+        return slot
+    shift = slot // SUB_BUCKETS - 1
+    return ((slot % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+class Histogram:
+    """Seconds, or other values with ``scale`` 1 slot unit per value."""
+
+    def __init__(self, scale=1e6):
+        self.scale = scale
+        self.counts = [0] * _SLOTS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[_slot(int(seconds * self.scale))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound of the ``q`` percentile."""
+        rank = q / 100 * self.count
+        seen = 0
+        for slot, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(_upper(slot) / self.scale, self.max)
+        return self.max
+
+    def summarize(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_ms": self.total / self.count * 1e3 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1e3,
+            "p90_ms": self.percentile(90) * 1e3,
+            "p99_ms": self.percentile(99) * 1e3,
+            "max_ms": self.max * 1e3,
+        }
+
+    def summarize_values(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Stages:
+    """Histograms of named stages, ``name/bucket`` ones per bucket."""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def start(self):
+        return time.perf_counter()
+
+    def record(self, name, start):
+        """Record the time since ``start``, returns now for the next stage."""
+        now = time.perf_counter()
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.record(now - start)
+        return now
+
+    def timed(self, name, iterable):
+        """Yield from ``iterable``, recording how long every item took."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, start)
+            yield item
+
+    def summarize(self):
+        return {name: histogram.summarize() for name, histogram in sorted(self.histograms.items())}
+
+    def format_lines(self):
+        """One line per stage, per bucket stages by their slowest bucket."""
+        summaries = self.summarize()
+        lines = []
+        for name, summary in summaries.items():
+            if "/" not in name:
+                lines.append(f"{name}: {format_stage(summary)}")
+        per_bucket = {}
+        for name, summary in summaries.items():
+            if "/" in name:
+                stage, bucket_id = name.split("/", 1)
+                if stage not in per_bucket or summary["p99_ms"] > per_bucket[stage][1]["p99_ms"]:
+                    per_bucket[stage] = (bucket_id, summary)
+        for stage, (bucket_id, summary) in sorted(per_bucket.items()):
+            lines.append(f"{stage} slowest bucket {bucket_id}: {format_stage(summary)}")
+        return lines
+
+    def dump(self, path, **extra):
+        with open(path, "w") as f:
+            json.dump(dict(extra, stages=self.summarize()), f, indent=2)
+
+
+class _NoStages(Stages):
+
+    def start(self):
+        return 0.0
+
+    def record(self, name, start):
+        return 0.0
+
+    def timed(self, name, iterable):
+        return iterable
+
+
+NO_STAGES = _NoStages()
+
+
+def format_stage(summary):
+    return (
+        f"count={summary['count']} total={summary['total_s']:.3f}s mean={summary['mean_ms']:.3f}ms "
+        f"p50={summary['p50_ms']:.3f}ms p99={summary['p99_ms']:.3f}ms max={summary['max_ms']:.3f}ms"
+    )
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """cProfile the block into ``path``, does nothing without a path."""
+    if not path:
+        yield None
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+
+
+def profile_stages(profile, functions):
+    """Cumulative seconds per stage, ``functions`` maps a stage to a regex
+    of the function names it runs in."""
+    stats = pstats.Stats(profile, stream=io.StringIO()).stats
+    seconds = {}
+    for stage, pattern in functions.items():
+        matcher = re.compile(pattern)
+        seconds[stage] = sum(
+            cumulative for (_, _, function), (_, _, _, cumulative, _) in stats.items() if matcher.fullmatch(function)
+        )
+    return seconds
+
+
+def top_functions(profile, limit=20):
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(limit)
+    return stream.getvalue()
@@ -0,0 +1,29 @@
+"""Command line options every router takes.
+
+The http, mq and v0 routers take the same options for the ``common``
+modules they share, ``add_router_arguments`` registers them on a
+router's parser.
+"""
+
+from . import cache
+from . import hashring
+from . import placement
+from . import sink
+
+
+def add_router_arguments(parser):
+    parser.add_argument("--placement", default="greedy", choices=list(placement.STRATEGIES))
+    parser.add_argument("--routing", default="directory", choices=["directory"] + list(hashring.ROUTINGS))
+    parser.add_argument("--vnodes", default=hashring.VNODES, type=int, help="Virtual nodes per bucket of --routing hash")
+    parser.add_argument("--hash-weights", default=None, type=hashring.parse_weights, help="Comma separated bucket weights")
+    parser.add_argument(
+        "--compare-balance", action="store_true",
+        help="Also place the writes greedily for the --routing (and http --shards) summaries",
+    )
+    parser.add_argument("--cache-bytes", default=0, type=int, help="Answer reads from a router cache of this size")
+    parser.add_argument("--cache-policy", default="lru", choices=sorted(cache.POLICIES))
+    parser.add_argument("--output-dir", default=None, help="One result file per bucket instead of stdout")
+    parser.add_argument("--sink-buffer", default=sink.BUFFER_BYTES, type=int, help="Result bytes buffered per write")
+    parser.add_argument("--ordered-output", action="store_true", help="Write results in request id order")
+    parser.add_argument("--reorder-window", default=sink.REORDER_WINDOW, type=int, help="Result lines held for reordering")
+    return parser
@@ -0,0 +1,123 @@
+"""Placement of writes on buckets.
+
+``push_to_bucket`` pops and pushes a heap once per write. A placement
+keeps the used bytes of its buckets in an array and places all writes of
+a trace batch at once, ``place`` returns their bucket ids:
+
+- ``heap``: the per write heap of the routers, the reference
+- ``greedy``: least used first, water-filled. The batch raises the least
+  used buckets to a common level and every bucket takes the run of writes
+  covering its share, so it ends within one write of the level like with
+  the heap
+- ``two-choice``: every write goes to the less used of two random
+  buckets, the used bytes are refreshed every ``chunk`` writes
+- ``size-class``: writes are binned by powers of two of their size. The
+  classes above the median one are dealt round robin over the buckets
+  from the least used one, largest class first, so buckets get a similar
+  number of large objects. The rest is water-filled to even out the bytes
+"""
+
+import heapq
+
+import numpy as np
+
+
+def _fill(used, sizes):
+    """Slots for ``sizes`` raising the least ``used`` slots to a level."""
+    order = np.argsort(used, kind="stable")
+    levels = used[order].astype(np.float64)
+    prefix = np.cumsum(levels)
+    # Bytes needed to raise the first k + 1 slots to the level of slot k
+    need = levels * np.arange(1, len(levels) + 1) - prefix
+    filled = int(np.searchsorted(need, sizes.sum(), side="right"))
+    level = (sizes.sum() + prefix[filled - 1]) / filled
+    bounds = np.cumsum(level - levels[:filled])
+    # A write belongs to the slot its middle falls into
+    middles = np.cumsum(sizes) - sizes / 2
+    slots = np.minimum(np.searchsorted(bounds, middles, side="right"), filled - 1)
+    return order[slots]
+
+
+class Placement:
+
+    def __init__(self, bucket_ids):
+        self.bucket_ids = np.asarray(list(bucket_ids), np.int64)
+        self.used = np.zeros(len(self.bucket_ids), np.int64)
+
+    def __len__(self):
+        return len(self.bucket_ids)
+
+    def place(self, sizes):
+        sizes = np.asarray(sizes, np.int64)
+        if not len(sizes):
+            return np.zeros(0, np.int64)
+        slots = self._assign(sizes)
+        self.used += np.bincount(slots, sizes, len(self)).astype(np.int64)
+        return self.bucket_ids[slots]
+
+    def used_bytes(self):
+        return dict(zip(self.bucket_ids.tolist(), self.used.tolist()))
+
+
+class HeapPlacement(Placement):
+
+    def _assign(self, sizes):
+        heap = list(zip(self.used.tolist(), range(len(self))))
+        heapq.heapify(heap)
+        slots = []
+        for size in sizes.tolist():
+            used, slot = heap[0]
+            heapq.heapreplace(heap, (used + size, slot))
+            slots.append(slot)
+        return np.array(slots, np.int64)
+
+
+class GreedyPlacement(Placement):
+
+    def _assign(self, sizes):
+        return _fill(self.used, sizes)
+
+
+class TwoChoicePlacement(Placement):
+
+    def __init__(self, bucket_ids, chunk=1024, seed=0):
+        super().__init__(bucket_ids)
+        self.chunk = chunk
+        self._random = np.random.default_rng(seed)
+
+    def _assign(self, sizes):
+        used = self.used.copy()
+        slots = np.empty(len(sizes), np.int64)
+        for start in range(0, len(sizes), self.chunk):
+            part = sizes[start:start + self.chunk]
+            first, second = self._random.integers(len(self), size=(2, len(part)))
+            picked = np.where(used[first] <= used[second], first, second)
+            used += np.bincount(picked, part, len(self)).astype(np.int64)
+            slots[start:start + len(part)] = picked
+        return slots
+
+
+class SizeClassPlacement(Placement):
+
+    def _assign(self, sizes):
+        used = self.used.copy()
+        slots = np.empty(len(sizes), np.int64)
+        classes = np.log2(sizes.clip(1)).astype(np.int64)
+        small = np.median(classes)
+        for size_class in np.unique(classes[classes > small])[::-1]:
+            rows = np.flatnonzero(classes == size_class)
+            order = np.argsort(used, kind="stable")
+            picked = order[np.arange(len(rows)) % len(self)]
+            used += np.bincount(picked, sizes[rows], len(self)).astype(np.int64)
+            slots[rows] = picked
+        rows = np.flatnonzero(classes <= small)
+        slots[rows] = _fill(used, sizes[rows])
+        return slots
+
+
+STRATEGIES = {
+    "heap": HeapPlacement,
+    "greedy": GreedyPlacement,
+    "two-choice": TwoChoicePlacement,
+    "size-class": SizeClassPlacement,
+}
@@ -0,0 +1,55 @@
+"""Routing of trace batches to buckets, shared by the routers.
+
+With a directory every write is placed and recorded under its object id,
+a read goes to the bucket of the latest write of its object before it in
+the trace. Without one (``--routing hash`` and friends) the object id
+alone picks the bucket.
+"""
+
+import numpy as np
+
+
+def latest_writes(digests, writes, rows):
+    """Latest of the ``writes`` rows with the digest of each of ``rows``
+    before it, -1 for rows without one. Only the writes are sorted."""
+    objects, groups = np.unique(digests[writes], return_inverse=True)
+    # Writes ordered by object and then row
+    keys = groups.astype(np.int64) * len(digests) + writes
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    found = np.searchsorted(objects, digests[rows])
+    known = found < len(objects)
+    known[known] = objects[found[known]] == digests[rows][known]
+    result = np.full(len(rows), -1, np.int64)
+    if not known.any():
+        return result
+    before = np.searchsorted(keys, found[known] * len(digests) + rows[known]) - 1
+    same = (before >= 0) & (keys[np.maximum(before, 0)] // len(digests) == found[known])
+    result[np.flatnonzero(known)[same]] = writes[order[before[same]]]
+    return result
+
+
+def route_batch(trace_batch, buckets, meta_info):
+    """Bucket id of every row of ``trace_batch``. Writes are placed on
+    ``buckets`` and recorded in ``meta_info``, each read resolves to the
+    state as of its position, an object written several times within the
+    batch included."""
+    digests = trace_batch.object_ids.digest()
+    writes = trace_batch.writes()
+    if meta_info is None:
+        # Stateless, the object id alone picks the bucket
+        bucket_ids = buckets.lookup(digests)
+        buckets.record(bucket_ids[writes], trace_batch.sizes[writes])
+        return bucket_ids
+    placed = buckets.place(trace_batch.sizes[writes])
+    bucket_ids = np.empty(len(digests), np.int64)
+    bucket_ids[writes] = placed
+    reads = trace_batch.reads()
+    if len(reads):
+        latest = latest_writes(digests, writes, reads)
+        earlier = latest < 0
+        # Objects written in earlier batches, before this one changes them
+        bucket_ids[reads[earlier]] = meta_info.lookup(digests[reads[earlier]])
+        bucket_ids[reads[~earlier]] = bucket_ids[latest[~earlier]]
+    meta_info.put_many(digests[writes], placed)
+    return bucket_ids
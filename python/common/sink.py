@@ -0,0 +1,345 @@
+"""Buffered result output for the routers.
+
+Routers hand over the raw reply bytes of a worker (result lines without
+the trailing newline). ``ResultSink`` only queues the buffers, a writer
+thread hands them to ``os.writev`` once ``buffer_bytes`` piled up, so the
+event loop never blocks on a large write and nothing is copied. ``write``
+never waits for the writer thread, routers ``await drain()`` between
+flushes to hold back while more than ``MAX_QUEUED`` buffers wait for it.
+Without a running event loop ``write`` blocks instead. A large write can
+be split, shards sharing stdout may interleave parts of lines, give them
+``output_dir`` instead.
+
+With ``output_dir`` every bucket gets its own ``bucket-<id>.out`` file,
+lines without a bucket (answered by the router itself) go to
+``router_file``. ``written`` counts the bytes of every file, ``-`` for
+``fd``. A sink created with ``resume``, such a count, cuts the files back
+to it and appends, stdout only when it is a regular file holding at least
+that many bytes (``>>``), see ``resumed``.
+
+``ReorderBuffer`` sits in front of a sink and writes the lines in request
+id order instead of completion order. Request ids are the sequential ids
+of the trace, so it keeps a ring of ``window`` slots from the lowest id
+not written yet. Routers check ``fits`` before they admit the rows of the
+next trace batch and hold back until enough of the window was written,
+which caps the buffer at ``window`` lines. Every slot keeps the bucket id
+its line came with, with ``output_dir`` each bucket file is in request id
+order.
+"""
+
+import asyncio
+import os
+import queue
+import stat
+import threading
+
+from collections import defaultdict
+
+import numpy as np
+
+
+BUFFER_BYTES = 4 << 20
+# Buffers handed to the writer thread and not written yet
+MAX_QUEUED = 4
+REORDER_WINDOW = 2000000
+# Linux IOV_MAX
+MAX_IOV = 1024
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def write_all(fd, buffers):
+    """writev ``buffers`` to ``fd``, resuming after partial writes."""
+    buffers = [memoryview(buffer) for buffer in buffers]
+    start = 0
+    while start < len(buffers):
+        written = os.writev(fd, buffers[start:start + MAX_IOV])
+        while start < len(buffers) and written >= len(buffers[start]):
+            written -= len(buffers[start])
+            start += 1
+        if written:
+            buffers[start] = buffers[start][written:]
+
+
+class ResultSink:
+
+    def __init__(self, fd=1, buffer_bytes=BUFFER_BYTES, output_dir=None, router_file="router.out", resume=None):
+        self.buffer_bytes = buffer_bytes
+        self.output_dir = output_dir
+        self.router_file = router_file
+        self.written = defaultdict(int, resume or {})
+        self.nbytes = sum(self.written.values())
+        self.resume = resume
+        self.resumed = False
+        self._fd = fd
+        self._fds = {}
+        self._pending = defaultdict(list)
+        self._sizes = defaultdict(int)
+        self._queue = queue.SimpleQueue()
+        self._queued = 0
+        self._written = threading.Condition()
+        self._loop = None
+        self._caught_up = asyncio.Event()
+        self._error = None
+        self._writer = threading.Thread(target=self._run, name="result-sink", daemon=True)
+        self._writer.start()
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        elif resume is not None:
+            keep = resume.get("-", 0)
+            info = os.fstat(fd)
+            if stat.S_ISREG(info.st_mode) and info.st_size >= keep:
+                os.ftruncate(fd, keep)
+                self.resumed = True
+
+    def _name(self, bucket_id):
+        if self.output_dir is None:
+            return "-"
+        return self.router_file if bucket_id is None else f"bucket-{bucket_id}.out"
+
+    def _target(self, bucket_id):
+        if self.output_dir is None:
+            return self._fd
+        if bucket_id not in self._fds:
+            name = self._name(bucket_id)
+            path = os.path.join(self.output_dir, name)
+            if self.resume is None:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            else:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                os.ftruncate(fd, self.resume.get(name, 0))
+            self._fds[bucket_id] = fd
+        return self._fds[bucket_id]
+
+    def _run(self):
+        while (item := self._queue.get()) is not None:
+            fd, buffers = item
+            if fd is None:
+                # A barrier, everything queued before it is written
+                buffers.set()
+                continue
+            try:
+                write_all(fd, buffers)
+            except OSError as e:
+                self._error = e
+            with self._written:
+                self._queued -= 1
+                self._written.notify_all()
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._caught_up.set)
+
+    async def drain(self):
+        """Wait until at most ``MAX_QUEUED`` buffers wait for the writer."""
+        self._loop = asyncio.get_running_loop()
+        while self._queued > MAX_QUEUED:
+            self._caught_up.clear()
+            if self._queued <= MAX_QUEUED:
+                break
+            await self._caught_up.wait()
+
+    def write(self, data, bucket_id=None):
+        """Queue the result lines in ``data``, a bytes-like object without
+        the trailing newline."""
+        if not data:
+            return
+        if self._error is not None:
+            raise self._error
+        fd = self._target(bucket_id)
+        self._pending[fd] += [data, b"\n"]
+        self._sizes[fd] += len(data) + 1
+        self.nbytes += len(data) + 1
+        self.written[self._name(bucket_id)] += len(data) + 1
+        if self._sizes[fd] >= self.buffer_bytes:
+            self._submit(fd)
+
+    def skip(self, request_ids):
+        pass
+
+    def _submit(self, fd):
+        buffers = self._pending.pop(fd, None)
+        self._sizes.pop(fd, None)
+        if not buffers:
+            return
+        with self._written:
+            self._queued += 1
+        self._queue.put((fd, buffers))
+        if self._queued > MAX_QUEUED and not _in_event_loop():
+            with self._written:
+                self._written.wait_for(lambda: self._queued <= MAX_QUEUED)
+
+    def flush(self):
+        for fd in list(self._pending):
+            self._submit(fd)
+
+    def barrier(self):
+        """Flush, returns an event set once everything written so far
+        reached the files."""
+        self.flush()
+        event = threading.Event()
+        self._queue.put((None, event))
+        return event
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+        if self._error is not None:
+            raise self._error
+
+
+def split_lines(data):
+    """Result lines of ``data`` and the request id each starts with."""
+    data = bytes(data)
+    lines = data.split(b"\n")
+    buf = np.frombuffer(data, np.uint8)
+    starts = np.zeros(len(lines), np.int64)
+    starts[1:] = np.flatnonzero(buf == ord("\n")) + 1
+    commas = np.flatnonzero(buf == ord(","))
+    digits = commas[np.searchsorted(commas, starts)] - starts
+    request_ids = np.zeros(len(lines), np.int64)
+    for k in range(int(digits.max())):
+        rows = np.flatnonzero(digits > k)
+        request_ids[rows] = request_ids[rows] * 10 + buf[starts[rows] + k] - ord("0")
+    return request_ids, lines
+
+
+def ack_lines(request_ids, worker_id):
+    """Result lines ``<request id>,<worker id>`` of acknowledged writes,
+    the digits of all ids are laid out at once."""
+    request_ids = np.asarray(request_ids, np.int64)
+    if not len(request_ids):
+        return b""
+    powers = 10 ** np.arange(1, 19, dtype=np.int64)
+    lengths = np.searchsorted(powers, request_ids, side="right") + 1
+    width = int(lengths.max())
+    suffix = np.frombuffer(b",%s\n" % worker_id, np.uint8)
+    rows = np.empty((len(request_ids), width + len(suffix)), np.uint8)
+    scales = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    rows[:, :width] = request_ids[:, None] // scales % 10 + ord("0")
+    rows[:, width:] = suffix
+    # Drop the leading zeros of the shorter ids
+    keep = np.ones(rows.shape, bool)
+    keep[:, :width] = np.arange(width)[None, :] >= (width - lengths)[:, None]
+    return rows[keep].tobytes()[:-1]
+
+
+class ReorderBuffer:
+
+    def __init__(self, result_sink, window=REORDER_WINDOW, start=0):
+        self.sink = result_sink
+        self.window = window
+        self.base = start
+        self.blocked = None
+        self._lines = np.empty(window, object)
+        self._buckets = np.empty(window, object)
+        self._filled = np.zeros(window, bool)
+        self._advanced = asyncio.Event()
+
+    @property
+    def nbytes(self):
+        return self.sink.nbytes
+
+    @property
+    def written(self):
+        return self.sink.written
+
+    @property
+    def resumed(self):
+        return self.sink.resumed
+
+    def fits(self, request_ids):
+        """Whether rows with ``request_ids``, in trace order, can be sent
+        without overrunning the window. Remembers them for ``wait`` when
+        they cannot."""
+        if not len(request_ids):
+            return True
+        first, end = int(request_ids[0]), int(request_ids[-1]) + 1
+        if end - first > self.window:
+            raise ValueError(f"{end - first} rows do not fit a reorder window of {self.window}")
+        if end - self.base <= self.window:
+            return True
+        self.blocked = end
+        return False
+
+    async def wait(self):
+        """Wait until the rows ``fits`` turned down can be sent."""
+        while self.blocked is not None and self.blocked - self.base > self.window:
+            self._advanced.clear()
+            await self._advanced.wait()
+        self.blocked = None
+
+    def _put(self, request_ids, lines, bucket_id=None):
+        if request_ids.min() < self.base or request_ids.max() >= self.base + self.window:
+            raise ValueError(f"Request ids outside of the reorder window [{self.base}, {self.base + self.window})")
+        slots = request_ids % self.window
+        self._lines[slots] = lines
+        self._buckets[slots] = bucket_id
+        self._filled[slots] = True
+        self._drain()
+
+    def write(self, data, bucket_id=None):
+        if data:
+            self._put(*split_lines(data), bucket_id)
+
+    def skip(self, request_ids):
+        """Rows which never get a result line, a failed request."""
+        if len(request_ids):
+            self._put(np.asarray(request_ids, np.int64), None)
+
+    def _drain(self, gaps=False):
+        while True:
+            start = self.base % self.window
+            filled = self._filled[start:]
+            if not gaps:
+                count = len(filled) if filled.all() else int(filled.argmin())
+            elif self._filled[:start].any():
+                # More lines wait after the wrap, pass the end of the ring
+                count = len(filled)
+            else:
+                last = np.flatnonzero(filled)
+                count = int(last[-1]) + 1 if len(last) else 0
+            if not count:
+                break
+            lines = self._lines[start:start + count].tolist()
+            buckets = self._buckets[start:start + count].tolist()
+            if self.sink.output_dir is None:
+                self.sink.write(b"\n".join(filter(None, lines)))
+            else:
+                # One write per bucket file, in request id order within each
+                by_bucket = {}
+                for line, bucket_id in zip(lines, buckets):
+                    if line is not None:
+                        by_bucket.setdefault(bucket_id, []).append(line)
+                for bucket_id, bucket_lines in by_bucket.items():
+                    self.sink.write(b"\n".join(bucket_lines), bucket_id)
+            self._lines[start:start + count] = None
+            self._buckets[start:start + count] = None
+            self._filled[start:start + count] = False
+            self.base += count
+            self._advanced.set()
+            if start + count < self.window:
+                break
+
+    def flush(self):
+        self.sink.flush()
+
+    async def drain(self):
+        await self.sink.drain()
+
+    def barrier(self):
+        return self.sink.barrier()
+
+    def close(self):
+        # Only lines behind a missing one are left, write them anyway
+        if self._filled.any():
+            self._drain(gaps=True)
+        self.sink.close()
@@ -0,0 +1,280 @@
+"""Object id -> hash stores for the workers.
+
+``DictStore`` is the plain dict the workers always used. ``ObjectStore``
+keeps keys and hashes in two fixed width arenas, row ``i`` of both belongs
+to entry ``i``. A ``directory.Directory`` maps the 64 bit key digest to
+the entry, so like the router's directory two keys sharing a digest would
+share an entry. The key arena is only read back for snapshots.
+
+Both take and return bytes and share the batch API: ``put_many``,
+``get_many`` and ``execute`` for batches mixing reads and writes, plus
+``chunks`` to copy every entry out for snapshots.
+"""
+
+import numpy as np
+
+from . import directory
+from . import trace
+
+
+GROWTH = 1.25
+
+
+def _rows(items, width=None):
+    """Strings as an ``(n, width)`` uint8 matrix, ``items`` is a sequence of
+    bytes/str, a ``trace.StringColumn`` or already such a matrix."""
+    if isinstance(items, np.ndarray):
+        return items
+    if isinstance(items, trace.StringColumn):
+        lengths = items.ends - items.starts
+        if not items.compact:
+            items = items.take(slice(None))
+        data = items.data
+    else:
+        items = [item.encode() if isinstance(item, str) else item for item in items]
+        lengths = np.fromiter(map(len, items), np.int64, len(items))
+        data = b"".join(items)
+    if not len(lengths):
+        return np.empty((0, width or 0), np.uint8)
+    width = int(lengths[0]) if width is None else width
+    if not (lengths == width).all():
+        raise ValueError(f"ObjectStore holds {width} byte strings only")
+    return np.frombuffer(data, np.uint8, len(lengths) * width).reshape(-1, width)
+
+
+def _runs(actions):
+    """``(action, start, end)`` of every run of equal actions."""
+    starts = np.flatnonzero(np.diff(actions)) + 1
+    bounds = np.concatenate([[0], starts, [len(actions)]]).tolist()
+    return zip(actions[bounds[:-1]].tolist(), bounds[:-1], bounds[1:])
+
+
+def _widths(object_ids, hashes):
+    """``(key width, hash width)`` when every key and every hash of a write
+    batch has the same length, None otherwise."""
+    if not len(object_ids):
+        return None
+    key_widths = set(map(len, object_ids))
+    hash_widths = set(map(len, hashes))
+    if len(key_widths) != 1 or len(hash_widths) != 1:
+        return None
+    return key_widths.pop(), hash_widths.pop()
+
+
+class DictStore(dict):
+    """Writes go through ``put_many`` and ``execute``, which keep the count
+    of ``payload_bytes``. While all keys and hashes have one width it is
+    the entry count times their sum, after that every write is counted."""
+
+    # put_many wants bytes, not uint8 rows
+    columnar = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._widths = None
+        self._payload = sum(len(key) + len(value) for key, value in self.items())
+        self._uniform = not self
+
+    @property
+    def payload_bytes(self):
+        if self._uniform:
+            return len(self) * sum(self._widths) if self._widths else 0
+        return self._payload
+
+    def _same_widths(self, object_ids, hashes):
+        """Whether a write batch keeps the store at one key and hash width."""
+        if not self._uniform or not len(hashes):
+            return self._uniform
+        widths = _widths(object_ids, hashes)
+        if widths is not None and self._widths in (None, widths):
+            self._widths = widths
+            return True
+        self._payload = self.payload_bytes
+        self._uniform = False
+        return False
+
+    def put_many(self, object_ids, hashes):
+        if self._same_widths(object_ids, hashes):
+            self.update(zip(object_ids, hashes))
+            return
+        for object_id, value in zip(object_ids, hashes):
+            self._put(object_id, value)
+
+    def _put(self, object_id, value):
+        old = self.get(object_id)
+        self._payload += len(value) - (len(old) if old is not None else -len(object_id))
+        self[object_id] = value
+
+    def get_many(self, object_ids):
+        return [self[object_id] for object_id in object_ids]
+
+    def execute(self, actions, object_ids, hashes):
+        """Run a batch in order, ``actions`` holds one action byte per row
+        and ``hashes`` the hashes of the writes. Returns the read hashes."""
+        put = self.__setitem__ if self._same_widths(object_ids, hashes) else self._put
+        hashes = iter(hashes)
+        values = []
+        for action, object_id in zip(actions, object_ids):
+            if action == trace.WRITE:
+                put(object_id, next(hashes))
+            elif action == trace.READ:
+                values.append(self[object_id])
+        return values
+
+    def chunks(self, size):
+        """``(object_ids, hashes)`` of all entries, ``size`` at a time. The
+        chunks are a copy, later writes leave them alone."""
+        object_ids = list(self)
+        hashes = list(self.values())
+        return [
+            (object_ids[start:start + size], hashes[start:start + size])
+            for start in range(0, len(object_ids), size)
+        ]
+
+
+def _digest(rows):
+    column = trace.StringColumn(
+        rows.tobytes(),
+        np.arange(0, rows.size, rows.shape[1]),
+        np.arange(rows.shape[1], rows.size + 1, rows.shape[1]),
+        compact=True,
+    )
+    return column.digest()
+
+
+class ObjectStore:
+
+    columnar = True
+
+    def __init__(self, capacity=1 << 16):
+        self._index = directory.Directory(capacity, np.uint32)
+        self._keys = None
+        self._values = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        arenas = 0 if self._keys is None else self._keys.nbytes + self._values.nbytes
+        return self._index.nbytes + arenas
+
+    @property
+    def payload_bytes(self):
+        if self._keys is None:
+            return 0
+        return self._size * (self._keys.shape[1] + self._values.shape[1])
+
+    def chunks(self, size):
+        # Overwrites change the arenas in place, copy them first
+        if self._keys is None:
+            return []
+        keys = self._keys[:self._size].copy()
+        values = self._values[:self._size].copy()
+        return [(keys[start:start + size], values[start:start + size]) for start in range(0, self._size, size)]
+
+    def _reserve(self, rows, values):
+        size = self._size + len(rows)
+        if self._keys is None:
+            self._keys = np.empty((0, rows.shape[1]), np.uint8)
+            self._values = np.empty((0, values.shape[1]), np.uint8)
+        if values.shape[1] != self._values.shape[1] or rows.shape[1] != self._keys.shape[1]:
+            raise ValueError("ObjectStore holds fixed width keys and hashes")
+        if size > len(self._keys):
+            capacity = max(size, int(len(self._keys) * GROWTH))
+            self._keys = self._grow(self._keys, capacity)
+            self._values = self._grow(self._values, capacity)
+
+    def _grow(self, arena, capacity):
+        grown = np.empty((capacity, arena.shape[1]), np.uint8)
+        grown[:self._size] = arena[:self._size]
+        return grown
+
+    def put_many(self, object_ids, hashes):
+        """Insert or overwrite a batch, the last of repeated keys wins."""
+        rows = _rows(object_ids)
+        values = _rows(hashes)
+        if len(rows) != len(values):
+            raise ValueError("object_ids and hashes differ in length")
+        if not len(rows):
+            return
+        self._reserve(rows, values)
+        digests = _digest(rows)
+        entries, known = self._index.find(digests)
+        self._values[entries[known]] = values[known]
+        new = np.flatnonzero(~known)
+        if not len(new):
+            return
+        _, last = np.unique(digests[new][::-1], return_index=True)
+        if len(last) != len(new):
+            # Repeated keys in the batch, keep the last one of each
+            new = np.sort(new[len(new) - 1 - last])
+        start = self._size
+        self._keys[start:start + len(new)] = rows[new]
+        self._values[start:start + len(new)] = values[new]
+        self._size += len(new)
+        self._index.put_many(digests[new], np.arange(start, self._size))
+
+    def get_many(self, object_ids):
+        """Hashes of a batch as a compact ``trace.StringColumn``."""
+        rows = _rows(object_ids)
+        if not len(rows):
+            return trace.StringColumn(b"", np.zeros(0, np.int64), np.zeros(0, np.int64), compact=True)
+        if self._keys is None:
+            raise KeyError(f"{len(rows)} unknown objects")
+        entries, found = self._index.find(_digest(rows))
+        if not found.all():
+            raise KeyError(rows[~found][0].tobytes())
+        width = self._values.shape[1]
+        ends = np.arange(width, width * (len(rows) + 1), width)
+        return trace.StringColumn(self._values[entries].tobytes(), ends - width, ends, compact=True)
+
+    def execute(self, actions, object_ids, hashes):
+        """Same as ``DictStore.execute``. Writes go first in one batch unless
+        a read comes before a later write of the same object."""
+        actions = np.frombuffer(actions, np.uint8)
+        rows = _rows(object_ids)
+        writes = np.flatnonzero(actions == trace.WRITE)
+        reads = np.flatnonzero(actions == trace.READ)
+        values = _rows(hashes)
+        if len(writes) and len(reads):
+            written = _digest(rows[writes])
+            order = np.argsort(written, kind="stable")
+            written = written[order]
+            # Position of the last write with the digest of every read
+            last = np.maximum(np.searchsorted(written, _digest(rows[reads]), side="right") - 1, 0)
+            later = (written[last] == _digest(rows[reads])) & (writes[order[last]] > reads)
+            if later.any():
+                return self._execute_runs(actions, rows, values)
+        self.put_many(rows[writes], values)
+        return self.get_many(rows[reads])
+
+    def _execute_runs(self, actions, rows, values):
+        result = []
+        written = 0
+        for action, start, end in _runs(actions):
+            if action == trace.WRITE:
+                self.put_many(rows[start:end], values[written:written + end - start])
+                written += end - start
+            elif action == trace.READ:
+                result.extend(self.get_many(rows[start:end]).tolist())
+        return result
+
+    def __setitem__(self, object_id, hash):
+        self.put_many([object_id], [hash])
+
+    def __getitem__(self, object_id):
+        return self.get_many([object_id]).data
+
+    def __contains__(self, object_id):
+        if self._keys is None:
+            return False
+        try:
+            rows = _rows([object_id], self._keys.shape[1])
+        except ValueError:
+            return False
+        return bool(self._index.find(_digest(rows))[1][0])
+
+
+STORES = {"dict": DictStore, "arena": ObjectStore}
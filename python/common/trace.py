@@ -0,0 +1,390 @@
+"""Chunked trace parser.
+
+The trace is mapped with mmap and parsed a block at a time with numpy: one
+pass finds every separator, the per-row columns are gathered from their
+positions. Strings are kept as offsets into the block until a batch is
+split per bucket, where they are gathered into compact buffers that go on
+the wire as is.
+"""
+
+import mmap
+
+import numpy as np
+
+from numpy.lib.stride_tricks import as_strided
+
+from . import batch
+
+BLOCK_SIZE = 8 << 20
+NEWLINE = ord("\n")
+RETURN = ord("\r")
+COMMA = ord(",")
+ZERO = ord("0")
+READ = ord("R")
+WRITE = ord("W")
+
+# 64 bit FNV-1a over little endian 8 byte words, zero padded, with an xor
+# shift per word so short ids still spread over the low bits.
+_FNV_OFFSET = 0xCBF29CE484222325
+_FNV_PRIME = 0x100000001B3
+_MASK = (1 << 64) - 1
+
+
+def _words(buf):
+    """Little endian uint64 starting at every byte of the uint8 ``buf``,
+    a view for unaligned word gathers."""
+    return np.ndarray((max(len(buf) - 7, 0),), "<u8", buf, strides=(1,))
+
+
+def digest(value):
+    """Stable 64 bit digest of one string, equal to ``StringColumn.digest``."""
+    value = value + b"\0" * (-len(value) % 8)
+    h = _FNV_OFFSET
+    for i in range(0, len(value), 8):
+        h = ((h ^ int.from_bytes(value[i:i + 8], "little")) * _FNV_PRIME) & _MASK
+        h ^= h >> 29
+    return h
+
+
+class StringColumn:
+    """Strings ``data[starts[i]:ends[i]]``, compact when they are stored
+    back to back from the start of ``data``."""
+
+    def __init__(self, data, starts, ends, compact=False):
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+        self.compact = compact
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def width(self):
+        """Common length of the strings, None if they differ."""
+        lengths = self.ends - self.starts
+        if not len(lengths):
+            return 0
+        width = int(lengths[0])
+        return width if (lengths == width).all() else None
+
+    def take(self, rows):
+        starts = self.starts[rows]
+        lengths = self.ends[rows] - starts
+        width = int(lengths[0]) if len(lengths) else 0
+        buf = np.frombuffer(self.data, np.uint8)
+        if width and (lengths == width).all():
+            # Fixed width strings are rows of a sliding window over the data
+            windows = as_strided(buf, (len(buf) - width + 1, width), (1, 1), writeable=False)
+            ends = np.arange(width, width * (len(starts) + 1), width)
+            return StringColumn(windows[starts].tobytes(), ends - width, ends, compact=True)
+        ends = np.cumsum(lengths)
+        new_starts = ends - lengths
+        total = int(ends[-1]) if len(ends) else 0
+        index = np.repeat(starts - new_starts, lengths) + np.arange(total)
+        return StringColumn(buf[index].tobytes(), new_starts, ends, compact=True)
+
+    def digest(self):
+        """``digest`` of every string as an uint64 array."""
+        lengths = self.ends - self.starts
+        width = int(lengths[0]) if len(lengths) else 0
+        if not width or not (lengths == width).all():
+            return np.array([digest(value) for value in self.tolist()], np.uint64)
+        column = self if self.compact else self.take(slice(None))
+        rows = np.frombuffer(column.data, np.uint8, len(column) * width).reshape(-1, width)
+        if width % 8:
+            rows = np.pad(rows, ((0, 0), (0, -width % 8)))
+        words = rows.view("<u8")
+        h = np.full(len(rows), _FNV_OFFSET, np.uint64)
+        for k in range(words.shape[1]):
+            h ^= words[:, k]
+            h *= np.uint64(_FNV_PRIME)
+            h ^= h >> np.uint64(29)
+        return h
+
+    def pack(self):
+        """Column in the ``batch.pack_strings`` layout."""
+        column = self if self.compact else self.take(slice(None))
+        width = column.width()
+        if not width:
+            return batch.pack_strings(column.tolist())
+        return batch.pack_fixed(column.data, width)
+
+    def tolist(self):
+        data = self.data
+        width = self.width()
+        if self.compact and width:
+            return [data[i:i + width] for i in range(0, len(data), width)]
+        return [data[s:e] for s, e in zip(self.starts.tolist(), self.ends.tolist())]
+
+    @staticmethod
+    def concat(columns):
+        columns = [c if c.compact else c.take(slice(None)) for c in columns]
+        shifts = np.cumsum([0] + [len(c.data) for c in columns[:-1]])
+        return StringColumn(
+            b"".join([c.data for c in columns]),
+            np.concatenate([c.starts + shift for c, shift in zip(columns, shifts)]),
+            np.concatenate([c.ends + shift for c, shift in zip(columns, shifts)]),
+            compact=True,
+        )
+
+
+class TraceBatch:
+    """Rows of the trace as columns. ``actions`` holds the action byte of
+    every row, reads have a zero size and an empty hash."""
+
+    def __init__(self, request_ids, actions, object_ids, sizes, hashes):
+        self.request_ids = request_ids
+        self.actions = actions
+        self.object_ids = object_ids
+        self.sizes = sizes
+        self.hashes = hashes
+
+    def __len__(self):
+        return len(self.request_ids)
+
+    def writes(self):
+        return np.flatnonzero(self.actions == WRITE)
+
+    def reads(self):
+        return np.flatnonzero(self.actions != WRITE)
+
+    def take(self, rows):
+        return TraceBatch(
+            self.request_ids[rows],
+            self.actions[rows],
+            self.object_ids.take(rows),
+            self.sizes[rows],
+            self.hashes.take(rows),
+        )
+
+    @staticmethod
+    def concat(batches):
+        if len(batches) == 1:
+            return batches[0]
+        return TraceBatch(
+            np.concatenate([b.request_ids for b in batches]),
+            np.concatenate([b.actions for b in batches]),
+            StringColumn.concat([b.object_ids for b in batches]),
+            np.concatenate([b.sizes for b in batches]),
+            StringColumn.concat([b.hashes for b in batches]),
+        )
+
+    def to_messages(self):
+        """Per-message dicts of the json/pickle protocols."""
+        messages = []
+        rows = zip(
+            self.request_ids.tolist(),
+            self.actions.tobytes().decode(),
+            self.object_ids.tolist(),
+            self.sizes.tolist(),
+            self.hashes.tolist(),
+        )
+        for request_id, action, object_id, size, hash in rows:
+            message = {"request_id": request_id, "action": action, "object_id": object_id.decode()}
+            if action == "W":
+                message["size"] = size
+                message["hash"] = hash.decode()
+            messages.append(message)
+        return messages
+
+
+_ZEROS = np.uint64(0x3030303030303030)
+
+
+def parse_int(buf, starts, ends):
+    """Decimal ints ``buf[starts:ends]``. Up to 8 digits are read as one
+    word each and combined in place (SWAR), longer ones digit by digit."""
+    widths = ends - starts
+    if len(widths) and int(widths.max()) <= 8 and int(widths.min()) > 0:
+        # The word ends at the last digit, the bytes before the number
+        # become '0'
+        early = ends < 8
+        x = _words(buf)[np.maximum(ends - 8, 0)]
+        widths *= -8
+        widths += 64
+        before = np.left_shift(np.uint64(1), widths.astype(np.uint64))
+        before -= np.uint64(1)
+        x &= ~before
+        x |= _ZEROS & before
+        x -= _ZEROS
+        x = x * np.uint64(10) + (x >> np.uint64(8))
+        x &= np.uint64(0x00FF00FF00FF00FF)
+        x = x * np.uint64(100) + (x >> np.uint64(16))
+        x &= np.uint64(0x0000FFFF0000FFFF)
+        x = x * np.uint64(10000) + (x >> np.uint64(32))
+        x &= np.uint64(0xFFFFFFFF)
+        values = x.astype(np.int64)
+        if early.any():
+            values[early] = _parse_digits(buf, starts[early], ends[early])
+        return values
+    return _parse_digits(buf, starts, ends)
+
+
+def _parse_digits(buf, starts, ends):
+    values = np.zeros(len(starts), np.int64)
+    width = int((ends - starts).max(initial=0))
+    for k in range(width, 0, -1):
+        pos = ends - k
+        digits = buf[pos].astype(np.int64)
+        digits -= ZERO
+        digits[pos < starts] = 0
+        values *= 10
+        values += digits
+    return values
+
+
+def parse_block(block):
+    """Parse whole lines of ``request_id,action,object_id[,size,hash]``,
+    ending in ``\n`` or ``\r\n``."""
+    buf = np.frombuffer(block, np.uint8)
+    # Digits and letters all sort after ',', '\r' and '\n'. A '\r' ends
+    # the object id of a read like a comma, only a hash has to drop it
+    separators = np.flatnonzero(buf <= COMMA)
+    line_ends = np.flatnonzero(buf[separators] == NEWLINE)
+    first = np.empty_like(line_ends)
+    first[:1] = 0
+    first[1:] = line_ends[:-1] + 1
+    starts = np.empty_like(line_ends)
+    starts[:1] = 0
+    starts[1:] = separators[line_ends[:-1]] + 1
+
+    request_end = separators[first]
+    actions = buf[request_end + 1]
+    object_start = separators[first + 1] + 1
+    object_end = separators[first + 2]
+
+    writes = np.flatnonzero(actions == WRITE)
+    size_end = separators[first[writes] + 3]
+    sizes = np.zeros(len(first), np.int64)
+    sizes[writes] = parse_int(buf, object_end[writes] + 1, size_end)
+    # Reads get an empty hash at the end of their line
+    hash_start = separators[line_ends].copy()
+    hash_end = hash_start.copy()
+    hash_start[writes] = size_end + 1
+    hash_end[writes] -= buf[hash_end[writes] - 1] == RETURN
+
+    return TraceBatch(
+        parse_int(buf, starts, request_end),
+        actions,
+        StringColumn(block, object_start, object_end),
+        sizes,
+        StringColumn(block, hash_start, hash_end),
+    )
+
+
+def read_blocks(path, block_size=BLOCK_SIZE, start=0, stop=None, offsets=False):
+    """Yield whole lines of the file, ``block_size`` bytes at a time, from
+    ``start`` up to ``stop``, which are line starts. With ``offsets`` yield
+    ``(end, block)``, ``end`` the byte offset after the block."""
+    with open(path, "rb") as reader:
+        size = reader.seek(0, 2)
+        if stop is None or stop > size:
+            stop = size
+        if start >= stop:
+            return
+        with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while start < stop:
+                end = start + block_size
+                if end < stop:
+                    end = mm.rfind(b"\n", start, end) + 1 or mm.find(b"\n", end, stop) + 1 or stop
+                else:
+                    end = stop
+                block = mm[start:end]
+                if not block.endswith(b"\n") or block.endswith(b"\n\n"):
+                    block = block.rstrip(b"\n") + b"\n"
+                if block.strip():
+                    yield (end, block) if offsets else block
+                start = end
+
+
+def split_ranges(path, parts):
+    """``(start, stop)`` byte ranges of about equal size, cut at line starts."""
+    with open(path, "rb") as reader:
+        size = reader.seek(0, 2)
+        if not size:
+            return []
+        with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            cuts = [0]
+            for k in range(1, parts):
+                cut = mm.find(b"\n", max(size * k // parts, cuts[-1])) + 1 or size
+                if cut < size and cut > cuts[-1]:
+                    cuts.append(cut)
+    cuts.append(size)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def read_batches(path, block_size=BLOCK_SIZE, start=0, stop=None, offsets=False):
+    """Yield a ``TraceBatch`` for every ``block_size`` bytes of the trace,
+    or ``(end, batch)`` like ``read_blocks``."""
+    for item in read_blocks(path, block_size, start, stop, offsets):
+        if offsets:
+            end, block = item
+            yield end, parse_block(block)
+        else:
+            yield parse_block(item)
+
+
+def group_rows(keys, rows=None):
+    """Yield ``(key, rows)`` for every distinct key, rows keep trace order."""
+    keys = np.asarray(keys)
+    if rows is None:
+        rows = np.arange(len(keys))
+    else:
+        keys = keys[rows]
+    order = np.argsort(keys, kind="stable")
+    values, starts = np.unique(keys[order], return_index=True)
+    return zip(values.tolist(), np.split(rows[order], starts[1:]))
+
+
+def encode_batch(action, trace_batch):
+    """Columnar http body of a batch holding only ``action`` rows."""
+    hashes = trace_batch.hashes.pack() if action == "W" else batch.pack_strings([])
+    return batch.encode_columns(
+        action,
+        len(trace_batch),
+        trace_batch.request_ids.astype(np.uint64).tobytes(),
+        trace_batch.object_ids.pack(),
+        hashes,
+    )
+
+
+def encode_mixed(trace_batch):
+    """Columnar http body of a batch interleaving reads and writes."""
+    return batch.encode_columns(
+        batch.MIXED,
+        len(trace_batch),
+        trace_batch.request_ids.astype(np.uint64).tobytes(),
+        trace_batch.object_ids.pack(),
+        trace_batch.hashes.take(trace_batch.writes()).pack(),
+        trace_batch.actions.tobytes(),
+    )
+
+
+def iter_body(action, trace_batch):
+    """Parts of the ``encode_batch``/``encode_mixed`` body, each column is
+    packed once the parts before it are consumed, so a streamed upload
+    holds one packed column at a time."""
+    yield batch.encode_header(action, len(trace_batch))
+    yield from batch.encode_column(trace_batch.request_ids.astype(np.uint64).tobytes())
+    yield from batch.encode_column(trace_batch.object_ids.pack())
+    if action == batch.MIXED:
+        yield from batch.encode_column(trace_batch.hashes.take(trace_batch.writes()).pack())
+        yield from batch.encode_column(trace_batch.actions.tobytes())
+    elif action == "W":
+        yield from batch.encode_column(trace_batch.hashes.pack())
+    else:
+        yield from batch.encode_column(batch.pack_strings([]))
+
+
+def encode_frames(bucket_id, trace_batch):
+    """zmq multipart message of a mixed batch, see ``batch.decode_frames``."""
+    return [
+        batch.topic(bucket_id),
+        trace_batch.actions.tobytes(),
+        trace_batch.request_ids.astype(np.uint64).tobytes(),
+        trace_batch.object_ids.pack(),
+        trace_batch.hashes.take(trace_batch.writes()).pack(),
+    ]
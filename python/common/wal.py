@@ -0,0 +1,335 @@
+"""Write-ahead log and snapshots for the worker stores.
+
+A log directory holds numbered segments ``wal-<n>.log`` and at most one
+``snapshot-<n>.snap`` covering every segment before ``n``. Both are a
+sequence of records
+
+    length(4) | crc32(4) | len(4) actions | actions | len(4) object_ids | object_ids | hashes
+
+with the columns packed like the batch format, so a worker can log the
+columns of a request as they came in. ``actions`` holds one action byte
+per object id when reads are mixed in, and is empty when every row is a
+write.
+
+Every request batch is one record. ``append`` hands it to a writer
+thread which writes it while the worker applies the batch to its store;
+``commit`` waits for an fsync covering it before the worker answers.
+Commits share fsyncs (group commit): the writer writes everything queued
+and syncs once, which covers every commit waiting on those records. Workers taking several batches
+at a time run them inside ``deferred`` and commit once, the http worker
+awaits ``commit_async`` so other requests go on meanwhile.
+
+Once enough was logged a commit rotates to a new segment and writes the
+snapshot on a background thread from a copy of the store, older files are
+dropped when it is done. A truncated or corrupt tail record, as left by a
+crash mid-write, ends the replay and is cut off.
+"""
+
+import asyncio
+import contextlib
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from . import batch
+from . import trace
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_BYTES = 256 << 20
+SNAPSHOT_CHUNK = 1 << 16
+
+_RECORD = struct.Struct("<II")
+_LENGTH = struct.Struct("<I")
+_SEGMENT = re.compile(r"wal-(\d+)\.log$")
+_SNAPSHOT = re.compile(r"snapshot-(\d+)\.snap$")
+
+
+def _pack(column):
+    if isinstance(column, np.ndarray):
+        return batch.pack_fixed(column.tobytes(), column.shape[1])
+    return batch.pack_strings(column)
+
+
+def _record(actions, object_ids, hashes):
+    """Header and parts of a record over packed columns. zlib drops the GIL
+    for the crc32, so this runs on the writer thread."""
+    parts = [_LENGTH.pack(len(actions)), actions, _LENGTH.pack(len(object_ids)), object_ids, hashes]
+    crc = 0
+    for part in parts:
+        crc = zlib.crc32(part, crc)
+    length = sum(len(part) for part in parts)
+    return [_RECORD.pack(length, crc)] + parts
+
+
+def _unpack(buf, start, end, rows):
+    """A packed column as a list of bytes, or as a uint8 matrix for stores
+    taking rows when the column is fixed width."""
+    if rows:
+        return batch.unpack_rows(buf, start, end)
+    return batch.unpack_strings(buf, start, end)
+
+
+def _writes(actions, object_ids):
+    if isinstance(object_ids, np.ndarray):
+        return object_ids[np.frombuffer(actions, np.uint8) == trace.WRITE]
+    return [object_id for action, object_id in zip(actions, object_ids) if action == trace.WRITE]
+
+
+def _apply(buf, start, end, store, rows):
+    # Own frame so no array over the mmap outlives it
+    bounds = []
+    for _ in range(2):
+        column, = _LENGTH.unpack_from(buf, start)
+        start += _LENGTH.size
+        bounds.append((start, start + column))
+        start += column
+    actions = buf[slice(*bounds[0])]
+    object_ids = _unpack(buf, *bounds[1], rows)
+    if actions:
+        object_ids = _writes(actions, object_ids)
+    store.put_many(object_ids, _unpack(buf, start, end, rows))
+
+
+def replay(path, store):
+    """Apply every intact record of ``path`` to ``store``, return the
+    number of records and the offset after the last intact one."""
+    size = os.path.getsize(path)
+    if not size:
+        return 0, 0
+    rows = getattr(store, "columnar", False)
+    records = 0
+    offset = 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        while offset + _RECORD.size <= size:
+            length, crc = _RECORD.unpack_from(buf, offset)
+            start = offset + _RECORD.size
+            end = start + length
+            if end > size or zlib.crc32(buf[start:end]) != crc:
+                break
+            _apply(buf, start, end, store, rows)
+            records += 1
+            offset = end
+    return records, offset
+
+
+class Log:
+
+    def __init__(self, path, store, snapshot_bytes=SNAPSHOT_BYTES, fsync=True):
+        self.path = path
+        self.store = store
+        self.snapshot_bytes = snapshot_bytes
+        self.fsync = fsync
+        self._file = None
+        self._segment = 0
+        # Column bytes logged to the current segment, counted on append
+        self._logged = 0
+        self._deferred = 0
+        # Writer thread state, guarded by _wakeup
+        self._queue = []
+        self._syncs = []
+        self._appended = 0
+        self._synced = 0
+        self._error = None
+        self._closing = False
+        self._wakeup = threading.Condition()
+        self._writer = threading.Thread(target=self._run, name="wal-writer", daemon=True)
+        self._writer.start()
+        self._snapshotter = ThreadPoolExecutor(1)
+        self._snapshot = None
+        os.makedirs(path, exist_ok=True)
+
+    def _files(self, pattern):
+        found = []
+        for name in os.listdir(self.path):
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.path, name)))
+        return sorted(found)
+
+    def recover(self):
+        """Load the latest snapshot and the segments after it into the store,
+        then keep appending to the last segment. Returns the number of
+        records replayed."""
+        records = 0
+        segment = 0
+        snapshots = self._files(_SNAPSHOT)
+        if snapshots:
+            segment, path = snapshots[-1]
+            records += replay(path, self.store)[0]
+        for number, path in self._files(_SEGMENT):
+            if number < segment:
+                continue
+            count, offset = replay(path, self.store)
+            if offset != os.path.getsize(path):
+                logger.warning(f"Truncate {path} at {offset}, torn tail record")
+                os.truncate(path, offset)
+            records += count
+            segment = number
+        self._segment = segment
+        self._open(segment)
+        self._logged = self._file.tell()
+        return records
+
+    def _open(self, segment):
+        # Runs on the writer thread once it is logging
+        if self._file is not None:
+            self._sync(self._file)
+            self._file.close()
+        self._file = open(os.path.join(self.path, f"wal-{segment:08d}.log"), "ab")
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _write(self, f, actions, object_ids, hashes):
+        f.writelines(_record(actions, object_ids, hashes))
+
+    def _append(self, actions, object_ids, hashes):
+        self._write(self._file, actions, object_ids, hashes)
+
+    def _submit(self, function, *args):
+        with self._wakeup:
+            self._queue.append((function, args))
+            self._appended += 1
+            self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while not self._queue and not self._closing:
+                    self._wakeup.wait()
+                if not self._queue:
+                    return
+                queue, self._queue = self._queue, []
+                appended = self._appended
+            try:
+                if self._error is not None:
+                    raise self._error
+                for function, args in queue:
+                    function(*args)
+                # Drop the request buffers before waiting on the disk
+                del queue
+                self._sync(self._file)
+            except Exception as e:
+                self._error = e
+            with self._wakeup:
+                if self._error is None:
+                    self._synced = appended
+                syncs = [(target, future) for target, future in self._syncs if target > self._synced]
+                done = [future for target, future in self._syncs if target <= self._synced]
+                self._syncs = [] if self._error is not None else syncs
+            for future in done:
+                future.set_result(None)
+            if self._error is not None:
+                for _, future in syncs:
+                    future.set_exception(self._error)
+
+    def append_columns(self, object_ids, hashes, actions=b""):
+        """Log one request batch given its packed columns, the buffers must
+        stay alive until ``commit``."""
+        self._logged += len(object_ids) + len(hashes) + len(actions)
+        self._submit(self._append, actions, object_ids, hashes)
+
+    def append(self, object_ids, hashes, actions=b""):
+        if not len(object_ids):
+            return
+        self.append_columns(_pack(object_ids), _pack(hashes), actions)
+
+    def sync(self):
+        """Future done once every batch logged so far is durable."""
+        future = Future()
+        with self._wakeup:
+            if self._error is not None:
+                future.set_exception(self._error)
+            elif self._synced == self._appended:
+                future.set_result(None)
+            else:
+                self._syncs.append((self._appended, future))
+        return future
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """Skip the commits of the batches run inside, the caller commits
+        once before any of them is answered."""
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+
+    def commit(self):
+        """Wait for the batches logged so far to be durable, called once they
+        are applied to the store and before answering."""
+        if self._deferred:
+            return
+        self.sync().result()
+        self._check_snapshot()
+
+    async def commit_async(self):
+        """``commit`` without blocking the event loop, batches other
+        requests log meanwhile share its fsync."""
+        await asyncio.wrap_future(self.sync())
+        self._check_snapshot()
+
+    def _check_snapshot(self):
+        if self._logged >= self.snapshot_bytes and (self._snapshot is None or self._snapshot.done()):
+            self.snapshot()
+
+    def snapshot(self):
+        """Start a new segment and write a copy of the store as the snapshot
+        of the ones before it on a background thread, which drops them once
+        it is durable. Returns its future."""
+        if self._snapshot is not None:
+            # Raise what went wrong with the last one
+            self._snapshot.result()
+        self._segment += 1
+        self._logged = 0
+        self._submit(self._open, self._segment)
+        # Every batch logged so far is applied, the copy covers them all
+        s = time.perf_counter()
+        chunks = self.store.chunks(SNAPSHOT_CHUNK)
+        paused = time.perf_counter() - s
+        self._snapshot = self._snapshotter.submit(self._write_snapshot, self._segment, chunks, len(self.store), paused)
+        return self._snapshot
+
+    def _write_snapshot(self, segment, chunks, objects, paused):
+        path = os.path.join(self.path, f"snapshot-{segment:08d}.snap")
+        with open(path + ".tmp", "wb") as f:
+            for object_ids, hashes in chunks:
+                self._write(f, b"", _pack(object_ids), _pack(hashes))
+            self._sync(f)
+        os.replace(path + ".tmp", path)
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        for number, old in self._files(_SEGMENT) + self._files(_SNAPSHOT):
+            if number < segment:
+                os.remove(old)
+        logger.info(f"Snapshot {objects} objects to {path}, copied in {paused:.3f}s")
+
+    def close(self):
+        if self._snapshot is not None:
+            self._snapshot.result()
+        self._snapshotter.shutdown()
+        self.sync().result()
+        with self._wakeup:
+            self._closing = True
+            self._wakeup.notify()
+        self._writer.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
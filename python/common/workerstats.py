@@ -0,0 +1,79 @@
+"""Counters of a worker process for its stats endpoint or control message:
+requests per endpoint, histograms of batch sizes, handler time and event
+loop lag, plus objects and payload bytes per bucket and the process RSS."""
+
+import asyncio
+import os
+import resource
+import time
+
+from collections import defaultdict
+
+from . import latency
+
+
+LAG_INTERVAL = 0.1
+
+
+def rss_bytes():
+    """Resident set size from /proc, the peak where there is none."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class WorkerStats:
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.batch_sizes = latency.Histogram(scale=1)
+        self.handler_time = latency.Histogram()
+        self.loop_lag = None
+
+    def record(self, endpoint, messages, seconds, failed=False):
+        self.requests[endpoint] += 1
+        if failed:
+            self.errors[endpoint] += 1
+        self.batch_sizes.record(messages)
+        self.handler_time.record(seconds)
+
+    async def monitor_loop(self, interval=LAG_INTERVAL):
+        """How late the event loop wakes a sleeper, run as a task."""
+        self.loop_lag = latency.Histogram()
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.record(max(time.perf_counter() - start - interval, 0.0))
+
+    def report(self, stores):
+        """Stats of the process, ``stores`` maps a bucket id to its store."""
+        return {
+            "uptime_s": time.time() - self.started,
+            "rss_bytes": rss_bytes(),
+            "buckets": {
+                str(bucket_id): {"objects": len(store), "payload_bytes": store.payload_bytes}
+                for bucket_id, store in stores.items()
+            },
+            "requests": dict(self.requests),
+            "errors": dict(self.errors),
+            "batch_size": self.batch_sizes.summarize_values(),
+            "handler_ms": self.handler_time.summarize(),
+            "loop_lag_ms": None if self.loop_lag is None else self.loop_lag.summarize(),
+        }
+
+
+def format_report(report):
+    buckets = report["buckets"].values()
+    lag = report["loop_lag_ms"]
+    return (
+        f"objects={sum(bucket['objects'] for bucket in buckets)} "
+        f"payload={sum(bucket['payload_bytes'] for bucket in buckets)} bytes "
+        f"rss={report['rss_bytes'] / (1 << 20):.1f}MiB requests={sum(report['requests'].values())} "
+        f"errors={sum(report['errors'].values())} batch p50={report['batch_size']['p50']:.0f} "
+        f"handler p50={report['handler_ms']['p50_ms']:.2f}ms p99={report['handler_ms']['p99_ms']:.2f}ms"
+        + ("" if lag is None else f" loop lag p99={lag['p99_ms']:.2f}ms max={lag['max_ms']:.2f}ms")
+    )
@@ -0,0 +1,113 @@
+"""Compare json and columnar batch encoding between router and worker.
+
+Runs the serialisation work of both sides in one process on a trace
+produced by cpp/data.py and reports bytes per message and CPU seconds.
+"""
+import argparse
+import logging
+import orjson as json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import batch  # noqa: E402
+from common import trace  # noqa: E402
+
+
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] [%(filename)s:%(lineno)d:%(funcName)s] %(message)s"
+)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+level = "INFO"
+logger.setLevel(level)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default="data.txt")
+    parser.add_argument("--block-size", default=trace.BLOCK_SIZE, type=int)
+    parser.add_argument("--worker-id", default=0)
+    return parser
+
+
+def load_batches(args):
+    batches = []
+    for trace_batch in trace.read_batches(args.data, args.block_size):
+        writes = trace_batch.take(trace_batch.writes())
+        reads = trace_batch.take(trace_batch.reads())
+        # The json router builds these dicts while ingesting, not when sending
+        batches.append(((writes, writes.to_messages()), (reads, reads.to_messages())))
+    return batches
+
+
+def run_json(batches, worker_id):
+    store = {}
+    sent = received = 0
+    for writes, reads in batches:
+        for action, (_, messages) in (("W", writes), ("R", reads)):
+            if not messages:
+                continue
+            body = json.dumps({"messages": messages})
+            sent += len(body)
+            result = []
+            for message in json.loads(body)["messages"]:
+                if action == "W":
+                    store[message["object_id"]] = message["hash"]
+                    result.append(f"{message['request_id']},{worker_id}")
+                else:
+                    result.append(f"{message['request_id']},{store[message['object_id']]}")
+            response = json.dumps({"result": result})
+            received += len(response)
+            "\n".join(json.loads(response)["result"]).encode()
+    return sent, received
+
+
+def run_binary(batches, worker_id):
+    store = {}
+    suffix = b",%s" % str(worker_id).encode()
+    sent = received = 0
+    for writes, reads in batches:
+        for action, (messages, _) in (("W", writes), ("R", reads)):
+            if not len(messages):
+                continue
+            body = trace.encode_batch(action, messages)
+            sent += len(body)
+            _, request_ids, object_ids, hashes = batch.decode_batch(body)
+            if action == "W":
+                store.update(zip(object_ids, hashes))
+                response = b"\n".join([b"%d%s" % (request_id, suffix) for request_id in request_ids])
+            else:
+                response = b"\n".join([
+                    b"%d,%s" % (request_id, store[object_id])
+                    for request_id, object_id in zip(request_ids, object_ids)
+                ])
+            received += len(response)
+    return sent, received
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    batches = load_batches(args)
+    total = sum(len(writes[0]) + len(reads[0]) for writes, reads in batches)
+    logger.info(f"Loaded {total} messages in {len(batches)} batches")
+    report = {}
+    for name, fn in (("json", run_json), ("binary", run_binary)):
+        s = time.process_time()
+        sent, received = fn(batches, args.worker_id)
+        cpu = time.process_time() - s
+        report[name] = cpu
+        print(
+            f"{name:>6}: request {sent / total:.1f} B/msg, "
+            f"response {received / total:.1f} B/msg, "
+            f"cpu {cpu:.3f}s ({total / cpu:.0f} msg/s)"
+        )
+    print(f"CPU saved: {1 - report['binary'] / report['json']:.1%}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""Compare the barrier and credit dispatchers of router.py.
+
+Starts one fake worker per bucket in this process. A fake worker serves
+one batch at a time and sleeps ``--row-cost`` per message, bucket 0
+``--slow`` times longer, so the comparison does not depend on how many
+cores are left for real workers. Replies are empty, stdout stays clean.
+
+    python bench_dispatch.py --data ../../data_large.txt --bucket-num 4
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import batch  # noqa: E402
+from common import trace  # noqa: E402
+
+import router  # noqa: E402
+
+
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] [%(filename)s:%(lineno)d:%(funcName)s] %(message)s"
+)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+level = "INFO"
+logger.setLevel(level)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default="data.txt")
+    parser.add_argument("--bucket-num", default=4, type=int)
+    parser.add_argument("--start-port", default=6500, type=int)
+    parser.add_argument("--row-cost", default=2e-6, type=float, help="Seconds per message")
+    parser.add_argument("--slow", default=3.0, type=float, help="Slowdown of bucket 0")
+    parser.add_argument("--flush-messages", default=100000, type=int)
+    return parser
+
+
+async def start_workers(args):
+    runners = []
+    for bucket_id in range(args.bucket_num):
+        lock = asyncio.Lock()
+        cost = args.row_cost * (args.slow if bucket_id == 0 else 1)
+
+        async def serve(request, lock=lock, cost=cost):
+            body = await request.read()
+            _, count, _ = batch.split_batch(body)
+            async with lock:
+                await asyncio.sleep(count * cost)
+            return web.Response(body=b"", content_type=batch.RESULT_CONTENT_TYPE)
+
+        app = web.Application(client_max_size=1 << 30)
+        app.router.add_post("/v1/messages/c", serve)
+        app.router.add_post("/v1/messages/r", serve)
+        app.router.add_post("/v1/messages/m", serve)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "localhost", args.start_port + bucket_id).start()
+        runners.append(runner)
+    return runners
+
+
+async def compare(args):
+    runners = await start_workers(args)
+    for dispatch in ("barrier", "credit"):
+        router_args = router.create_parser().parse_args([
+            "--data", args.data,
+            "--bucket-num", str(args.bucket_num),
+            "--start-port", str(args.start_port),
+            "--batch-format", "binary",
+            "--dispatch", dispatch,
+            "--flush-messages", str(args.flush_messages),
+        ])
+        buckets, urls = router.init_bucket(router_args)
+        s = time.time()
+        await router.run(router_args, trace.read_batches(args.data), buckets, urls)
+        logger.info(f"{dispatch}: {time.time() - s:.2f}s")
+    for runner in runners:
+        await runner.cleanup()
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    asyncio.run(compare(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
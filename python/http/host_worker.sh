@@ -0,0 +1,18 @@
+#!/bin/bash
+# One worker.py host per PER_HOST buckets instead of one process per bucket,
+# route with: router.py --bucket-num $NUM --buckets-per-host $PER_HOST
+NUM=100
+PER_HOST=25
+PORT=5555
+
+
+command rm -vf pid.info
+
+for first in `seq 0 $PER_HOST $((NUM-1))`
+do
+    last=$((first+PER_HOST-1))
+    ((last>NUM-1)) && last=$((NUM-1))
+    python worker.py --port $PORT --buckets $first-$last &> host-$first.log&
+    echo $! >> pid.info
+    ((PORT+=1))
+done
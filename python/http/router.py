@@ -1,15 +1,35 @@
 import asyncio
 import argparse
-import heapq
 # import json
 import orjson as json
+import os
 import sys
 import time
 import logging
+import multiprocessing
 
 from collections import defaultdict
+from queue import Empty, Full
 
 import aiohttp
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import balance  # noqa: E402
+from common import batch  # noqa: E402
+from common import cache  # noqa: E402
+from common import checkpoint  # noqa: E402
+from common import directory  # noqa: E402
+from common import framing  # noqa: E402
+from common import hashring  # noqa: E402
+from common import latency  # noqa: E402
+from common import options  # noqa: E402
+from common import placement  # noqa: E402
+from common import routing  # noqa: E402
+from common import shmring  # noqa: E402
+from common import sink  # noqa: E402
+from common import trace  # noqa: E402
+from common import workerstats  # noqa: E402
 
 
 logger = logging.getLogger(__name__)
@@ -22,18 +42,22 @@ logger.addHandler(handler)
 level = "INFO"
 logger.setLevel(level)
 
+# Messages dumped per json chunk of a streamed upload
+STREAM_ROWS = 16384
+RESULT_CHUNK = 1 << 20
+# Seconds between liveness checks of the router shards
+SHARD_POLL = 1.0
 
+# Functions every stage runs in, for --profile
+PROFILE_STAGES = {
+    "parse": "parse_block",
+    "place": "route_batch|group_rows",
+    "serialize": "iter_body|json_body",
+    "deserialize": "split_result|decode_acks|decode_json",
+    "output": "write_output",
+}
 
 
-class BucketStatus:
-
-    def __init__(self, bucket_id, used_bytes):
-        self._bucket_id = bucket_id
-        self._used_bytes = used_bytes
-
-    def __lt__(self, other):
-        return self._used_bytes < other._used_bytes
-
 
 
 def create_parser():
@@ -41,141 +65,831 @@ def create_parser():
     parser.add_argument("--start-port", default=5555, type=int)
     parser.add_argument("--data", default="data.txt")
     parser.add_argument("--bucket-num", default=1, type=int)
+    parser.add_argument("--batch-format", default="json", choices=["json", "binary"])
+    parser.add_argument("--batch-mode", default="mixed", choices=["mixed", "split"])
+    parser.add_argument("--block-size", default=trace.BLOCK_SIZE, type=int)
+    options.add_router_arguments(parser)
+    parser.add_argument("--shards", default=1, type=int)
+    parser.add_argument("--dispatch", default="credit", choices=["credit", "barrier"])
+    parser.add_argument("--flush-messages", default=500000, type=int, help="Lines routed per flush")
+    parser.add_argument("--window", default=4, type=int, help="Batches in flight per bucket")
+    parser.add_argument("--window-messages", default=500000, type=int, help="Messages in flight per bucket")
+    parser.add_argument("--queue-size", default=4, type=int, help="Batches queued per bucket")
+    parser.add_argument("--transport", default="http", choices=["http", "tcp", "unix", "shm"], help="tcp, unix and shm need raw/worker.py")
+    parser.add_argument("--socket-dir", default="/tmp", help="Where raw workers listen with --transport unix or shm")
+    parser.add_argument(
+        "--buckets-per-host", default=0, type=int,
+        help="Buckets of every worker host started with --buckets, on consecutive ports from --start-port",
+    )
+    parser.add_argument("--connections", default=8, type=int, help="Connections kept open per worker")
+    parser.add_argument("--keepalive", default=60.0, type=float, help="Seconds an idle connection stays open")
+    parser.add_argument(
+        "--implicit-acks", action="store_true",
+        help="Ask workers to acknowledge writes by count, the router writes their result lines",
+    )
+    parser.add_argument("--wait-ready", default=0.0, type=float, help="Seconds to wait for every worker's /v1/ready")
+    parser.add_argument("--worker-stats", action="store_true", help="Log every worker's /v1/stats at the end")
+    parser.add_argument("--checkpoint-dir", default=None, help="Checkpoint the routing state here")
+    parser.add_argument(
+        "--checkpoint-interval", default=checkpoint.INTERVAL, type=float, help="Seconds between checkpoints"
+    )
+    parser.add_argument("--resume", action="store_true", help="Resume from the latest checkpoint of --checkpoint-dir")
+    parser.add_argument(
+        "--stage-stats", action="store_true",
+        help="Histograms of parse, place, serialize, rtt, deserialize and output, logged every --stats-interval",
+    )
+    parser.add_argument("--stats-interval", default=10.0, type=float, help="Seconds between stage summaries")
+    parser.add_argument("--stats-json", default=None, help="Dump the stage histograms here, implies --stage-stats")
+    parser.add_argument(
+        "--profile", default=None,
+        help="cProfile the router process into this file and log seconds per stage, implies --stage-stats. "
+        "With --shards every shard profiles into <file>.<shard id>",
+    )
     return parser
 
 
-def init_bucket(args):
-    buckets = []
+def init_bucket(args, bucket_ids=None):
     urls = []
+    if bucket_ids is None:
+        bucket_ids = range(args.bucket_num)
+    if args.routing == "directory":
+        buckets = placement.STRATEGIES[args.placement](bucket_ids)
+    else:
+        # Every shard hashes over all buckets, it only gets the objects of its own
+        buckets = hashring.create(
+            args.routing, range(args.bucket_num), args.hash_weights, args.vnodes, args.compare_balance
+        )
     for bucket_id in range(args.bucket_num):
-        buckets.append(BucketStatus(bucket_id, 0))
-        port = args.start_port + bucket_id
-        address = f"http://localhost:{port}/v1/messages"
+        if args.buckets_per_host:
+            port = args.start_port + bucket_id // args.buckets_per_host
+            address = f"http://localhost:{port}/v1/buckets/{bucket_id}/messages"
+        else:
+            port = args.start_port + bucket_id
+            address = f"http://localhost:{port}/v1/messages"
         logger.info(f"Worker address for {bucket_id}: {address}")
         urls.append(address)
     return buckets, urls
 
 
-def push_to_bucket(message, buckets, meta_info):
-    bucket = heapq.heappop(buckets)
-    bucket._used_bytes += message["size"]
-    heapq.heappush(buckets, bucket)
-    meta_info[message["object_id"]] = bucket._bucket_id
-    return bucket._bucket_id
+
+def worker_hosts(urls):
+    """Base url of every worker process, a host serves several buckets."""
+    return list(dict.fromkeys(url.split("/v1/", 1)[0] for url in urls))
+
+
+async def wait_ready(urls, session, timeout):
+    deadline = time.time() + timeout
+    for host in worker_hosts(urls):
+        while True:
+            try:
+                async with session.get(f"{host}/v1/ready") as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            if time.time() > deadline:
+                raise TimeoutError(f"Worker {host} not ready after {timeout}s")
+            await asyncio.sleep(0.1)
+
+
+async def log_worker_stats(urls, session):
+    for host in worker_hosts(urls):
+        try:
+            async with session.get(f"{host}/v1/stats") as response:
+                report = await response.json()
+        except (aiohttp.ClientError, ValueError) as e:
+            logger.warning(f"Worker {host} stats: {e}")
+            continue
+        logger.info(f"Worker {host}: {workerstats.format_report(report)}")
+
+
+async def negotiate_formats(urls, session, args):
+    """Probe every worker with an empty columnar batch, fall back to json
+    for workers which do not answer in the columnar result format."""
+    formats = ["json"] * len(urls)
+    if args.batch_format == "json":
+        return formats
+    message = batch.encode_batch("W", [], [], [])
+    headers = {"Content-Type": batch.CONTENT_TYPE}
+    for bucket_id, url in enumerate(urls):
+        async with session.post(f"{url}/c", data=message, headers=headers) as response:
+            await response.read()
+            if response.status == 200 and response.content_type == batch.RESULT_CONTENT_TYPE:
+                formats[bucket_id] = "binary"
+            else:
+                logger.warning(f"Worker {bucket_id} does not support columnar batch, use json")
+    return formats
+
+
+async def negotiate_modes(urls, session, args, formats):
+    """Probe every worker for the mixed batch endpoint, workers without it
+    get the writes and then the reads of a mixed batch as two requests."""
+    modes = ["split"] * len(urls)
+    if args.batch_mode == "split":
+        return modes
+    for bucket_id, url in enumerate(urls):
+        if formats[bucket_id] == "binary":
+            message = batch.encode_batch(batch.MIXED, [], [], [], b"")
+            headers = {"Content-Type": batch.CONTENT_TYPE}
+        else:
+            message = json.dumps({"messages": []})
+            headers = {"Content-Type": batch.JSON_CONTENT_TYPE}
+        async with session.post(f"{url}/m", data=message, headers=headers) as response:
+            await response.read()
+            if response.status == 200:
+                modes[bucket_id] = "mixed"
+            else:
+                logger.warning(f"Worker {bucket_id} does not support mixed batch, split it")
+    return modes
+
+
+result_sink = None
+implicit_acks = False
+stages = latency.NO_STAGES
+# bucket id: [answered batches, last request id of them]
+acked = {}
+
+def write_output(result, bucket_id=None):
+    start = stages.start()
+    result_sink.write(result, bucket_id)
+    stages.record("output", start)
+
+
+def skip_output(request_ids):
+    result_sink.skip(request_ids)
+
+
+def decode_acks(trace_batch, action, body, bucket_id):
+    """Result lines of the acknowledged writes of ``trace_batch`` and the
+    lines of its reads, which came with the ack."""
+    writes, worker_id, lines = batch.decode_ack(body)
+    if action == "W":
+        request_ids = trace_batch.request_ids
+    elif action == "R":
+        request_ids = trace_batch.request_ids[:0]
+    else:
+        request_ids = trace_batch.request_ids[trace_batch.writes()]
+    if writes != len(request_ids):
+        raise batch.BatchError(f"Worker {bucket_id} acked {writes} writes, sent {len(request_ids)}")
+    return sink.ack_lines(request_ids, worker_id), lines
+
+
+def decode_json(body):
+    return "\n".join(json.loads(body)["result"]).encode()
+
+
+class Utilisation:
+    """Time every worker had at least one batch in flight, and the latency
+    of every batch."""
+
+    def __init__(self):
+        self._inflight = defaultdict(int)
+        self._since = {}
+        self.busy = defaultdict(float)
+        self.requests = 0
+        self.latencies = latency.Latencies()
+
+    def begin(self, bucket_id):
+        self.requests += 1
+        if not self._inflight[bucket_id]:
+            self._since[bucket_id] = time.time()
+        self._inflight[bucket_id] += 1
+        return self.latencies.start()
+
+    def end(self, bucket_id, start):
+        self.latencies.record(start)
+        self._inflight[bucket_id] -= 1
+        if not self._inflight[bucket_id]:
+            self.busy[bucket_id] += time.time() - self._since.pop(bucket_id)
+
+    def summary(self, bucket_ids, elapsed):
+        ratios = [self.busy[bucket_id] / elapsed for bucket_id in bucket_ids]
+        return f"mean {sum(ratios) / len(ratios):.0%}, min {min(ratios):.0%}, max {max(ratios):.0%}"
 
 
-async def handle_request(bucket_id, urls, message, session, action):
-    message = {"messages": message}
-    o = message
+def json_body(message):
+    """Parts of ``{"messages": [...]}``, ``STREAM_ROWS`` messages each."""
+    yield b'{"messages":['
+    for start in range(0, len(message), STREAM_ROWS):
+        if start:
+            yield b","
+        rows = np.arange(start, min(start + STREAM_ROWS, len(message)))
+        yield json.dumps(message.take(rows).to_messages())[1:-1]
+    yield b"]}"
+
+
+async def stream_body(parts):
+    # Chunked upload, a part is encoded once the one before it is sent
+    for part in stages.timed("serialize", parts):
+        yield part
+
+
+def split_result(tail, chunk):
+    """``(lines, tail)`` of a result chunk, ``lines`` runs up to its last
+    newline and is None without one."""
+    cut = chunk.rfind(b"\n")
+    if cut < 0:
+        return None, tail + chunk
+    lines = memoryview(chunk)[:cut]
+    return tail + lines if tail else lines, chunk[cut + 1:]
+
+
+async def stream_output(response, bucket_id):
+    """Hand the result lines over as they arrive, up to the last newline
+    of every chunk. Waiting for a chunk is not part of the deserialize
+    stage."""
+    tail = b""
+    async for chunk in response.content.iter_chunked(RESULT_CHUNK):
+        start = stages.start()
+        lines, tail = split_result(tail, chunk)
+        stages.record("deserialize", start)
+        if lines is not None:
+            write_output(lines, bucket_id)
+    write_output(tail, bucket_id)
+
+
+async def post_batch(bucket_id, urls, message, session, action, formats, stats):
+    o = len(message)
+    request_ids = message.request_ids
+    trace_batch = message
     # logger.debug(f"Send message: {message}")
     logger.debug(f"Send finish for {bucket_id}")
-    message = json.dumps(message)
-    attr = {"R": "r", "W": "c"}
+    if formats[bucket_id] == "binary":
+        message = stream_body(trace.iter_body(action, message))
+        headers = {"Content-Type": batch.CONTENT_TYPE}
+        if implicit_acks:
+            headers["Accept"] = batch.ACK_CONTENT_TYPE
+    else:
+        message = stream_body(json_body(message))
+        headers = {"Content-Type": batch.JSON_CONTENT_TYPE}
+    attr = {"R": "r", "W": "c", batch.MIXED: "m"}
     url = f"{urls[bucket_id]}/{attr[action]}"
-    async with getattr(session, "post")(url, data=message) as response:
-        if response.status != 200:
-            print(
-                f"FATAL = {response.status}, message={o}",
-                await response.read(),
-                file=sys.stderr
-            )
-            return
-        try:
-            result = await response.json()
-            print("\n".join(result["result"]))
-        except:
-            print(await response.read(), file=sys.stderr)
-        # sys.stdout.flush()
+    start = stats.begin(bucket_id)
+    try:
+        async with getattr(session, "post")(url, data=message, headers=headers) as response:
+            stages.record("rtt", start)
+            stages.record(f"rtt/{bucket_id}", start)
+            if response.status != 200:
+                print(
+                    f"FATAL = {response.status}, messages={o}",
+                    await response.read(),
+                    file=sys.stderr
+                )
+                skip_output(request_ids)
+                return
+            if response.content_type == batch.RESULT_CONTENT_TYPE:
+                await stream_output(response, bucket_id)
+                return
+            if response.content_type == batch.ACK_CONTENT_TYPE:
+                body = await response.read()
+                try:
+                    decoding = stages.start()
+                    acked, lines = decode_acks(trace_batch, action, body, bucket_id)
+                    stages.record("deserialize", decoding)
+                    write_output(acked, bucket_id)
+                    write_output(lines, bucket_id)
+                except batch.BatchError as e:
+                    print(f"FATAL = {e}, messages={o}", file=sys.stderr)
+                    skip_output(request_ids)
+                return
+            body = await response.read()
+            try:
+                decoding = stages.start()
+                lines = decode_json(body)
+                stages.record("deserialize", decoding)
+                write_output(lines, bucket_id)
+            except:
+                print(body, file=sys.stderr)
+                skip_output(request_ids)
+            # sys.stdout.flush()
+    finally:
+        stats.end(bucket_id, start)
+
 
+async def handle_request(bucket_id, urls, message, session, action, formats, modes, stats):
+    message = trace.TraceBatch.concat(message)
+    if action == batch.MIXED and modes[bucket_id] == "split":
+        # Writes first keeps every read behind its write, objects are
+        # written once
+        for action, rows in (("W", message.writes()), ("R", message.reads())):
+            if len(rows):
+                await post_batch(bucket_id, urls, message.take(rows), session, action, formats, stats)
+    else:
+        await post_batch(bucket_id, urls, message, session, action, formats, stats)
+    batches = acked.get(bucket_id, (0, None))[0]
+    acked[bucket_id] = [batches + 1, int(message.request_ids[-1])]
 
-async def handle(messages, urls, session, action):
+
+async def handle(messages, urls, session, action, formats, modes, stats):
     logger.debug(f"Message bucket size: {len(messages)}")
     tasks = []
     for bucket_id, message in messages.items():
         logger.debug(f"Message content size: {len(message)}")
         if message:
-            tasks.append(handle_request(bucket_id, urls, message, session, action))
+            tasks.append(handle_request(bucket_id, urls, message, session, action, formats, modes, stats))
     await asyncio.gather(*tasks)
 
-async def main():
-    parser = create_parser()
-    args, _ = parser.parse_known_args()
-    meta_info = {}  # object_id: bucket_id
-    # cache = {}
-    buckets, urls = init_bucket(args)
-    session = aiohttp.ClientSession()
 
-    s = time.time()
-    futures = []
-    read_futures = []
-    write_futures = []
-    future_peak = 10
-    message_peak = 500000
+def flushes(batches, buckets, meta_info, message_peak, mixed, read_cache=None, reorder=None, checkpoints=None):
+    """Route the trace and yield ``[(action, messages), ...]`` every
+    ``message_peak`` lines, ``messages`` maps a bucket id to TraceBatch
+    parts. Mixed flushes hold one ``MIXED`` entry in trace order, split
+    ones the writes and then the reads. Reads ``read_cache`` answers are
+    written out right away. With ``reorder`` a trace batch beyond its
+    window first yields what is routed so far, possibly nothing, until
+    the dispatcher waited for room. A due checkpoint yields what is
+    routed so far before the next trace batch, the dispatcher saves it
+    once that is answered."""
     message_count = 0
+    messages = defaultdict(list)
     read_messages = defaultdict(list)
     write_messages = defaultdict(list)
-    logger.info("Start to ingesting file")
-    with open(args.data) as reader:
-        counter = 0
-        for line in reader:
-            counter += 1
-            if counter % 1000000 == 0:
-                logger.info(f"Processed to {counter}")
-                sys.stdout.flush()
-            body = {}
-            line = line.strip().split(",")
-            body["request_id"] = line[0]
-            body["action"] = line[1]
-            body["object_id"] = line[2]
-            object_id = line[2]
-            if len(line) > 3:
-                body["size"] = int(line[3])
-                body["hash"] = line[4]
-            if body["action"] == "W":
-                bucket_id = push_to_bucket(body, buckets, meta_info)
-                write_messages[bucket_id].append(body)
-            else:
-                bucket_id = meta_info[object_id]
-                read_messages[bucket_id].append(body)
-            message_count += 1
-            if message_count == message_peak:
-                if read_messages:
-                    read_futures.append(handle(read_messages, urls, session, "R"))
-                if write_messages:
-                    write_futures.append(handle(write_messages, urls, session, "W"))
-                read_messages = defaultdict(list)
-                write_messages = defaultdict(list)
-                message_count = 0
-                if len(read_futures) + len(write_futures) == future_peak:
-                    logger.debug(f"Fetching data: {len(futures)}")
-                    if write_futures:
-                        await asyncio.gather(*write_futures)
-                    if read_futures:
-                        await asyncio.gather(*read_futures)
-                    read_futures = []
-                    write_futures = []
-    if message_count:
-        if read_messages:
-            read_futures.append(handle(read_messages, urls, session, "R"))
-        if write_messages:
-            write_futures.append(handle(write_messages, urls, session, "W"))
+    counter = 0
+
+    def pending():
+        nonlocal message_count, messages, read_messages, write_messages
+        if mixed:
+            flush = [(batch.MIXED, messages)]
+        else:
+            flush = [("W", write_messages), ("R", read_messages)]
+        messages = defaultdict(list)
         read_messages = defaultdict(list)
         write_messages = defaultdict(list)
         message_count = 0
-    if write_futures:
-        await asyncio.gather(*write_futures)
-        write_futures = []
-    if read_futures:
-        await asyncio.gather(*read_futures)
+        return flush
+
+    for trace_batch in batches:
+        if checkpoints is not None and checkpoints.due():
+            yield pending()
+        while reorder is not None and not reorder.fits(trace_batch.request_ids):
+            yield pending()
+        start = stages.start()
+        bucket_ids = routing.route_batch(trace_batch, buckets, meta_info)
+        counter += len(trace_batch)
+        if counter // 1000000 != (counter - len(trace_batch)) // 1000000:
+            logger.info(f"Processed to {counter}")
+            sys.stdout.flush()
+        if read_cache is not None:
+            rows, lines = read_cache.apply(trace_batch)
+            write_output(b"\n".join(lines))
+            trace_batch = trace_batch.take(rows)
+            bucket_ids = bucket_ids[rows]
+        if mixed:
+            for bucket_id, rows in trace.group_rows(bucket_ids):
+                messages[bucket_id].append(trace_batch.take(rows))
+        else:
+            for bucket_id, rows in trace.group_rows(bucket_ids, trace_batch.writes()):
+                write_messages[bucket_id].append(trace_batch.take(rows))
+            for bucket_id, rows in trace.group_rows(bucket_ids, trace_batch.reads()):
+                read_messages[bucket_id].append(trace_batch.take(rows))
+        stages.record("place", start)
+        message_count += len(trace_batch)
+        if message_count >= message_peak:
+            yield pending()
+    if message_count:
+        yield pending()
+
+
+async def handle_ordered(flushes, urls, session, formats, modes, stats):
+    """Send the mixed batches of several flushes, each bucket gets its
+    batches one after the other so reads never overtake their writes."""
+    per_bucket = defaultdict(list)
+    for messages in flushes:
+        for bucket_id, message in messages.items():
+            per_bucket[bucket_id].append(message)
+
+    async def send(bucket_id, messages):
+        for message in messages:
+            await handle_request(bucket_id, urls, message, session, batch.MIXED, formats, modes, stats)
+
+    await asyncio.gather(*(send(bucket_id, messages) for bucket_id, messages in per_bucket.items()))
+
+
+def save_checkpoint(checkpoints):
+    state, paused = checkpoints.save(result_sink, acked)
+    logger.info(f"Checkpoint {state['number']} at byte {state['offset']}, line {state['lines']}: waited {paused * 1000:.0f} ms")
+
+
+async def dispatch_barrier(args, flushed, urls, session, formats, modes, stats, reorder=None, checkpoints=None):
+    """Pile up flushes, then await all their writes and then all their
+    reads, or all their mixed batches."""
+    read_futures = []
+    write_futures = []
+    mixed = []
+    future_peak = 10
+
+    async def fetch():
+        nonlocal read_futures, write_futures, mixed
+        logger.debug(f"Fetching data: {len(read_futures) + len(write_futures) + len(mixed)}")
+        if write_futures:
+            await asyncio.gather(*write_futures)
+        if read_futures:
+            await asyncio.gather(*read_futures)
+        if mixed:
+            await handle_ordered(mixed, urls, session, formats, modes, stats)
         read_futures = []
-    e = time.time()
-    for status in buckets:
-        logger.info(f"{status._bucket_id} = {status._used_bytes} bytes")
-    logger.info(f"Time cost: {e - s}")
+        write_futures = []
+        mixed = []
+
+    for flush in flushed:
+        for action, messages in flush:
+            if not messages:
+                continue
+            if action == batch.MIXED:
+                mixed.append(messages)
+            elif action == "W":
+                write_futures.append(handle(messages, urls, session, action, formats, modes, stats))
+            else:
+                read_futures.append(handle(messages, urls, session, action, formats, modes, stats))
+        # Piled up flushes only start on fetch, the window cannot move before
+        if len(read_futures) + len(write_futures) + len(mixed) >= future_peak or (reorder and reorder.blocked):
+            await fetch()
+        if reorder is not None:
+            await reorder.wait()
+        # A slow output holds the parser back
+        await result_sink.drain()
+        if checkpoints is not None and checkpoints.requested:
+            await fetch()
+            save_checkpoint(checkpoints)
+    await fetch()
+
+
+class BucketSender:
+    """Sends the batches of one bucket in queue order with at most
+    ``window`` batches and ``window_messages`` messages in flight. A batch
+    with reads waits while a batch in flight writes one of the objects it
+    reads, which keeps every read behind its write."""
+
+    def __init__(self, bucket_id, args, urls, session, formats, modes, stats):
+        self.bucket_id = bucket_id
+        self.queue = asyncio.Queue(args.queue_size)
+        self._window = args.window
+        self._window_messages = args.window_messages
+        self._request = (urls, session, formats, modes, stats)
+        self._inflight = 0
+        self._messages = 0
+        # Batches put and not answered yet
+        self._queued = 0
+        # Object id digests written by every batch in flight
+        self._written = {}
+        self._changed = asyncio.Condition()
+        self._tasks = set()
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, item):
+        self._queued += 1
+        await self.queue.put(item)
+
+    async def drain(self):
+        """Wait until every batch put so far is answered."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self._queued)
+
+    def _has_credit(self, count):
+        if self._inflight >= self._window:
+            return False
+        # A batch larger than the window still goes out alone
+        return not self._inflight or self._messages + count <= self._window_messages
+
+    def _can_read(self, digests):
+        return not any(np.isin(digests, written).any() for written in self._written.values())
+
+    async def run(self):
+        sequence = 0
+        while (item := await self.queue.get()) is not None:
+            action, message = item
+            message = trace.TraceBatch.concat(message)
+            digests = message.object_ids.digest()
+            reads = digests[message.reads()]
+            async with self._changed:
+                if len(reads):
+                    await self._changed.wait_for(lambda: self._can_read(reads))
+                await self._changed.wait_for(lambda: self._has_credit(len(message)))
+                self._inflight += 1
+                self._messages += len(message)
+                sequence += 1
+                if action != "R":
+                    self._written[sequence] = digests[message.writes()]
+            task = asyncio.create_task(self._send(sequence, action, message))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        await asyncio.gather(*self._tasks)
+
+    async def _send(self, sequence, action, message):
+        urls, session, formats, modes, stats = self._request
+        try:
+            await handle_request(self.bucket_id, urls, [message], session, action, formats, modes, stats)
+        finally:
+            async with self._changed:
+                self._inflight -= 1
+                self._messages -= len(message)
+                self._queued -= 1
+                self._written.pop(sequence, None)
+                self._changed.notify_all()
+
+
+async def dispatch_credit(args, flushed, urls, session, formats, modes, stats, reorder=None, checkpoints=None):
+    """Feed per bucket send queues, a full queue or a full reorder window
+    stalls the parser. A checkpoint waits for every queue to drain."""
+    senders = {}
+    for flush in flushed:
+        for action, messages in flush:
+            for bucket_id, message in messages.items():
+                if bucket_id not in senders:
+                    senders[bucket_id] = BucketSender(bucket_id, args, urls, session, formats, modes, stats)
+                await senders[bucket_id].put((action, message))
+        # Let the senders start on this flush before parsing the next one
+        await asyncio.sleep(0)
+        if reorder is not None:
+            await reorder.wait()
+        # A slow output holds the parser back
+        await result_sink.drain()
+        if checkpoints is not None and checkpoints.requested:
+            await asyncio.gather(*(sender.drain() for sender in senders.values()))
+            save_checkpoint(checkpoints)
+    for sender in senders.values():
+        await sender.queue.put(None)
+    await asyncio.gather(*(sender.task for sender in senders.values()))
+
+
+async def report_stages(interval):
+    while True:
+        await asyncio.sleep(interval)
+        for line in stages.format_lines():
+            logger.info(f"Stage {line}")
+
+
+async def run(args, batches, buckets, urls, shard_id=0, resumed=None):
+    """Route ``batches``, ``(end, batch)`` pairs with --checkpoint-dir.
+    ``resumed`` is the checkpoint state and directory to go on from."""
+    global result_sink, implicit_acks, stages
+    implicit_acks = args.implicit_acks
+    if args.stage_stats:
+        stages = latency.Stages()
+    state, meta_info = resumed or (None, None)
+    if args.routing == "directory" and meta_info is None:
+        meta_info = directory.Directory()  # object_id digest: bucket_id
+    if state is not None:
+        checkpoint.restore_used(buckets, state["used_bytes"])
+        acked.update((int(bucket_id), entry) for bucket_id, entry in state["acked"].items())
+        logger.info(f"Resume checkpoint {state['number']} at byte {state['offset']}, line {state['lines']}")
+    result_sink = sink.ResultSink(
+        buffer_bytes=args.sink_buffer,
+        output_dir=args.output_dir,
+        router_file=f"router-{shard_id}.out",
+        # Resuming without a checkpoint starts the output over as well
+        resume=({} if args.resume else None) if state is None else state["output"],
+    )
+    if state is not None and args.output_dir is None and not result_sink.resumed:
+        logger.warning(f"stdout does not hold the output resumed, keep the first {state['output'].get('-', 0)} bytes of it")
+    reorder = None
+    if args.ordered_output:
+        start = 0 if state is None else state["request_id"]
+        result_sink = reorder = sink.ReorderBuffer(result_sink, args.reorder_window, start)
+    checkpoints = None
+    if args.checkpoint_dir:
+        checkpoints = checkpoint.Checkpoints(
+            args.checkpoint_dir,
+            meta_info,
+            buckets,
+            args.checkpoint_interval,
+            state,
+            data_bytes=os.path.getsize(args.data),
+            bucket_num=args.bucket_num,
+            routing=args.routing,
+        )
+    # cache = {}
+    if args.transport == "http":
+        connector = aiohttp.TCPConnector(
+            limit=args.connections * args.bucket_num,
+            limit_per_host=args.connections * max(args.buckets_per_host, 1),
+            keepalive_timeout=args.keepalive,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+    elif args.transport == "shm":
+        session = shmring.ShmSession(args.socket_dir)
+    else:
+        session = framing.RawSession(args.transport, args.socket_dir)
+    if args.wait_ready:
+        await wait_ready(urls, session, args.wait_ready)
+    formats = await negotiate_formats(urls, session, args)
+    modes = await negotiate_modes(urls, session, args, formats)
+
+    stats = Utilisation()
+    lines = 0
+
+    def counted():
+        nonlocal lines
+        offset, before = (0, 0) if state is None else (state["offset"], state["lines"])
+        for trace_batch in stages.timed("parse", batches):
+            if checkpoints is not None:
+                end, trace_batch = trace_batch
+                checkpoints.advance(offset, int(trace_batch.request_ids[0]), before + lines)
+                offset = end
+            lines += len(trace_batch)
+            yield trace_batch
+
+    logger.info("Start to ingesting file")
+    s = time.time()
+    read_cache = None
+    if args.cache_bytes:
+        read_cache = cache.ReadCache(args.cache_bytes, args.cache_policy)
+    flushed = flushes(
+        counted(), buckets, meta_info, args.flush_messages, args.batch_mode == "mixed", read_cache, reorder, checkpoints
+    )
+    reporter = asyncio.create_task(report_stages(args.stats_interval)) if args.stage_stats else None
+    if args.dispatch == "barrier":
+        await dispatch_barrier(args, flushed, urls, session, formats, modes, stats, reorder, checkpoints)
+    else:
+        await dispatch_credit(args, flushed, urls, session, formats, modes, stats, reorder, checkpoints)
+    elapsed = time.time() - s
+    if reporter is not None:
+        reporter.cancel()
+    if checkpoints is not None:
+        checkpoints.close()
+        logger.info(f"Checkpoints: {checkpoints.saved}, the parser waited {checkpoints.paused:.3f}s for them")
+    if meta_info is not None:
+        logger.info(f"Directory: {len(meta_info)} objects, {meta_info.nbytes} bytes, {meta_info.bytes_per_entry():.1f} bytes/entry")
+    elif args.shards == 1:
+        logger.info(f"Routing {args.routing}: {buckets.summary()}")
+    logger.info(f"Dispatch {args.dispatch}, {args.batch_mode} batches: {lines / elapsed:.0f} lines/s, {stats.requests} requests")
+    bucket_ids = [bucket_id for bucket_id in buckets.used_bytes() if bucket_id % args.shards == shard_id]
+    logger.info(f"Worker utilisation: {stats.summary(bucket_ids, elapsed)}")
+    logger.info(f"Batch latency: {latency.format_summary(stats.latencies.summarize())}")
+    if read_cache is not None:
+        logger.info(f"Read cache: {read_cache.summary()}")
+    result_sink.close()
+    logger.info(f"Results: {result_sink.nbytes} bytes")
+    if args.stage_stats:
+        for line in stages.format_lines():
+            logger.info(f"Stage {line}")
+    if args.stats_json:
+        path = args.stats_json if args.shards == 1 else f"{args.stats_json}.{shard_id}"
+        stages.dump(path, lines=lines, seconds=elapsed, shard_id=shard_id)
+        logger.info(f"Stage histograms: {path}")
+    if args.worker_stats:
+        await log_worker_stats(urls, session)
     await session.close()
 
 
-if __name__ == '__main__':
-    sys.exit(asyncio.run(main()))
+class ShardError(Exception):
+    pass
+
+
+def check_shards(shards):
+    for shard_id, shard in enumerate(shards):
+        if shard.exitcode not in (None, 0):
+            raise ShardError(f"Router shard {shard_id} exited with {shard.exitcode}")
+
+
+def put_checked(queue, item, shards):
+    """``queue.put`` that gives up when a shard fails instead of waiting
+    for it forever."""
+    while True:
+        try:
+            return queue.put(item, timeout=SHARD_POLL)
+        except Full:
+            check_shards(shards)
+
+
+def get_checked(queue, shards):
+    while True:
+        try:
+            return queue.get(timeout=SHARD_POLL)
+        except Empty:
+            check_shards(shards)
+
+
+def split_trace(args, queues, processes):
+    """Front splitter: send every row to the shard owning its object id,
+    returns the write sizes for the balance comparison."""
+    shards = len(queues)
+    sizes = []
+    ring = None
+    if args.routing != "directory":
+        ring = hashring.create(args.routing, range(args.bucket_num), args.hash_weights, args.vnodes)
+    for trace_batch in trace.read_batches(args.data, args.block_size):
+        shard_ids = trace_batch.object_ids.digest()
+        if ring is not None:
+            # To the shard owning the bucket of the object
+            shard_ids = ring.lookup(shard_ids)
+        shard_ids = shard_ids % shards
+        for shard_id, rows in trace.group_rows(shard_ids):
+            put_checked(queues[shard_id], trace_batch.take(rows), processes)
+        if args.compare_balance:
+            sizes.extend(trace_batch.sizes[trace_batch.writes()].tolist())
+    for queue in queues:
+        put_checked(queue, None, processes)
+    return sizes
+
 
+def log_profile(profile, path):
+    for stage, seconds in latency.profile_stages(profile, PROFILE_STAGES).items():
+        logger.info(f"Profile {stage} ({path}): {seconds:.3f}s")
+    logger.info(f"Profile {path}:\n{latency.top_functions(profile)}")
 
+
+def run_shard(args, shard_id, queue, reports):
+    logger.info(f"Start router shard {shard_id}")
+
+    def batches():
+        while (trace_batch := queue.get()) is not None:
+            yield trace_batch
+
+    # Shard i owns buckets i, i + shards, ... and places writes on them
+    buckets, urls = init_bucket(args, range(shard_id, args.bucket_num, args.shards))
+    path = args.profile and f"{args.profile}.{shard_id}"
+    with latency.profiled(path) as profile:
+        asyncio.run(run(args, batches(), buckets, urls, shard_id))
+    if profile is not None:
+        log_profile(profile, path)
+    used_bytes = buckets.used_bytes()
+    reports.put({bucket_id: used_bytes[bucket_id] for bucket_id in range(shard_id, args.bucket_num, args.shards)})
+
+
+def run_sharded(args):
+    queues = [multiprocessing.Queue(maxsize=4) for _ in range(args.shards)]
+    reports = multiprocessing.Queue()
+    shards = [
+        multiprocessing.Process(target=run_shard, args=(args, shard_id, queue, reports))
+        for shard_id, queue in enumerate(queues)
+    ]
+    for shard in shards:
+        shard.start()
+    try:
+        sizes = split_trace(args, queues, shards)
+        used_bytes = {}
+        for _ in shards:
+            used_bytes.update(get_checked(reports, shards))
+        for shard in shards:
+            shard.join()
+        check_shards(shards)
+    except ShardError as e:
+        logger.error(f"{e}, stop the other shards")
+        for shard in shards:
+            shard.terminate()
+        for queue in queues:
+            # Batches no shard will read, do not wait for them at exit
+            queue.cancel_join_thread()
+        return 1
+    for bucket_id in sorted(used_bytes):
+        logger.info(f"{bucket_id} = {used_bytes[bucket_id]} bytes")
+    summary = balance.summarize(used_bytes.values())
+    logger.info(f"Sharded balance ({args.shards} shards): {balance.format_summary(summary)}")
+    if args.compare_balance:
+        summary = balance.summarize(balance.global_heap(sizes, args.bucket_num))
+        logger.info(f"Global heap balance: {balance.format_summary(summary)}")
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    if not 1 <= args.shards <= args.bucket_num:
+        parser.error("--shards must be between 1 and --bucket-num")
+    if args.hash_weights is not None and len(args.hash_weights) != args.bucket_num:
+        parser.error("--hash-weights needs one weight per bucket")
+    if args.transport != "http" and args.buckets_per_host:
+        parser.error("--buckets-per-host needs --transport http")
+    if args.transport != "http" and (args.wait_ready or args.worker_stats):
+        parser.error("--wait-ready and --worker-stats need --transport http")
+    if args.transport != "http" and args.batch_format != "binary":
+        parser.error(f"--transport {args.transport} needs --batch-format binary")
+    if args.ordered_output and args.shards > 1:
+        parser.error("--ordered-output needs a single router shard")
+    if args.checkpoint_dir and args.shards > 1:
+        parser.error("--checkpoint-dir needs a single router shard")
+    if args.resume and not args.checkpoint_dir:
+        parser.error("--resume needs --checkpoint-dir")
+    resumed = None
+    if args.resume:
+        resumed = checkpoint.load(args.checkpoint_dir)
+        state = resumed[0]
+        if state is None:
+            logger.warning(f"No checkpoint in {args.checkpoint_dir}, start from the beginning")
+            resumed = None
+        elif state["data_bytes"] != os.path.getsize(args.data):
+            parser.error(f"--data has {os.path.getsize(args.data)} bytes, the checkpoint {state['data_bytes']}")
+        elif (state["bucket_num"], state["routing"]) != (args.bucket_num, args.routing):
+            parser.error(f"The checkpoint routes over {state['bucket_num']} buckets by {state['routing']}")
+    args.stage_stats = args.stage_stats or bool(args.stats_json or args.profile)
+    s = time.time()
+    with latency.profiled(args.profile) as profile:
+        if args.shards > 1:
+            if run_sharded(args):
+                return 1
+        else:
+            buckets, urls = init_bucket(args)
+            start = 0 if resumed is None else resumed[0]["offset"]
+            batches = trace.read_batches(args.data, args.block_size, start, offsets=bool(args.checkpoint_dir))
+            asyncio.run(run(args, batches, buckets, urls, resumed=resumed))
+            for bucket_id, used_bytes in buckets.used_bytes().items():
+                logger.info(f"{bucket_id} = {used_bytes} bytes")
+    e = time.time()
+    logger.info(f"Time cost: {e - s}")
+    if profile is not None:
+        # With --shards this is the trace split, the shards log their own
+        log_profile(profile, args.profile)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,21 @@ import argparse
 import asyncio
 import logging
 import orjson as json
+import os
 import sys
+import time
 
 from tornado.web import Application
+from tornado.web import HTTPError
 from tornado.web import RequestHandler
 from tornado.ioloop import IOLoop
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import batch  # noqa: E402
+from common import columnar  # noqa: E402
+from common import store as object_store  # noqa: E402
+from common import wal  # noqa: E402
+from common import workerstats  # noqa: E402
 
 
 logger = logging.getLogger(__name__)
@@ -22,67 +31,211 @@ logger.setLevel(level)
 logger.propagate = False
 
 
+def parse_buckets(text):
+    """Bucket ids of ``first-last``, both included."""
+    first, _, last = text.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
 def create_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", default="5555")
     parser.add_argument("--id", default=0)
+    parser.add_argument(
+        "--buckets", default=None, type=parse_buckets,
+        help="Serve the bucket ids first-last under /v1/buckets/<id>/messages, --id is ignored",
+    )
+    parser.add_argument("--store", default="dict", choices=sorted(object_store.STORES))
+    parser.add_argument("--wal-dir", default=None, help="Log writes here and recover from it on start")
+    parser.add_argument("--snapshot-bytes", default=wal.SNAPSHOT_BYTES, type=int)
     return parser
 
-store = {}
+
+def open_bucket(bucket_id, args, wal_dir=None):
+    s = time.time()
+    bucket = columnar.Bucket(bucket_id, args, wal_dir)
+    if wal_dir:
+        logger.info(
+            f"Bucket {bucket_id} recovered {len(bucket.store)} objects from {bucket.records} records "
+            f"in {time.time() - s:.2f}s"
+        )
+    return bucket
 
 # lock = asyncio.Lock()
 
-class Handler(RequestHandler):
-
-    def initialize(self, args):
-        self.args = args
-
-    async def post(self):
-        body = json.loads(self.request.body)
-        result = []
-        for message in body["messages"]:
-            object_id = message["object_id"]
-            # logger.info(f"Write object: {object_id}")
-            body = f"{message['request_id']},{self.args.id}"
-            # async with lock:
-            store[object_id] = message["hash"]
-            result.append(body)
-        result = {"result": result}
+
+async def logged(bucket, execute, *args):
+    """Run a batch with its commit deferred and await the group commit, so
+    the worker takes other requests while the log syncs."""
+    if bucket.log is None:
+        return execute(bucket, *args)
+    with bucket.log.deferred():
+        result = execute(bucket, *args)
+    await bucket.log.commit_async()
+    return result
+
+
+def write_json(bucket, messages):
+    # Stores hold bytes, json batches are encoded on the way in
+    object_ids = [message["object_id"].encode() for message in messages]
+    hashes = [message["hash"].encode() for message in messages]
+    if bucket.log is not None:
+        bucket.log.append(object_ids, hashes)
+    bucket.store.put_many(object_ids, hashes)
+    if bucket.log is not None:
+        bucket.log.commit()
+    worker_id = bucket.worker_id.decode()
+    return [f"{message['request_id']},{worker_id}" for message in messages]
+
+
+def read_json(bucket, messages):
+    values = bucket.store.get_many([message["object_id"].encode() for message in messages])
+    return [
+        f"{message['request_id']},{value.decode()}"
+        for message, value in zip(messages, values)
+    ]
+
+
+def execute_json(bucket, messages):
+    actions = "".join([message["action"] for message in messages]).encode()
+    object_ids = [message["object_id"].encode() for message in messages]
+    hashes = [message["hash"].encode() for message in messages if message["action"] == "W"]
+    log = bucket.log
+    if log is not None and hashes:
+        log.append(object_ids, hashes, actions)
+    values = bucket.store.execute(actions, object_ids, hashes)
+    request_ids = [message["request_id"] for message in messages]
+    result = columnar.format_results(actions, request_ids, values, bucket.worker_id)
+    if log is not None:
+        log.commit()
+    return [line.decode() for line in result]
+
+
+class ColumnarMixin:
+
+    def initialize(self, buckets, stats):
+        self.buckets = buckets
+        self.stats = stats
+
+    def prepare(self):
+        self._started = time.perf_counter()
+        # Set by the json handlers once the body is decoded
+        self.messages = 0
+
+    def on_finish(self):
+        messages = self.messages
+        if self.is_columnar():
+            try:
+                messages = batch.peek_count(self.request.body)
+            except batch.BatchError:
+                pass
+        seconds = time.perf_counter() - self._started
+        self.stats.record(self.request.path, messages, seconds, self.get_status() >= 400)
+
+    def json_messages(self):
+        messages = json.loads(self.request.body)["messages"]
+        self.messages = len(messages)
+        return messages
+
+    def bucket(self, bucket_id):
+        # A single bucket worker has its bucket under None
+        if bucket_id not in self.buckets:
+            raise HTTPError(404, f"Bucket {bucket_id} is not served here")
+        return self.buckets[bucket_id]
+
+    def is_columnar(self):
+        # Anything else is treated as the json batch for older routers
+        return self.request.headers.get("Content-Type") == batch.CONTENT_TYPE
+
+    def wants_acks(self):
+        return self.request.headers.get("Accept") == batch.ACK_CONTENT_TYPE
+
+    def finish_columnar(self, result, acks=False):
+        self.set_header("Content-Type", batch.ACK_CONTENT_TYPE if acks else batch.RESULT_CONTENT_TYPE)
         self.write(result)
 
-    async def get(self):
-        body = json.loads(self.request.body)
-        result = []
-        for message in body["messages"]:
-            object_id = message["object_id"]
-            # logger.info(f"Get object: {object_id}")
-            body = f"{message['request_id']},{store[object_id]}"
-            result.append(body)
-        result = {"result": result}
+
+class Handler(ColumnarMixin, RequestHandler):
+
+    async def post(self, bucket_id=None):
+        bucket = self.bucket(bucket_id)
+        if self.is_columnar():
+            acks = self.wants_acks()
+            self.finish_columnar(await logged(bucket, columnar.write_columnar, self.request.body, acks), acks)
+            return
+        result = {"result": await logged(bucket, write_json, self.json_messages())}
         self.write(result)
 
+    async def get(self, bucket_id=None):
+        result = {"result": read_json(self.bucket(bucket_id), self.json_messages())}
+        self.write(result)
 
-class Handler2(RequestHandler):
 
-    def initialize(self, args):
-        self.args = args
+class Handler2(ColumnarMixin, RequestHandler):
 
-    async def post(self):
-        body = json.loads(self.request.body)
-        result = []
-        for message in body["messages"]:
-            object_id = message["object_id"]
-            # logger.info(f"Get object: {object_id}")
-            body = f"{message['request_id']},{store[object_id]}"
-            result.append(body)
-        result = {"result": result}
+    async def post(self, bucket_id=None):
+        bucket = self.bucket(bucket_id)
+        if self.is_columnar():
+            self.finish_columnar(columnar.read_columnar(bucket, self.request.body))
+            return
+        result = {"result": read_json(bucket, self.json_messages())}
         self.write(result)
 
 
+class MixedHandler(ColumnarMixin, RequestHandler):
+    """Reads and writes interleaved in trace order, run in order."""
+
+    async def post(self, bucket_id=None):
+        bucket = self.bucket(bucket_id)
+        if self.is_columnar():
+            acks = self.wants_acks()
+            self.finish_columnar(await logged(bucket, columnar.execute_columnar, self.request.body, acks), acks)
+            return
+        result = {"result": await logged(bucket, execute_json, self.json_messages())}
+        self.write(result)
+
+
+class StatsHandler(RequestHandler):
+    """Objects, payload bytes, RSS, request counts and histograms."""
+
+    def initialize(self, buckets, stats):
+        self.buckets = buckets
+        self.stats = stats
 
+    def get(self):
+        stores = {bucket.worker_id.decode(): bucket.store for bucket in self.buckets.values()}
+        self.write(self.stats.report(stores))
 
-def create_application(args):
-    url_specs = [("/v1/messages/c", Handler, dict(args=args)), ("/v1/messages/r", Handler2, dict(args=args))]
+
+class ReadyHandler(RequestHandler):
+    """Answers once the buckets are recovered and the port is open."""
+
+    def initialize(self, buckets, stats):
+        self.buckets = buckets
+
+    def get(self):
+        self.write({"ready": True, "buckets": len(self.buckets)})
+
+
+def create_buckets(args):
+    """``{bucket id: Bucket}`` of a host, ``{None: Bucket}`` for --id."""
+    if args.buckets is None:
+        return {None: open_bucket(args.id, args, args.wal_dir)}
+    return {
+        str(bucket_id): open_bucket(bucket_id, args, args.wal_dir and os.path.join(args.wal_dir, str(bucket_id)))
+        for bucket_id in args.buckets
+    }
+
+
+def create_application(args, buckets, stats):
+    prefix = "/v1/messages" if args.buckets is None else r"/v1/buckets/(\d+)/messages"
+    url_specs = [
+        (f"{prefix}/c", Handler, dict(buckets=buckets, stats=stats)),
+        (f"{prefix}/r", Handler2, dict(buckets=buckets, stats=stats)),
+        (f"{prefix}/m", MixedHandler, dict(buckets=buckets, stats=stats)),
+        ("/v1/stats", StatsHandler, dict(buckets=buckets, stats=stats)),
+        ("/v1/ready", ReadyHandler, dict(buckets=buckets, stats=stats)),
+    ]
     for spec in url_specs:
         logger.info(f"Register url: {spec[0]}, handler: {spec[1].__name__}")
     app = Application(url_specs) # type: ignore
@@ -92,10 +245,16 @@ def create_application(args):
 def main():
     parser = create_parser()
     args, _= parser.parse_known_args()
+    logger.info(f"Object store: {args.store}")
+    buckets = create_buckets(args)
+    if args.buckets is not None:
+        logger.info(f"Serve buckets {args.buckets.start}-{args.buckets.stop - 1}")
 
-    app = create_application(args)
+    stats = workerstats.WorkerStats()
+    app = create_application(args, buckets, stats)
     logger.info(f"Start server at port = {args.port}")
     app.listen(args.port)
+    IOLoop.current().spawn_callback(stats.monitor_loop)
 
     try:
         IOLoop.current().start()
@@ -106,5 +265,3 @@ def main():
 
 if __name__ == "__main__":
     sys.exit(main())
-
-
@@ -1,12 +1,17 @@
 import argparse
 import logging
 import orjson as json
+import os
 import sys
+import time
 
 from tornado.web import Application
 from tornado.web import RequestHandler
 from tornado.ioloop import IOLoop
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import store as object_store  # noqa: E402
+from common import workerstats  # noqa: E402
 
 
 logger = logging.getLogger(__name__)
@@ -26,7 +31,8 @@ def create_parser():
     parser.add_argument("--id", default=0)
     return parser
 
-store = {}
+store = object_store.DictStore()
+stats = workerstats.WorkerStats()
 
 
 class Handler(RequestHandler):
@@ -34,24 +40,56 @@ class Handler(RequestHandler):
     def initialize(self, args):
         self.args = args
 
+    def prepare(self):
+        self._started = time.perf_counter()
+        self.messages = 0
+
+    def on_finish(self):
+        seconds = time.perf_counter() - self._started
+        stats.record(self.request.path, self.messages, seconds, self.get_status() >= 400)
+
     async def post(self):
-        body = json.loads(self.request.body)
+        messages = json.loads(self.request.body)["messages"]
+        self.messages = len(messages)
+        actions = bytes(ord(message["action"]) for message in messages)
+        object_ids = [message["object_id"] for message in messages]
+        hashes = [message["hash"] for message in messages if message["action"] == "W"]
+        # DictStore keeps the payload count of the stats endpoint
+        values = iter(store.execute(actions, object_ids, hashes))
         result = []
-        for message in body["messages"]:
-            object_id = message["object_id"]
+        for message in messages:
             if message["action"] == "W":
-                body = f"{message['request_id']},{self.args.id}"
-                store[object_id] = message["hash"]
-                result.append(body)
+                result.append(f"{message['request_id']},{self.args.id}")
             elif message["action"] == "R":
-                body = f"{message['request_id']},{store[object_id]}"
-                result.append(body)
+                result.append(f"{message['request_id']},{next(values)}")
         result = {"result": result}
         self.write(result)
 
 
+class StatsHandler(RequestHandler):
+
+    def initialize(self, args):
+        self.args = args
+
+    def get(self):
+        self.write(stats.report({self.args.id: store}))
+
+
+class ReadyHandler(RequestHandler):
+
+    def initialize(self, args):
+        self.args = args
+
+    def get(self):
+        self.write({"ready": True, "buckets": 1})
+
+
 def create_application(args):
-    url_specs = [("/v1/messages", Handler, dict(args=args))]
+    url_specs = [
+        ("/v1/messages", Handler, dict(args=args)),
+        ("/v1/stats", StatsHandler, dict(args=args)),
+        ("/v1/ready", ReadyHandler, dict(args=args)),
+    ]
     for spec in url_specs:
         logger.info(f"Register url: {spec[0]}, handler: {spec[1].__name__}")
     app = Application(url_specs) # type: ignore
@@ -65,6 +103,7 @@ def main():
     app = create_application(args)
     logger.info(f"Start server at port = {args.port}")
     app.listen(args.port)
+    IOLoop.current().spawn_callback(stats.monitor_loop)
 
     try:
         IOLoop.current().start()
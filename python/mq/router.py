@@ -1,7 +1,7 @@
 import asyncio
 import argparse
-import heapq
-import pickle
+import json
+import os
 import sys
 import time
 import logging
@@ -11,6 +11,19 @@ from collections import defaultdict
 import zmq
 import zmq.asyncio
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import batch  # noqa: E402
+from common import cache  # noqa: E402
+from common import directory  # noqa: E402
+from common import hashring  # noqa: E402
+from common import latency  # noqa: E402
+from common import options  # noqa: E402
+from common import placement  # noqa: E402
+from common import routing  # noqa: E402
+from common import sink  # noqa: E402
+from common import trace  # noqa: E402
+from common import workerstats  # noqa: E402
+
 
 logger = logging.getLogger(__name__)
 formatter = logging.Formatter(
@@ -23,16 +36,14 @@ level = "INFO"
 logger.setLevel(level)
 logger.propagate = False
 
-
-class BucketStatus:
-
-    def __init__(self, bucket_id, used_bytes):
-        self._bucket_id = bucket_id
-        self._used_bytes = used_bytes
-
-    def __lt__(self, other):
-        return self._used_bytes < other._used_bytes
-
+# Functions every stage runs in, for --profile
+PROFILE_STAGES = {
+    "parse": "parse_block",
+    "place": "route_batch|group_rows",
+    "serialize": "encode_frames",
+    "deserialize": "decode_ack|ack_lines",
+    "output": "write_output",
+}
 
 
 def create_parser():
@@ -41,11 +52,27 @@ def create_parser():
     parser.add_argument("--result-pub-port", default=[], action="append")
     parser.add_argument("--data", default="data.txt")
     parser.add_argument("--bucket-num", default=1, type=int)
+    parser.add_argument("--block-size", default=trace.BLOCK_SIZE, type=int)
+    options.add_router_arguments(parser)
+    parser.add_argument(
+        "--implicit-acks", action="store_true",
+        help="Ask workers to acknowledge writes by count, the router writes their result lines",
+    )
+    parser.add_argument("--worker-stats", action="store_true", help="Ask every worker for its stats at the end")
+    parser.add_argument(
+        "--stage-stats", action="store_true",
+        help="Histograms of parse, place, serialize, rtt, deserialize and output, logged every --stats-interval",
+    )
+    parser.add_argument("--stats-interval", default=10.0, type=float, help="Seconds between stage summaries")
+    parser.add_argument("--stats-json", default=None, help="Dump the stage histograms here, implies --stage-stats")
+    parser.add_argument(
+        "--profile", default=None,
+        help="cProfile the router into this file and log seconds per stage, implies --stage-stats",
+    )
     return parser
 
 
 def init_bucket(args):
-    buckets = []
     context = zmq.asyncio.Context()
     task = context.socket(zmq.PUB)
     task_address = f"tcp://*:{args.task_pub_port}"
@@ -58,34 +85,125 @@ def init_bucket(args):
         result_pub_address = f"tcp://localhost:{port}"
         logger.info(f"Connect to result pub address: {result_pub_address}")
         result.connect(result_pub_address)
-    for bucket_id in range(args.bucket_num):
-        buckets.append(BucketStatus(bucket_id, 0))
+    if args.routing == "directory":
+        buckets = placement.STRATEGIES[args.placement](range(args.bucket_num))
+    else:
+        buckets = hashring.create(
+            args.routing, range(args.bucket_num), args.hash_weights, args.vnodes, args.compare_balance
+        )
     return buckets, task, result
 
 
-def push_to_bucket(message, buckets, meta_info):
-    bucket = heapq.heappop(buckets)
-    bucket._used_bytes += message["size"]
-    heapq.heappush(buckets, bucket)
-    meta_info[message["object_id"]] = bucket._bucket_id
-    return bucket._bucket_id
-
 global_counter_read = 0
+result_sink = None
+latencies = latency.Latencies()
+stages = latency.NO_STAGES
+# Send time of the batch in flight per bucket, for the rtt stage
+sent = {}
+# Start of the batch in flight per bucket, for the batch latency
+started = {}
+
+implicit_acks = False
+# Batch in flight per bucket, for implicit acks
+written = {}
+
+async def connect_workers(task, result_queue, bucket_num):
+    """Keep sending handshakes until every worker answered one, PUB drops
+    messages for subscribers which are still joining."""
+    pending = set(range(bucket_num))
+    while pending:
+        for bucket_id in pending:
+            await task.send_multipart(batch.encode_control_frames(bucket_id, implicit_acks))
+        await asyncio.sleep(0.03)
+        while await result_queue.poll(timeout=0):
+            frames = await result_queue.recv_multipart()
+            pending.discard(int(frames[0][:-1]))
+
+
+async def log_worker_stats(task, result_queue, bucket_num, timeout=2.0):
+    for bucket_id in range(bucket_num):
+        await task.send_multipart(batch.encode_stats_frames(bucket_id))
+    pending = set(range(bucket_num))
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        if not await result_queue.poll(timeout=100):
+            continue
+        frames = await result_queue.recv_multipart()
+        if frames[1] != batch.STATS:
+            continue
+        bucket_id = int(frames[0][:-1])
+        pending.discard(bucket_id)
+        logger.info(f"Worker {bucket_id}: {workerstats.format_report(json.loads(frames[2]))}")
+    if pending:
+        logger.warning(f"No stats from workers {sorted(pending)}")
+
 
 async def handle_request(bucket_id, task, message, result_queue):
     global global_counter_read
-    message = f"{bucket_id}".encode() +  b"-" + pickle.dumps(message)
     # logger.debug(f"Send message: {message}")
-    await task.send(message)
+    start = started[bucket_id] = latencies.start()
+    frames = trace.encode_frames(bucket_id, message)
+    sent[bucket_id] = stages.record("serialize", start)
+    await task.send_multipart(frames, copy=False)
     logger.debug(f"Send finish for {bucket_id}")
-    message = await result_queue.recv()
-    messages = pickle.loads(message)
-    global_counter_read += len(messages)
-    for content in messages:
-        print(content)
+    while True:
+        frames = await result_queue.recv_multipart(copy=False)
+        # Late answers to the handshake
+        if frames[1].bytes != batch.CONTROL:
+            break
+    # Replies come in any order, time the batch of the bucket that replied
+    replied = int(frames[0].bytes[:-1])
+    latencies.record(started.pop(replied))
+    received = stages.record("rtt", sent[replied])
+    stages.record(f"rtt/{replied}", sent[replied])
+    if frames[1].bytes == batch.ACK:
+        message = written.pop(replied)
+        try:
+            write_acks(frames, message, received)
+        except batch.BatchError as e:
+            print(f"FATAL = {e}, messages={len(message)}", file=sys.stderr)
+            result_sink.skip(message.request_ids)
+        return
+    result = frames[2].bytes
+    stages.record("deserialize", received)
+    if result:
+        global_counter_read += result.count(b"\n") + 1
+        write_output(result, replied)
+
+
+def write_output(result, bucket_id=None):
+    start = stages.start()
+    result_sink.write(result, bucket_id)
+    stages.record("output", start)
+
+
+def write_acks(frames, message, received):
+    """Result lines of the writes of ``message`` a worker acknowledged,
+    replies may come from any bucket with a batch in flight."""
+    global global_counter_read
+    bucket_id = int(frames[0].bytes[:-1])
+    writes, worker_id, lines = batch.decode_ack(frames[2].buffer)
+    request_ids = message.request_ids[message.writes()]
+    if writes != len(request_ids):
+        raise batch.BatchError(f"Worker {bucket_id} acked {writes} writes, sent {len(request_ids)}")
+    acked = sink.ack_lines(request_ids, worker_id)
+    stages.record("deserialize", received)
+    write_output(acked, bucket_id)
+    write_output(bytes(lines), bucket_id)
+    global_counter_read += writes + (lines.tobytes().count(b"\n") + 1 if len(lines) else 0)
 
 
 global_counter_write = 0
+# Reads answered by the read cache, never sent to a worker
+global_counter_cached = 0
+
+def answer_locally(lines):
+    global global_counter_read, global_counter_cached
+    if lines:
+        write_output(b"\n".join(lines))
+        global_counter_read += len(lines)
+        global_counter_cached += len(lines)
+
 
 async def handle(messages, task, result_queue):
     global global_counter_write
@@ -94,14 +212,37 @@ async def handle(messages, task, result_queue):
     for bucket_id, message in messages.items():
         logger.debug(f"Message content size: {len(message)}")
         if message:
+            message = trace.TraceBatch.concat(message)
+            if implicit_acks:
+                written[bucket_id] = message
             tasks.append(handle_request(bucket_id, task, message, result_queue))
             global_counter_write += len(message)
     await asyncio.gather(*tasks)
 
-async def main():
-    parser = create_parser()
-    args, _ = parser.parse_known_args()
-    meta_info = {}  # object_id: bucket_id
+async def report_stages(interval):
+    while True:
+        await asyncio.sleep(interval)
+        for line in stages.format_lines():
+            logger.info(f"Stage {line}")
+
+
+async def route(args, parser):
+    global result_sink, implicit_acks, stages
+    implicit_acks = args.implicit_acks
+    if args.stage_stats:
+        stages = latency.Stages()
+    if args.hash_weights is not None and len(args.hash_weights) != args.bucket_num:
+        parser.error("--hash-weights needs one weight per bucket")
+    result_sink = sink.ResultSink(buffer_bytes=args.sink_buffer, output_dir=args.output_dir)
+    reorder = None
+    if args.ordered_output:
+        result_sink = reorder = sink.ReorderBuffer(result_sink, args.reorder_window)
+    meta_info = None
+    if args.routing == "directory":
+        meta_info = directory.Directory()  # object_id digest: bucket_id
+    read_cache = None
+    if args.cache_bytes:
+        read_cache = cache.ReadCache(args.cache_bytes, args.cache_policy)
     buckets, task, result_queue = init_bucket(args)
 
     s = time.time()
@@ -112,57 +253,89 @@ async def main():
     messages = defaultdict(list)
     # Setup connection
     logger.info("Connection setup stage")
-    for _ in range(100):
-        for bucket_id in range(args.bucket_num):
-            message = [{"action": "C", "object_id": "0"}]
-            message = f"{bucket_id}".encode() +  b"-" + pickle.dumps(message)
-            task.send(message)
-            result_queue.recv()
-        time.sleep(0.03)
+    await connect_workers(task, result_queue, args.bucket_num)
 
     logger.info("Start to ingesting file")
-    with open(args.data) as reader:
-        counter = 0
-        for line in reader:
-            counter += 1
-            body = {}
-            line = line.strip().split(",")
-            body["request_id"] = line[0]
-            body["action"] = line[1]
-            body["object_id"] = line[2]
-            if len(line) > 3:
-                body["size"] = int(line[3])
-                body["hash"] = line[4]
-            if body["action"] == "W":
-                bucket_id = push_to_bucket(body, buckets, meta_info)
-                messages[bucket_id].append(body)
-            else:
-                bucket_id = meta_info[body["object_id"]]
-                messages[bucket_id].append(body)
-            message_count += 1
-            if message_count == message_peak:
+    reporter = asyncio.create_task(report_stages(args.stats_interval)) if args.stage_stats else None
+    counter = 0
+    for trace_batch in stages.timed("parse", trace.read_batches(args.data, args.block_size)):
+        # A slow output holds the parser back
+        await result_sink.drain()
+        if reorder is not None and not reorder.fits(trace_batch.request_ids):
+            # Everything before this batch has to be written out first
+            if message_count:
                 futures.append(handle(messages, task, result_queue))
                 messages = defaultdict(list)
                 message_count = 0
-                if len(futures) == future_peak or True:
-                    logger.debug(f"Fetching data: {len(futures)}")
-                    await asyncio.gather(*futures)
-                    futures = []
-            if counter % 1000000 == 0:
-                logger.info(f"Processed to {counter}")
-                sys.stdout.flush()
+            await asyncio.gather(*futures)
+            futures = []
+            await reorder.wait()
+        start = stages.start()
+        bucket_ids = routing.route_batch(trace_batch, buckets, meta_info)
+        size = len(trace_batch)
+        counter += size
+        if read_cache is not None:
+            rows, lines = read_cache.apply(trace_batch)
+            answer_locally(lines)
+            trace_batch = trace_batch.take(rows)
+            bucket_ids = bucket_ids[rows]
+        for bucket_id, rows in trace.group_rows(bucket_ids):
+            messages[bucket_id].append(trace_batch.take(rows))
+        stages.record("place", start)
+        message_count += len(trace_batch)
+        if message_count >= message_peak:
+            futures.append(handle(messages, task, result_queue))
+            messages = defaultdict(list)
+            message_count = 0
+            if len(futures) == future_peak or True:
+                logger.debug(f"Fetching data: {len(futures)}")
+                await asyncio.gather(*futures)
+                futures = []
+        if counter // 1000000 != (counter - size) // 1000000:
+            logger.info(f"Processed to {counter}")
+            sys.stdout.flush()
     if message_count:
         futures.append(handle(messages, task, result_queue))
         messages = defaultdict(list)
         message_count = 0
     if futures or True:
         await asyncio.gather(*futures)
+    result_sink.close()
     e = time.time()
+    if reporter is not None:
+        reporter.cancel()
     logger.info(f"Time cost: {e - s}")
-    for status in buckets:
-        logger.info(f"{status._bucket_id} = {status._used_bytes} bytes")
+    logger.info(f"Batch latency: {latency.format_summary(latencies.summarize())}")
+    if read_cache is not None:
+        logger.info(f"Read cache: {read_cache.summary()}")
+    if meta_info is not None:
+        logger.info(f"Directory: {len(meta_info)} objects, {meta_info.nbytes} bytes, {meta_info.bytes_per_entry():.1f} bytes/entry")
+    else:
+        logger.info(f"Routing {args.routing}: {buckets.summary()}")
+    for bucket_id, used_bytes in buckets.used_bytes().items():
+        logger.info(f"{bucket_id} = {used_bytes} bytes")
     sys.stdout.flush()
-    logger.info(f"Global counter: {global_counter_write}, {global_counter_read}")
+    logger.info(f"Global counter: {global_counter_write}, {global_counter_read} ({global_counter_cached} cached)")
+    if args.worker_stats:
+        await log_worker_stats(task, result_queue, args.bucket_num)
+    if args.stage_stats:
+        for line in stages.format_lines():
+            logger.info(f"Stage {line}")
+    if args.stats_json:
+        stages.dump(args.stats_json, lines=counter, seconds=e - s)
+        logger.info(f"Stage histograms: {args.stats_json}")
+
+
+async def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    args.stage_stats = args.stage_stats or bool(args.stats_json or args.profile)
+    with latency.profiled(args.profile) as profile:
+        await route(args, parser)
+    if profile is not None:
+        for stage, seconds in latency.profile_stages(profile, PROFILE_STAGES).items():
+            logger.info(f"Profile {stage}: {seconds:.3f}s")
+        logger.info(f"Profile {args.profile}:\n{latency.top_functions(profile)}")
 
 
 if __name__ == '__main__':
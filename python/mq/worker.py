@@ -1,10 +1,18 @@
 import argparse
+import json
 import logging
-import pickle
+import os
 import sys
+import time
 
 import zmq
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import batch  # noqa: E402
+from common import store as object_store  # noqa: E402
+from common import wal  # noqa: E402
+from common import workerstats  # noqa: E402
+
 
 logger = logging.getLogger(__name__)
 formatter = logging.Formatter(
@@ -17,6 +25,8 @@ level = "INFO"
 logger.setLevel(level)
 logger.propagate = False
 
+READ = ord("R")
+WRITE = ord("W")
 
 
 def create_parser():
@@ -24,6 +34,9 @@ def create_parser():
     parser.add_argument("--task-pub-port", default="5555")
     parser.add_argument("--result-pub-port", default="5556")
     parser.add_argument("--id", default=0)
+    parser.add_argument("--store", default="dict", choices=sorted(object_store.STORES))
+    parser.add_argument("--wal-dir", default=None, help="Log writes here and recover from it on start")
+    parser.add_argument("--snapshot-bytes", default=wal.SNAPSHOT_BYTES, type=int)
     return parser
 
 
@@ -41,50 +54,84 @@ def main():
     address = f"tcp://localhost:{args.task_pub_port}"
     logger.info(f"Connect to address: {address}")
     socket.connect(address)
-    topicfilter = f"{args.id}"
+    topicfilter = batch.topic(args.id)
     logger.info(f"Topic filter = {topicfilter}")
-    topicfilter = ""
-    socket.setsockopt_string(zmq.SUBSCRIBE, topicfilter, encoding="utf-8")
-    store = {}
+    socket.setsockopt(zmq.SUBSCRIBE, topicfilter)
+    store = object_store.STORES[args.store]()
+    logger.info(f"Object store: {args.store}")
+    log = None
+    if args.wal_dir:
+        s = time.time()
+        log = wal.Log(args.wal_dir, store, args.snapshot_bytes)
+        records = log.recover()
+        logger.info(f"Recovered {len(store)} objects from {records} records in {time.time() - s:.2f}s")
+    worker_id = str(args.id).encode()
 
     result_socket = context.socket(zmq.PUB)
     result_socket.bind(f"tcp://*:{args.result_pub_port}")
     connecting = False
     connected = False
+    acks = False
+    # No event loop here, loop_lag stays empty
+    stats = workerstats.WorkerStats()
+    # Replies held back for the commit of the batches run since the last one
+    replies = []
 
-    #  Do 10 requests, waiting each time for a response
     while True:
-        #  Get the reply.
         logger.debug("Wait to receive message")
-        messages = socket.recv()
-        # print(messages)
-        messages = messages.split(b"-", maxsplit=1)[1]
-        messages = pickle.loads(messages)
-        logger.debug(f"Receive message: {messages}")
+        try:
+            frames = socket.recv_multipart(zmq.NOBLOCK if replies else 0, copy=False)
+        except zmq.Again:
+            # Nothing else queued, one commit covers every batch run so far
+            log.commit()
+            for reply, messages, start in replies:
+                result_socket.send_multipart(reply, copy=False)
+                stats.record("mixed", messages, time.perf_counter() - start)
+            replies = []
+            continue
+        actions, request_ids, object_ids, hashes = batch.decode_frames(
+            [frame.buffer for frame in frames], store.columnar
+        )
+        if actions == batch.CONTROL:
+            if len(frames) == 3 and frames[2].bytes == batch.STATS:
+                report = json.dumps(stats.report({args.id: store})).encode()
+                result_socket.send_multipart([topicfilter, batch.STATS, report])
+                continue
+            acks = len(frames) == 3 and frames[2].bytes == batch.ACK
+            if not connecting:
+                logger.info(f"Connecting stage, implicit acks: {acks}")
+                connecting = True
+            result_socket.send_multipart([topicfilter, batch.CONTROL, b""])
+            continue
+        if not connected:
+            logger.info("Connected")
+            connected = True
+        logger.debug(f"Receive {len(actions)} messages")
+        start = time.perf_counter()
         result = []
-        for message in messages:
-            object_id = message["object_id"]
-            if message["action"] == "R":
-                body = f"{message['request_id']},{store[object_id]}"
-                result.append(body)
-            elif message["action"] == "W":
-                body = f"{message['request_id']},{args.id}"
-                store[object_id] = message["hash"]
-                result.append(body)
-            elif message["action"] == "C":
-                if not connecting:
-                    logger.info("Connecting stage")
-                    connecting = True
-            else:
-                print(f"Unknown message: {message}")
-            if message["action"] == "C":
-                result_socket.send(pickle.dumps([]))
+        if log is not None and WRITE in actions:
+            # Frames stay referenced until the commit
+            log.append_columns(frames[3].buffer, frames[4].buffer, actions)
+        values = iter(store.execute(actions, object_ids, hashes))
+        # Iterating bytes yields ints, compare against the action code points
+        for action, request_id in zip(actions, request_ids):
+            if action == READ:
+                result.append(b"%d,%s" % (request_id, next(values)))
+            elif action == WRITE:
+                if not acks:
+                    result.append(b"%d,%s" % (request_id, worker_id))
             else:
-                if not connected:
-                    logger.info("Connected")
-                    connected = True
+                print(f"Unknown action: {chr(action)}")
         logger.debug("Finish process message")
-        result_socket.send(pickle.dumps(result))
+        if acks:
+            reply = [batch.ACK, batch.encode_ack(actions.count(WRITE), worker_id, b"\n".join(result))]
+        else:
+            reply = [batch.DATA, b"\n".join(result)]
+        if log is None:
+            result_socket.send_multipart([topicfilter] + reply, copy=False)
+            stats.record("mixed", len(actions), time.perf_counter() - start)
+        else:
+            replies.append(([topicfilter] + reply, len(actions), start))
 
 
 if __name__ == "__main__":
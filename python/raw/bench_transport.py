@@ -0,0 +1,112 @@
+"""Transport cost of the raw worker sessions: tcp, unix and shm.
+
+Starts a raw worker per transport whose batches are not executed, every
+request gets an empty reply, and posts ``--requests`` bodies of
+``--body-bytes`` with ``--concurrency`` in flight. What is left is moving
+the body to the worker, the part the shm rings save a copy of.
+
+    python bench_transport.py --body-bytes 1048576 --requests 2000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import framing  # noqa: E402
+from common import shmring  # noqa: E402
+
+import worker  # noqa: E402
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--body-bytes", default=1 << 20, type=int, help="Bytes per request")
+    parser.add_argument("--requests", default=2000, type=int)
+    parser.add_argument("--concurrency", default=4, type=int)
+    parser.add_argument("--transports", default="tcp,unix,shm")
+    parser.add_argument("--port", default=7700, type=int)
+    parser.add_argument("--socket-dir", default="/tmp")
+    parser.add_argument("--ring-bytes", default=shmring.RING_BYTES, type=int)
+    return parser
+
+
+def serve(transport, args):
+    # Only the transport is measured, batches are dropped unread
+    worker.execute = lambda bucket, payload: [framing.OK, b""]
+    # Unlink the rings on terminate
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    worker_args = worker.create_parser().parse_args([
+        "--port", str(args.port),
+        "--ring-bytes", str(args.ring_bytes),
+    ] + (["--unix-dir", args.socket_dir] if transport != "tcp" else []) + (["--shm"] if transport == "shm" else []))
+    asyncio.run(worker.serve(worker_args, None))
+
+
+async def wait_ready(transport, args, timeout=10):
+    path = framing.socket_path(args.socket_dir, args.port)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if transport == "tcp":
+                _, writer = await asyncio.open_connection("localhost", args.port)
+            else:
+                _, writer = await asyncio.open_unix_connection(path)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise TimeoutError(f"No {transport} worker on port {args.port}")
+
+
+async def post_all(transport, args):
+    await wait_ready(transport, args)
+    if transport == "shm":
+        session = shmring.ShmSession(args.socket_dir)
+    else:
+        session = framing.RawSession(transport, args.socket_dir)
+    url = f"http://localhost:{args.port}/v1/messages/m"
+    body = os.urandom(args.body_bytes)
+    remaining = args.requests
+
+    async def post():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            async with session.post(url, data=body) as response:
+                await response.read()
+
+    s = time.perf_counter()
+    await asyncio.gather(*[post() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - s
+    await session.close()
+    return elapsed
+
+
+def run(transport, args):
+    server = multiprocessing.Process(target=serve, args=(transport, args), daemon=True)
+    server.start()
+    try:
+        elapsed = asyncio.run(post_all(transport, args))
+    finally:
+        server.terminate()
+        server.join()
+    mib = args.requests * args.body_bytes / (1 << 20)
+    print(
+        f"{transport:>4}: {args.requests / elapsed:,.0f} requests/s, {mib / elapsed:,.0f} MiB/s "
+        f"({args.body_bytes} byte bodies)"
+    )
+
+
+def main():
+    parser = create_parser()
+    args, _ = parser.parse_known_args()
+    for transport in args.transports.split(","):
+        run(transport, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import columnar  # noqa: E402
+from common import framing  # noqa: E402
+from common import shmring  # noqa: E402
+from common import store as object_store  # noqa: E402
+from common import wal  # noqa: E402
+
+
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] [%(filename)s:%(lineno)d:%(funcName)s] %(message)s"
+)
+handler = logging.StreamHandler(stream=sys.stderr)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+level = "INFO"
+logger.setLevel(level)
+logger.propagate = False
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", default=5555, type=int)
+    parser.add_argument("--id", default=0)
+    parser.add_argument("--unix-dir", default=None, help="Listen on worker-<port>.sock here instead of TCP")
+    parser.add_argument("--shm", action="store_true", help="Take batches from shared memory rings, needs --unix-dir")
+    parser.add_argument("--ring-bytes", default=shmring.RING_BYTES, type=int, help="Size of every --shm ring")
+    parser.add_argument("--store", default="dict", choices=sorted(object_store.STORES))
+    parser.add_argument("--wal-dir", default=None, help="Log writes here and recover from it on start")
+    parser.add_argument("--snapshot-bytes", default=wal.SNAPSHOT_BYTES, type=int)
+    return parser
+
+def execute(bucket, payload):
+    """``[status, result]`` of a request payload, its accept byte and batch."""
+    # Bytes from a socket are copied once, ring records stay views
+    acked, result = columnar.execute(bucket, payload[1:], payload[:1] == framing.ACK)
+    return [framing.ACK if acked else framing.OK, result]
+
+
+class WorkerProtocol(asyncio.Protocol):
+    """Runs the batches of a connection in the order they arrive."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.transport = None
+        self._parser = framing.FrameParser()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        logger.info(f"Router connected from {transport.get_extra_info('peername')}")
+
+    def data_received(self, data):
+        log = self.bucket.log
+        replies = []
+        # One commit for every batch that came in with this data
+        with log.deferred() if log is not None else contextlib.nullcontext():
+            for frame_id, payload in self._parser.feed(data):
+                try:
+                    parts = execute(self.bucket, payload)
+                except Exception as e:
+                    logger.exception(f"Batch {frame_id} failed")
+                    parts = [framing.ERROR, repr(e).encode()]
+                replies.append((frame_id, parts))
+        if log is not None and replies:
+            log.commit()
+        for frame_id, parts in replies:
+            self.transport.writelines(framing.encode_frame(frame_id, parts))
+
+    def pause_writing(self):
+        # Stop taking batches until the router reads its results
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        logger.info(f"Router disconnected: {exc}")
+
+
+class RingProtocol(asyncio.Protocol):
+    """Runs the batches of the request ring in place, the socket only
+    carries doorbells."""
+
+    def __init__(self, bucket, requests, replies):
+        self.bucket = bucket
+        self.transport = None
+        self.requests = requests
+        self.replies = replies
+        self._pending = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        logger.info("Router attached to the rings")
+
+    def data_received(self, data):
+        written = False
+        while True:
+            while self._pending:
+                frame_id, parts = self._pending[0]
+                if not self.replies.put(frame_id, parts):
+                    # Ring the router to drain its replies
+                    if written:
+                        self.transport.write(shmring.DOORBELL)
+                    return
+                self._pending.pop(0)
+                written = True
+            record = self.requests.get()
+            if record is None:
+                break
+            frame_id, payload = record
+            try:
+                status, result = execute(self.bucket, payload)
+            except Exception as e:
+                logger.exception(f"Batch {frame_id} failed")
+                status, result = framing.ERROR, repr(e).encode()
+            del payload
+            self.requests.release()
+            self._pending = [
+                (frame_id, parts) for parts in shmring.reply_records(status, result, self.replies.max_record)
+            ]
+        if written:
+            self.transport.write(shmring.DOORBELL)
+
+    def connection_lost(self, exc):
+        logger.info(f"Router detached: {exc}")
+
+
+async def serve_rings(args, bucket):
+    path = framing.socket_path(args.unix_dir, args.port)
+    if os.path.exists(path):
+        os.remove(path)
+    requests = shmring.Ring(shmring.ring_name(args.port, "requests"), args.ring_bytes)
+    replies = shmring.Ring(shmring.ring_name(args.port, "replies"), args.ring_bytes)
+    try:
+        server = await asyncio.get_running_loop().create_unix_server(
+            lambda: RingProtocol(bucket, requests, replies), path
+        )
+        logger.info(f"Start server at {path}, rings {requests.name} and {replies.name} of {args.ring_bytes} bytes")
+        async with server:
+            await server.serve_forever()
+    finally:
+        requests.close()
+        replies.close()
+
+
+async def serve(args, bucket):
+    loop = asyncio.get_running_loop()
+    if args.shm:
+        await serve_rings(args, bucket)
+        return
+    if args.unix_dir:
+        path = framing.socket_path(args.unix_dir, args.port)
+        if os.path.exists(path):
+            os.remove(path)
+        server = await loop.create_unix_server(lambda: WorkerProtocol(bucket), path)
+        logger.info(f"Start server at {path}")
+    else:
+        server = await loop.create_server(lambda: WorkerProtocol(bucket), port=args.port)
+        logger.info(f"Start server at port = {args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = create_parser()
+    args, _= parser.parse_known_args()
+    if args.shm and not args.unix_dir:
+        parser.error("--shm needs --unix-dir for the doorbell socket")
+    logger.info(f"Object store: {args.store}")
+    s = time.time()
+    bucket = columnar.Bucket(args.id, args, args.wal_dir)
+    if args.wal_dir:
+        logger.info(f"Recovered {len(bucket.store)} objects from {bucket.records} records in {time.time() - s:.2f}s")
+    try:
+        asyncio.run(serve(args, bucket))
+    except KeyboardInterrupt:
+        logger.info("Stop raw service")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
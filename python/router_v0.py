@@ -1,6 +1,6 @@
 import asyncio
 import argparse
-import heapq
+import json
 import pickle
 import sys
 import time
@@ -11,6 +11,18 @@ from collections import defaultdict
 import zmq
 import zmq.asyncio
 
+from common import batch
+from common import cache
+from common import directory
+from common import hashring
+from common import latency
+from common import options
+from common import placement
+from common import routing
+from common import sink
+from common import trace
+from common import workerstats
+
 
 logger = logging.getLogger(__name__)
 formatter = logging.Formatter(
@@ -23,109 +35,155 @@ level = "INFO"
 logger.setLevel(level)
 
 
-class BucketStatus:
-
-    def __init__(self, bucket_id, used_bytes):
-        self._bucket_id = bucket_id
-        self._used_bytes = used_bytes
-
-    def __lt__(self, other):
-        return self._used_bytes < other._used_bytes
-
-
-
 def create_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--worker-start-port", default=5555)
+    parser.add_argument("--worker-start-port", default=5555, type=int)
     parser.add_argument("--data", default="data.txt")
     parser.add_argument("--bucket-num", default=1, type=int)
+    parser.add_argument("--block-size", default=trace.BLOCK_SIZE, type=int)
+    parser.add_argument("--queue-size", default=4, type=int, help="Batches queued per bucket")
+    options.add_router_arguments(parser)
+    parser.add_argument("--worker-stats", action="store_true", help="Ask every worker for its stats at the end")
     return parser
 
 
 def init_bucket(args):
-    buckets = []
     tasks = []
+    locks = []
     context = zmq.asyncio.Context()
     for bucket_id in range(args.bucket_num):
-        buckets.append(BucketStatus(bucket_id, 0))
         task = context.socket(zmq.REQ)
         task.connect(f"tcp://localhost:{args.worker_start_port + bucket_id}")
         tasks.append(task)
-    return buckets, tasks
-
-
-def push_to_bucket(message, buckets, meta_info):
-    bucket = heapq.heappop(buckets)
-    bucket._used_bytes += message["size"]
-    heapq.heappush(buckets, bucket)
-    meta_info[message["object_id"]] = bucket._bucket_id
-    return bucket._bucket_id
+        # A REQ socket only allows one outstanding request
+        locks.append(asyncio.Lock())
+    if args.routing == "directory":
+        buckets = placement.STRATEGIES[args.placement](range(args.bucket_num))
+    else:
+        buckets = hashring.create(
+            args.routing, range(args.bucket_num), args.hash_weights, args.vnodes, args.compare_balance
+        )
+    return buckets, tasks, locks
+
+
+
+result_sink = None
+latencies = latency.Latencies()
+
+
+async def send_batches(bucket_id, queue, tasks, locks):
+    """Send the batches of one bucket in flush order, so every read goes
+    out behind the write it depends on. The REQ socket has one request
+    outstanding anyway."""
+    while (message := await queue.get()) is not None:
+        message = trace.TraceBatch.concat(message).to_messages()
+        async with locks[bucket_id]:
+            start = latencies.start()
+            await tasks[bucket_id].send(pickle.dumps(message))
+            result = await tasks[bucket_id].recv()
+            latencies.record(start)
+        result_sink.write("\n".join(pickle.loads(result)).encode(), bucket_id)
 
 
-async def handle(messages, tasks):
+async def handle(messages, queues):
+    """Queue a flush on its buckets, a full queue holds the parser back."""
     logger.debug(f"Message bucket size: {len(messages)}")
     for bucket_id, message in messages.items():
         logger.debug(f"Message content size: {len(message)}")
         if message:
-            await tasks[bucket_id].send(pickle.dumps(message))
-            result = await tasks[bucket_id].recv()
-            for content in pickle.loads(result):
-                print(content)
-                # sys.stdout.flush()
+            await queues[bucket_id].put(message)
+
+
+async def log_worker_stats(tasks, locks, timeout=2.0):
+    for bucket_id, task in enumerate(tasks):
+        async with locks[bucket_id]:
+            await task.send_multipart([batch.CONTROL, batch.STATS])
+            # A worker without stats leaves its REQ socket waiting, the run is over anyway
+            if not await task.poll(timeout * 1000):
+                logger.warning(f"No stats from worker {bucket_id}")
+                continue
+            report = json.loads(await task.recv())
+        logger.info(f"Worker {bucket_id}: {workerstats.format_report(report)}")
 
 
 async def main():
+    global result_sink
     parser = create_parser()
     args, _ = parser.parse_known_args()
-    meta_info = {}  # object_id: bucket_id
-    buckets, tasks = init_bucket(args)
+    if args.hash_weights is not None and len(args.hash_weights) != args.bucket_num:
+        parser.error("--hash-weights needs one weight per bucket")
+    result_sink = sink.ResultSink(buffer_bytes=args.sink_buffer, output_dir=args.output_dir)
+    reorder = None
+    if args.ordered_output:
+        result_sink = reorder = sink.ReorderBuffer(result_sink, args.reorder_window)
+    meta_info = None
+    if args.routing == "directory":
+        meta_info = directory.Directory()  # object_id digest: bucket_id
+    read_cache = None
+    if args.cache_bytes:
+        read_cache = cache.ReadCache(args.cache_bytes, args.cache_policy)
+    buckets, tasks, locks = init_bucket(args)
+    queues = [asyncio.Queue(args.queue_size) for _ in range(args.bucket_num)]
+    senders = [
+        asyncio.create_task(send_batches(bucket_id, queue, tasks, locks))
+        for bucket_id, queue in enumerate(queues)
+    ]
 
     s = time.time()
-    futures = []
-    future_peak = 5000
     message_peak = 1000
     message_count = 0
     messages = defaultdict(list)
     logger.info("Start to ingesting file")
-    with open(args.data) as reader:
-        counter = 0
-        for line in reader:
-            counter += 1
-            body = {}
-            line = line.strip().split(",")
-            body["request_id"] = line[0]
-            body["action"] = line[1]
-            body["object_id"] = line[2]
-            if len(line) > 3:
-                body["size"] = int(line[3])
-                body["hash"] = line[4]
-            if body["action"] == "W":
-                bucket_id = push_to_bucket(body, buckets, meta_info)
-                messages[bucket_id].append(body)
-            else:
-                bucket_id = meta_info[body["object_id"]]
-                messages[bucket_id].append(body)
-            message_count += 1
-            if message_count == message_peak:
-                futures.append(handle(messages, tasks))
+    counter = 0
+    for trace_batch in trace.read_batches(args.data, args.block_size):
+        # A slow output holds the parser back
+        await result_sink.drain()
+        if reorder is not None and not reorder.fits(trace_batch.request_ids):
+            # Everything before this batch has to be written out first
+            if message_count:
+                await handle(messages, queues)
                 messages = defaultdict(list)
                 message_count = 0
-                if len(futures) == future_peak:
-                    await asyncio.gather(*futures)
-                    futures = []
-            if counter % 1000000 == 0:
-                logger.info(f"Processed to {counter}")
-                sys.stdout.flush()
+            await reorder.wait()
+        bucket_ids = routing.route_batch(trace_batch, buckets, meta_info)
+        size = len(trace_batch)
+        counter += size
+        if read_cache is not None:
+            rows, lines = read_cache.apply(trace_batch)
+            result_sink.write(b"\n".join(lines))
+            trace_batch = trace_batch.take(rows)
+            bucket_ids = bucket_ids[rows]
+        for bucket_id, rows in trace.group_rows(bucket_ids):
+            messages[bucket_id].append(trace_batch.take(rows))
+        message_count += len(trace_batch)
+        if message_count >= message_peak:
+            await handle(messages, queues)
+            messages = defaultdict(list)
+            message_count = 0
+        if counter // 1000000 != (counter - size) // 1000000:
+            logger.info(f"Processed to {counter}")
+            sys.stdout.flush()
     if message_count:
-        futures.append(handle(messages, tasks))
+        await handle(messages, queues)
         messages = defaultdict(list)
         message_count = 0
-    if futures:
-        await asyncio.gather(*futures)
+    for queue in queues:
+        await queue.put(None)
+    await asyncio.gather(*senders)
+    result_sink.close()
     e = time.time()
     logger.info(f"Time cost: {e - s}")
-    for status in buckets:
-        logger.info(f"{status._bucket_id} = {status._used_bytes} bytes")
+    logger.info(f"Batch latency: {latency.format_summary(latencies.summarize())}")
+    if read_cache is not None:
+        logger.info(f"Read cache: {read_cache.summary()}")
+    if meta_info is not None:
+        logger.info(f"Directory: {len(meta_info)} objects, {meta_info.nbytes} bytes, {meta_info.bytes_per_entry():.1f} bytes/entry")
+    else:
+        logger.info(f"Routing {args.routing}: {buckets.summary()}")
+    for bucket_id, used_bytes in buckets.used_bytes().items():
+        logger.info(f"{bucket_id} = {used_bytes} bytes")
+    if args.worker_stats:
+        await log_worker_stats(tasks, locks)
 
 
 if __name__ == '__main__':
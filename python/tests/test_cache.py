@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import cache  # noqa: E402
+from common import trace  # noqa: E402
+
+
+OBJECT = b"a" * 32
+FIRST = b"1" * 128
+SECOND = b"2" * 128
+
+
+def block(*rows):
+    lines = []
+    for request_id, row in enumerate(rows):
+        if row[0] == "W":
+            lines.append(b"%d,W,%s,10,%s" % (request_id, row[1], row[2]))
+        else:
+            lines.append(b"%d,R,%s" % (request_id, row[1]))
+    return trace.parse_block(b"\n".join(lines) + b"\n")
+
+
+@pytest.mark.parametrize("policy", sorted(cache.POLICIES))
+def test_read_between_rewrites(policy):
+    read_cache = cache.ReadCache(1 << 20, policy)
+    rows, lines = read_cache.apply(block(("W", OBJECT, FIRST), ("R", OBJECT), ("W", OBJECT, SECOND)))
+    assert lines == [b"1,%s" % FIRST]
+    assert rows.tolist() == [0, 2]
+
+
+@pytest.mark.parametrize("policy", sorted(cache.POLICIES))
+def test_read_before_rewrite_sees_earlier_batch(policy):
+    read_cache = cache.ReadCache(1 << 20, policy)
+    read_cache.apply(block(("W", OBJECT, FIRST)))
+    rows, lines = read_cache.apply(block(("R", OBJECT), ("W", OBJECT, SECOND), ("R", OBJECT)))
+    assert lines == [b"0,%s" % FIRST, b"2,%s" % SECOND]
+    assert rows.tolist() == [1]
+    _, lines = read_cache.apply(block(("R", OBJECT)))
+    assert lines == [b"0,%s" % SECOND]
+    assert read_cache.hits == 3
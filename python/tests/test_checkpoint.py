@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import checkpoint  # noqa: E402
+from common import directory  # noqa: E402
+from common import placement  # noqa: E402
+from common import sink  # noqa: E402
+
+
+def test_save_and_load(tmp_path):
+    meta_info = directory.Directory(capacity=16)
+    digests = np.arange(2, 1002, dtype=np.uint64)
+    meta_info.put_many(digests, digests % 3)
+    buckets = placement.GreedyPlacement(range(3))
+    buckets.place([100, 250, 40, 7])
+    result_sink = sink.ResultSink(output_dir=str(tmp_path / "out"))
+    result_sink.write(b"0,1\n1,2", 1)
+    checkpoints = checkpoint.Checkpoints(str(tmp_path / "checkpoints"), meta_info, buckets, interval=0, data="t")
+    for offset in (512, 4096):
+        checkpoints.advance(offset, 2, 2)
+        # Not due while the last checkpoint is still being written
+        while not checkpoints.due():
+            time.sleep(0.01)
+        state, _ = checkpoints.save(result_sink, {1: (1, 1)})
+    checkpoints.close()
+    result_sink.close()
+    # Only the latest checkpoint is kept
+    assert sorted(os.listdir(tmp_path / "checkpoints")) == [
+        "checkpoint-00000002.json", "checkpoint-00000002.keys.npy", "checkpoint-00000002.values.npy"
+    ]
+
+    loaded, restored = checkpoint.load(str(tmp_path / "checkpoints"))
+    assert loaded == state
+    assert (loaded["offset"], loaded["data"], loaded["acked"]) == (4096, "t", {"1": [1, 1]})
+    assert loaded["output"] == {"bucket-1.out": 8}
+    assert len(restored) == len(meta_info)
+    assert restored.lookup(digests).tolist() == (digests % 3).tolist()
+    # The restored tables take writes and grow like a fresh directory
+    more = np.arange(1002, 3002, dtype=np.uint64)
+    restored.put_many(more, more % 3)
+    assert restored.lookup(np.concatenate([digests, more])).tolist() == (np.arange(2, 3002) % 3).tolist()
+
+    resumed = placement.GreedyPlacement(range(3))
+    checkpoint.restore_used(resumed, loaded["used_bytes"])
+    assert resumed.used_bytes() == buckets.used_bytes()
+
+
+def test_load_without_checkpoint(tmp_path):
+    assert checkpoint.load(str(tmp_path / "missing")) == (None, None)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import directory  # noqa: E402
+
+
+def test_grow_keeps_entries():
+    meta_info = directory.Directory(capacity=16)
+    rng = np.random.default_rng(0)
+    digests = rng.integers(2, 1 << 63, 5000, dtype=np.uint64)
+    bucket_ids = rng.integers(0, 8, len(digests))
+    for start in range(0, len(digests), 700):
+        meta_info.put_many(digests[start:start + 700], bucket_ids[start:start + 700])
+    assert len(meta_info) == len(digests)
+    assert meta_info.capacity * directory.MAX_LOAD >= len(digests)
+    assert meta_info.lookup(digests).tolist() == bucket_ids.tolist()
+
+
+def test_last_of_repeated_digests_wins():
+    meta_info = directory.Directory(capacity=16)
+    meta_info.put_many([5, 6, 5, 5], [1, 2, 3, 4])
+    meta_info.put_many([6], [7])
+    assert len(meta_info) == 2
+    assert meta_info.lookup([5, 6]).tolist() == [4, 7]
+
+
+def test_unknown_digest():
+    meta_info = directory.Directory()
+    meta_info[b"a" * 32] = 3
+    assert meta_info[b"a" * 32] == 3
+    assert meta_info.get(b"b" * 32) is None
+    _, found = meta_info.find([9])
+    assert not found[0]
+    with pytest.raises(KeyError):
+        meta_info.lookup([9])
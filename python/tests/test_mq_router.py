@@ -0,0 +1,61 @@
+import asyncio
+import importlib.util
+import os
+import sys
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import batch  # noqa: E402
+from common import sink  # noqa: E402
+from common import trace  # noqa: E402
+
+
+spec = importlib.util.spec_from_file_location(
+    "mq_router", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mq", "router.py")
+)
+router = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(router)
+
+HASH = b"h" * 128
+
+
+class Task:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_multipart(self, frames, copy=True):
+        self.sent.append(frames)
+
+
+class Results:
+    """Replies of the SUB socket, in the order given."""
+
+    def __init__(self, replies):
+        self.replies = [[zmq.Frame(frame) for frame in frames] for frames in replies]
+
+    async def recv_multipart(self, copy=True):
+        await asyncio.sleep(0)
+        return self.replies.pop(0)
+
+
+def writes(*request_ids):
+    return trace.parse_block(b"".join(
+        b"%d,W,%s,10,%s\n" % (request_id, b"%032d" % request_id, HASH) for request_id in request_ids
+    ))
+
+
+def test_results_go_to_the_bucket_that_replied(tmp_path):
+    router.result_sink = sink.ResultSink(output_dir=str(tmp_path))
+    # Bucket 1 answers first, the reply reaches the request sent to bucket 0
+    results = Results([
+        [batch.topic(1), batch.DATA, b"2,1\n3,1"],
+        [batch.topic(0), batch.DATA, b"0,0\n1,0"],
+    ])
+    asyncio.run(router.handle({0: [writes(0, 1)], 1: [writes(2, 3)]}, Task(), results))
+    router.result_sink.close()
+    for bucket_id in range(2):
+        lines = (tmp_path / f"bucket-{bucket_id}.out").read_bytes().split()
+        assert len(lines) == 2
+        assert all(line.endswith(b",%d" % bucket_id) for line in lines)
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import directory  # noqa: E402
+from common import placement  # noqa: E402
+from common import routing  # noqa: E402
+from common import trace  # noqa: E402
+
+
+OBJECT = b"a" * 32
+OTHER = b"b" * 32
+HASH = b"h" * 128
+
+
+def block(*rows):
+    lines = []
+    for request_id, row in enumerate(rows):
+        if row[0] == "W":
+            lines.append(b"%d,W,%s,%d,%s" % (request_id, row[1], row[2], HASH))
+        else:
+            lines.append(b"%d,R,%s" % (request_id, row[1]))
+    return trace.parse_block(b"\n".join(lines) + b"\n")
+
+
+def charged(trace_batch, bucket_ids):
+    """Bytes of the writes per bucket they were routed to."""
+    writes = trace_batch.writes()
+    used = {}
+    for bucket_id, size in zip(bucket_ids[writes].tolist(), trace_batch.sizes[writes].tolist()):
+        used[bucket_id] = used.get(bucket_id, 0) + size
+    return used
+
+
+def test_rewrite_within_a_batch():
+    buckets = placement.GreedyPlacement(range(2))
+    meta_info = directory.Directory()
+    trace_batch = block(("W", OBJECT, 100), ("R", OBJECT), ("W", OBJECT, 5))
+    bucket_ids = routing.route_batch(trace_batch, buckets, meta_info)
+    # The read goes where the write before it went, not the later one
+    assert bucket_ids[1] == bucket_ids[0]
+    assert bucket_ids[2] != bucket_ids[0]
+    assert charged(trace_batch, bucket_ids) == {k: v for k, v in buckets.used_bytes().items() if v}
+    assert meta_info[OBJECT] == bucket_ids[2]
+
+
+def test_read_before_rewrite_sees_earlier_batch():
+    buckets = placement.GreedyPlacement(range(2))
+    meta_info = directory.Directory()
+    first = routing.route_batch(block(("W", OBJECT, 100)), buckets, meta_info)
+    trace_batch = block(("R", OBJECT), ("W", OBJECT, 5), ("R", OBJECT), ("W", OTHER, 1))
+    bucket_ids = routing.route_batch(trace_batch, buckets, meta_info)
+    assert bucket_ids[0] == first[0]
+    assert bucket_ids[2] == bucket_ids[1]
+    assert meta_info[OBJECT] == bucket_ids[1]
+
+
+def test_latest_writes():
+    digests = np.array([7, 7, 8, 7, 8, 9, 7], np.uint64)
+    writes = np.array([0, 3, 4])
+    reads = np.array([1, 2, 5, 6])
+    assert routing.latest_writes(digests, writes, reads).tolist() == [0, -1, -1, 3]
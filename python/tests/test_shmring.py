@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import shmring  # noqa: E402
+
+
+@pytest.fixture
+def ring():
+    # One process plays both sides, attaching a second time would unregister
+    # the ring from the resource tracker of its owner
+    ring = shmring.Ring(f"test-ring-{os.getpid()}", 256)
+    yield ring
+    ring.close()
+
+
+def take(reader):
+    frame_id, payload = reader.get()
+    data = bytes(payload)
+    payload.release()
+    reader.release()
+    return frame_id, data
+
+
+def test_wraparound_near_capacity(ring):
+    writer = reader = ring
+    assert writer.max_record == 128
+    sent = []
+    received = []
+    # Sizes that leave every kind of remainder at the end of the ring
+    for frame_id in range(200):
+        parts = [b"%d:" % frame_id, b"x" * (frame_id * 7 % 100)]
+        while not writer.put(frame_id, parts):
+            received.append(take(reader))
+        sent.append((frame_id, b"".join(parts)))
+    while reader.get() is not None:
+        received.append(take(reader))
+    assert received == sent
+
+
+def test_full_ring_refuses_until_released(ring):
+    writer = reader = ring
+    record = b"y" * 56
+    puts = 0
+    while writer.put(puts, [record]):
+        puts += 1
+    # 64 bytes a record with its header
+    assert puts == 256 // 64
+    assert take(reader) == (0, record)
+    assert writer.put(puts, [record])
+    with pytest.raises(ValueError):
+        writer.put(0, [b"z" * 200])
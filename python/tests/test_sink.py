@@ -0,0 +1,91 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import sink  # noqa: E402
+
+
+def test_buffers_reach_the_file(tmp_path):
+    path = tmp_path / "out.txt"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    result_sink = sink.ResultSink(fd, buffer_bytes=8)
+    for request_id in range(100):
+        result_sink.write(b"%d,0" % request_id)
+    result_sink.write(b"")
+    result_sink.close()
+    os.close(fd)
+    assert path.read_bytes() == b"".join(b"%d,0\n" % request_id for request_id in range(100))
+    assert result_sink.nbytes == path.stat().st_size
+
+
+def test_output_dir_and_resume(tmp_path):
+    result_sink = sink.ResultSink(output_dir=str(tmp_path))
+    result_sink.write(b"0,1\n1,1", 1)
+    result_sink.write(b"2,h")
+    result_sink.close()
+    assert (tmp_path / "bucket-1.out").read_bytes() == b"0,1\n1,1\n"
+    assert (tmp_path / "router.out").read_bytes() == b"2,h\n"
+    written = dict(result_sink.written)
+    # A crash after more was written, resuming cuts the files back
+    with open(tmp_path / "bucket-1.out", "ab") as f:
+        f.write(b"3,1\n4,")
+    result_sink = sink.ResultSink(output_dir=str(tmp_path), resume=written)
+    result_sink.write(b"3,1", 1)
+    result_sink.close()
+    assert (tmp_path / "bucket-1.out").read_bytes() == b"0,1\n1,1\n3,1\n"
+
+
+def test_split_and_ack_lines():
+    request_ids, lines = sink.split_lines(b"12,a\n3,b\n456,c")
+    assert request_ids.tolist() == [12, 3, 456]
+    assert lines == [b"12,a", b"3,b", b"456,c"]
+    assert sink.ack_lines([7, 1000, 42], b"2") == b"7,2\n1000,2\n42,2"
+    assert sink.ack_lines([], b"2") == b""
+
+
+def reordered(tmp_path, window, writes, output_dir=False):
+    path = tmp_path / "out.txt"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    result_sink = sink.ResultSink(fd, output_dir=str(tmp_path) if output_dir else None)
+    reorder = sink.ReorderBuffer(result_sink, window)
+    for data, bucket_id in writes:
+        reorder.write(data, bucket_id)
+    reorder.close()
+    os.close(fd)
+    return path.read_bytes()
+
+
+def test_reorder_across_the_window_end(tmp_path):
+    writes = [(b"1,a\n3,a", 0), (b"2,b", 1), (b"0,b", 1), (b"5,a\n6,a", 0), (b"4,b", 1), (b"7,a", 0)]
+    assert reordered(tmp_path, 4, writes) == b"".join(b"%d,%s\n" % (i, b"bababaaa"[i:i + 1]) for i in range(8))
+
+
+def test_reorder_per_bucket_file(tmp_path):
+    writes = [(b"2,w", 1), (b"1,w", 0), (b"3,w", 0), (b"0,w", 1)]
+    reordered(tmp_path, 8, writes, output_dir=True)
+    assert (tmp_path / "bucket-0.out").read_bytes() == b"1,w\n3,w\n"
+    assert (tmp_path / "bucket-1.out").read_bytes() == b"0,w\n2,w\n"
+
+
+def test_reorder_skips_and_gaps(tmp_path):
+    path = tmp_path / "out.txt"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    reorder = sink.ReorderBuffer(sink.ResultSink(fd), 4)
+    assert reorder.fits([0, 1, 2, 3])
+    assert not reorder.fits([4, 5])
+    reorder.write(b"1,b")
+    # A failed request frees its rows without a line
+    reorder.skip([0, 2])
+    reorder.write(b"3,d")
+    assert reorder.base == 4
+    assert reorder.fits([4, 5])
+    # Lines behind one that never came are written on close
+    reorder.write(b"5,f")
+    reorder.close()
+    os.close(fd)
+    assert path.read_bytes() == b"1,b\n3,d\n5,f\n"
+
+
+def test_reorder_gaps_past_the_ring_end(tmp_path):
+    writes = [(b"0,a\n1,a", None), (b"3,a", None), (b"5,a", None)]
+    assert reordered(tmp_path, 4, writes) == b"0,a\n1,a\n3,a\n5,a\n"
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import store as object_store  # noqa: E402
+
+
+A = b"a" * 32
+B = b"b" * 32
+FIRST = b"1" * 128
+SECOND = b"2" * 128
+THIRD = b"3" * 128
+
+
+def values_list(values):
+    return values.tolist() if hasattr(values, "tolist") else list(values)
+
+
+@pytest.mark.parametrize("name", sorted(object_store.STORES))
+def test_execute_in_trace_order(name):
+    store = object_store.STORES[name]()
+    values = store.execute(b"WRWRWR", [A, A, A, A, B, B], [FIRST, SECOND, THIRD])
+    assert values_list(values) == [FIRST, SECOND, THIRD]
+    assert len(store) == 2
+    assert store.payload_bytes == 2 * (32 + 128)
+
+
+@pytest.mark.parametrize("name", sorted(object_store.STORES))
+def test_execute_reads_behind_writes(name):
+    store = object_store.STORES[name]()
+    store.put_many([A], [FIRST])
+    values = store.execute(b"RWWR", [A, B, A, B], [SECOND, THIRD])
+    assert values_list(values) == [FIRST, SECOND]
+    assert values_list(store.get_many([A, B])) == [THIRD, SECOND]
+
+
+@pytest.mark.parametrize("name", sorted(object_store.STORES))
+def test_chunks_are_copies(name):
+    store = object_store.STORES[name]()
+    store.put_many([A, B], [FIRST, SECOND])
+    chunks = store.chunks(1)
+    store.put_many([A], [THIRD])
+    assert [[bytes(value) for value in hashes] for _, hashes in chunks] == [[FIRST], [SECOND]]
+
+
+def test_dict_store_payload_of_mixed_widths():
+    store = object_store.DictStore()
+    store.put_many([A, B], [FIRST, SECOND])
+    store.put_many([b"c"], [b"short"])
+    store.execute(b"WR", [A, b"c"], [b"x"])
+    assert store.payload_bytes == 32 + 1 + 32 + 128 + 1 + 5
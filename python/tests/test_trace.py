@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import trace  # noqa: E402
+
+
+OBJECT = b"a" * 32
+HASH = b"h" * 128
+LINES = [b"0,W,%s,10,%s" % (OBJECT, HASH), b"1,R,%s" % OBJECT, b"2,W,%s,7,%s" % (OBJECT, HASH)]
+
+
+def test_crlf_lines():
+    lf = trace.parse_block(b"\n".join(LINES) + b"\n")
+    crlf = trace.parse_block(b"\r\n".join(LINES) + b"\r\n")
+    assert crlf.request_ids.tolist() == lf.request_ids.tolist() == [0, 1, 2]
+    assert crlf.object_ids.tolist() == lf.object_ids.tolist() == [OBJECT] * 3
+    assert crlf.hashes.tolist() == lf.hashes.tolist() == [HASH, b"", HASH]
+    assert crlf.sizes.tolist() == [10, 0, 7]
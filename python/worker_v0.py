@@ -1,14 +1,21 @@
 import argparse
+import json
 import pickle
 import sys
+import time
 
 import zmq
 
+from common import batch
+from common import store as object_store
+from common import workerstats
+
 
 def create_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--worker-port", default="5555")
     parser.add_argument("--id", default=0)
+    parser.add_argument("--store", default="dict", choices=sorted(object_store.STORES))
     return parser
 
 
@@ -21,27 +28,36 @@ def main():
     print(f"Create worker for {args.id}")
     socket = context.socket(zmq.REP)
     socket.bind(f"tcp://*:{args.worker_port}")
-    store = {}
+    store = object_store.STORES[args.store]()
+    print(f"Object store: {args.store}")
+    # No event loop here, loop_lag stays empty
+    stats = workerstats.WorkerStats()
 
     #  Do 10 requests, waiting each time for a response
     while True:
         #  Get the reply.
-        messages = socket.recv()
-        messages = pickle.loads(messages)
+        frames = socket.recv_multipart()
+        if frames == [batch.CONTROL, batch.STATS]:
+            socket.send(json.dumps(stats.report({args.id: store})).encode())
+            continue
+        start = time.perf_counter()
+        messages = pickle.loads(frames[0])
         # print(f"Receive message: {message}")
+        # Stores hold bytes and run the batch in order
+        actions = "".join([message["action"] for message in messages]).encode()
+        object_ids = [message["object_id"].encode() for message in messages]
+        hashes = [message["hash"].encode() for message in messages if message["action"] == "W"]
+        values = iter(store.execute(actions, object_ids, hashes))
         result = []
         for message in messages:
-            object_id = message["object_id"]
             if message["action"] == "R":
-                body = f"{message['request_id']},{store[object_id]}"
-                result.append(body)
+                result.append(f"{message['request_id']},{next(values).decode()}")
             elif message["action"] == "W":
-                body = f"{message['request_id']},{args.id}"
-                store[object_id] = message["hash"]
-                result.append(body)
+                result.append(f"{message['request_id']},{args.id}")
             else:
                 print(f"Unknown message: {message}")
         socket.send(pickle.dumps(result))
+        stats.record("mixed", len(messages), time.perf_counter() - start)
 
 
 if __name__ == "__main__":